@@ -7,8 +7,14 @@ by Sam Hocevar. See the COPYING file for more details.
 """
 
 import math
-import re
+import numpy
 import sys
+import time
+from metrics import METRICS, SIZE_BUCKETS
+from snippets import highlighter
+from tokenizer import Tokenizer, loadStopwords
+
+_TOP_N = 1000  # results per query looked at by EvaluateBenchmark
 
 
 class InvertedIndex:
@@ -41,37 +47,46 @@ class InvertedIndex:
         self.records = {}
         self.avdl = 0
         recordId = 0
-        self.stopwords = []
+        self.stopwords = frozenset()
+        self.tokenizer = Tokenizer()
 
         """ Pass 1: calculate tf, dl and avdl. """
+        passStart = time.perf_counter()
+        tokenizeSeconds = 0.0
         for line in fileObj:
             if recordId not in self.records:
                 self.records[recordId] = {}
             self.records[recordId]['line'] = line
             self.records[recordId]['dl'] = 0
-            for word in re.split('\W+', line):
-                if len(word) > 0:
-                    word = word.lower()
-                    self.records[recordId]['dl'] += 1
-                    self.avdl += 1
-
-                    """ First occurence of word in file, create inv. list. """
-                    if word not in self.invertedLists:
-                        self.invertedLists[word] = []
-
-                    """ First occurence of word in record, add tuple w/ 0. """
-                    if len(self.invertedLists[word]) == 0 or\
-                       self.invertedLists[word][-1][0] != recordId:
-                        self.invertedLists[word].append((recordId, 0))
-                    """ Increase tf by 1 from 0 or previous value. """
-                    currTf = self.invertedLists[word][-1][1]
-                    self.invertedLists[word][-1] = (recordId, currTf + 1)
+            start = time.perf_counter()
+            words = self.tokenizer.tokenize(line)
+            tokenizeSeconds += time.perf_counter() - start
+            for word in words:
+                self.records[recordId]['dl'] += 1
+                self.avdl += 1
+
+                """ First occurence of word in file, create inv. list. """
+                if word not in self.invertedLists:
+                    self.invertedLists[word] = []
+
+                """ First occurence of word in record, add tuple w/ 0. """
+                if len(self.invertedLists[word]) == 0 or\
+                   self.invertedLists[word][-1][0] != recordId:
+                    self.invertedLists[word].append((recordId, 0))
+                """ Increase tf by 1 from 0 or previous value. """
+                currTf = self.invertedLists[word][-1][1]
+                self.invertedLists[word][-1] = (recordId, currTf + 1)
 
             recordId += 1
 
         self.numDocs = recordId  # started at 0, increased at loop end
+        METRICS.count('documents_indexed', self.numDocs)
+        METRICS.count('tokens_indexed', self.avdl)
+        METRICS.observe('tokenize_seconds', tokenizeSeconds)
+        METRICS.observe('pass1_seconds', time.perf_counter() - passStart)
         self.avdl = self.avdl / self.numDocs
 
+        passStart = time.perf_counter()
         """ Pass 2: calculate tf* idf. """
         tmpInvLists = {}
         for word, invList in self.invertedLists.items():
@@ -90,6 +105,7 @@ class InvertedIndex:
 
         self.invListSimpleTf = self.invertedLists  # save for doctest
         self.invertedLists = tmpInvLists
+        METRICS.observe('pass2_seconds', time.perf_counter() - passStart)
 
     def merge(self, l1, l2):
         """ Merge two lists of recId bm25score touples by adding values.
@@ -147,6 +163,7 @@ class InvertedIndex:
 
         return result
 
+    @METRICS.timed('process_query')
     def processQuery(self, q):
         r""" Given a list of keywords, find the 3 best maches accoding to
         BM25.
@@ -164,6 +181,10 @@ class InvertedIndex:
         keywords = [w.lower() for w in keywords]
         keywords = [w for w in keywords if w not in self.stopwords]
 
+        METRICS.observe('query_postings', sum(
+            len(self.invertedLists.get(w, ())) for w in keywords),
+            SIZE_BUCKETS)
+
         """ Special cases. """
         if len(keywords) == 0:
             return []
@@ -171,6 +192,7 @@ class InvertedIndex:
             if keywords[0] not in self.invertedLists:
                 return []
             rawList = self.invertedLists[keywords[0]]
+            METRICS.observe('query_candidates', len(rawList), SIZE_BUCKETS)
             sortdList = sorted(rawList, key=lambda x: -x[1])
             return sortdList
 
@@ -180,18 +202,86 @@ class InvertedIndex:
             if keywords[i] in self.invertedLists:
                 list2 = self.invertedLists[keywords[i]]
                 list1 = self.merge(list1, list2)
+        METRICS.observe('query_candidates', len(list1), SIZE_BUCKETS)
 
         sortdList = sorted(list1, key=lambda x: -x[1])
         return sortdList
 
     def setStopwords(self, lisd):
-        self.stopwords = lisd
+        self.stopwords = frozenset(lisd)
 
 
 class EvaluateBenchmark:
-    """ Class with functions for computing MP@3, MP@R and MAP. """
+    """ Class with functions for computing MP@3, MP@R and MAP (and nDCG@k,
+    recall@k). All metrics are computed for a batch of queries at once from
+    a boolean relevance mask of their top-N results. """
+
+    def __init__(self, topN=_TOP_N):
+        """ Create an evaluator that looks at the topN results per query. """
+
+        self.topN = topN
+
+    def relevanceMask(self, resultIds, relevantIds, n):
+        """ Given a list of result ID lists (one per query, best first) and a
+        list of relevant ID lists, return a #queries x n boolean matrix whose
+        entry (q, i) tells whether the result at rank i + 1 of query q is
+        relevant. Shorter result lists are padded with False.
+
+        >>> eb = EvaluateBenchmark()
+        >>> eb.relevanceMask([[3, 1, 2], [5]], [[1, 2], [7]], 4).astype(int)
+        array([[0, 1, 1, 0],
+               [0, 0, 0, 0]])
+        """
 
-    def precisionAtK(self, resultsIds, relevantIds, k):
+        mask = numpy.zeros((len(resultIds), n), dtype=bool)
+        for q, (res, rel) in enumerate(zip(resultIds, relevantIds)):
+            res = numpy.asarray(res[0:n], dtype=numpy.int64)
+            mask[q, 0:len(res)] = numpy.isin(res, rel)
+        return mask
+
+    def metrics(self, mask, numRelevant, ks=(3,)):
+        """ Given a relevance mask (see relevanceMask) and the number of
+        relevant documents per query, return a dict of per query arrays for
+        P@k, R@k (recall) and nDCG@k (binary gains) for each k in ks, P@R and
+        AP.
+
+        >>> eb = EvaluateBenchmark()
+        >>> mask = eb.relevanceMask([[0, 1, 2, 5, 6], [9, 4]],
+        ...                         [[0, 2, 5, 6, 7, 8], [4]], 6)
+        >>> m = eb.metrics(mask, [6, 1], ks=[3])
+        >>> for name in sorted(m):
+        ...     print(name, [float('%.3f' % v) for v in m[name]])
+        AP [0.536, 0.5]
+        P@3 [0.667, 0.333]
+        P@R [0.667, 0.0]
+        R@3 [0.333, 1.0]
+        nDCG@3 [0.704, 0.631]
+        """
+
+        mask = numpy.asarray(mask, dtype=bool)
+        numRelevant = numpy.asarray(numRelevant, dtype=numpy.int64)
+        numQueries, n = mask.shape
+        hits = numpy.cumsum(mask, axis=1)  # relevant results up to rank i+1
+        safeR = numpy.maximum(numRelevant, 1)
+        result = {}
+        for k in ks:
+            hitsAtK = hits[:, min(k, n) - 1]
+            result['P@{0}'.format(k)] = hitsAtK / k
+            result['R@{0}'.format(k)] = hitsAtK / safeR
+            discounts = 1 / numpy.log2(numpy.arange(2, k + 2))
+            dcg = mask[:, 0:k].dot(discounts[0:min(k, n)])
+            # ideal DCG: all min(R, k) relevant documents ranked first
+            idealDcgs = numpy.concatenate(([1], numpy.cumsum(discounts)))
+            idcg = idealDcgs[numpy.minimum(numRelevant, k)]
+            result['nDCG@{0}'.format(k)] = dcg / idcg
+        rows = numpy.arange(numQueries)
+        hitsAtR = hits[rows, numpy.clip(numRelevant, 1, n) - 1]
+        result['P@R'] = numpy.where(numRelevant > 0, hitsAtR / safeR, 0)
+        precisions = hits / numpy.arange(1, n + 1)
+        result['AP'] = (precisions * mask).sum(axis=1) / safeR
+        return result
+
+    def precisionAtK(self, resultIds, relevantIds, k):
         """ Given lists of calculated, actually relevant record IDs and k,
         calculate P@k.
 
@@ -200,14 +290,11 @@ class EvaluateBenchmark:
         0.75
         """
 
-        res = resultsIds[0:k]
-        hit = 0
-        for r in relevantIds:
-            if r in res:
-                hit += 1
-        return hit/k
+        mask = self.relevanceMask([resultIds], [relevantIds], k)
+        return float(self.metrics(mask, [len(relevantIds)],
+                                  [k])['P@{0}'.format(k)][0])
 
-    def precisionAtR(self, resultsIds, relevantIds):
+    def precisionAtR(self, resultIds, relevantIds):
         """ Given lists of calculated and actually relevant record IDs,
         calculate P@R.
 
@@ -216,9 +303,9 @@ class EvaluateBenchmark:
         0.5
         """
 
-        return self.precisionAtK(resultsIds, relevantIds, len(relevantIds))
+        return self.precisionAtK(resultIds, relevantIds, len(relevantIds))
 
-    def avgPrecision(self, resultsIds, relevantIds):
+    def avgPrecision(self, resultIds, relevantIds):
         """ Given lists of calculated and actually relevant record IDs,
         calculate AP.
 
@@ -227,15 +314,45 @@ class EvaluateBenchmark:
         0.525
         """
 
-        pSum = 0
-        for relId in relevantIds:
-            if relId not in resultsIds:
-                continue
-            else:
-                k = resultsIds.index(relId) + 1
-                pSum += self.precisionAtK(resultsIds, relevantIds, k)
+        mask = self.relevanceMask([resultIds], [relevantIds],
+                                  max(len(resultIds), 1))
+        return float(self.metrics(mask, [len(relevantIds)], [])['AP'][0])
+
+    def evaluateQueries(self, bmFileName, processQuery, ks=(3,)):
+        """ Run all queries of the given benchmark file through the given
+        query function (returning (record ID, score) pairs, best first). Return
+        the list of queries and a dict of per query metric arrays (see
+        metrics), computed on the top self.topN results of each query.
+        """
+
+        queries = []
+        resultIds = []
+        relevantIds = []
+        with open(bmFileName) as f:
+            for line in f:
+                query, idLine = line.strip().split('\t')
+                """ movies-benchmark.txt assumes movie IDs starting at 1
+                whereas I work with IDs starting at 0, therefore I decrement
+                all relevant IDs by 1. """
+                relIds = numpy.array(idLine.split(' '), dtype=numpy.int64) - 1
+                result = processQuery(query)[0:self.topN]
+                queries.append(query)
+                resultIds.append([r[0] for r in result])
+                relevantIds.append(relIds)
+        numRelevant = [len(relIds) for relIds in relevantIds]
+        n = max([self.topN] + numRelevant + list(ks))
+        mask = self.relevanceMask(resultIds, relevantIds, n)
+        return queries, self.metrics(mask, numRelevant, ks)
+
+    def evaluate(self, bmFileName, processQuery):
+        """ Run all queries of the given benchmark file through the given
+        query function and return MP@3, MP@R and MAP.
+        """
+
+        queries, metrics = self.evaluateQueries(bmFileName, processQuery)
+        return (float(metrics['P@3'].mean()), float(metrics['P@R'].mean()),
+                float(metrics['AP'].mean()))
 
-        return pSum/len(relevantIds)
 
 if __name__ == '__main__':
     """ Answer user queries for a file given as command line parameter. """
@@ -250,54 +367,29 @@ if __name__ == '__main__':
         ii = InvertedIndex(f, 1.2, 0.5)
     print('done')
 
-    stopwords = []
-    with open('stopwords_en.txt') as f:
-        for line in f:
-            stopwords.append(line.strip())
-    ii.setStopwords(stopwords)
+    ii.setStopwords(loadStopwords())
 
     mode = input('\n[i]nteractive or [b]enchmark?\n> ')
     if mode == 'i':
         while True:
             queryLine = input('\nEnter a query (space separated keywords)\n> ')
             matches = ii.processQuery(queryLine)
+            hl = highlighter(queryLine)
             for recId, score in matches[0:3]:
-                text = ii.records[recId]['line'].strip()
-                for keyword in queryLine.split(' '):
-                    patt = r'\b(' + keyword + r')\b'
-                    text = re.sub(patt, '[32m\g<0>[0m', text, flags=re.I)
+                text = hl.snippet(ii.records[recId]['line'].strip())
                 print('[1m[{0:.4f}][0m: {1}'.format(score, text))
     elif mode == 'b':
         eb = EvaluateBenchmark()
-        with open('movies-benchmark.txt') as f:
-            mpAt3 = 0
-            mpAtR = 0
-            mAp = 0
-            count = 0
-            for line in f:
-                query, idLine = line.strip().split('\t')
-                relIds = idLine.split(' ')
-                """ movies-benchmark.txt assumes movie IDs starting at 1
-                whereas I work with IDs starting at 0, therefore I decrement
-                all relevant IDs by 1. """
-                relIds = [int(x)-1 for x in relIds]
-                result = ii.processQuery(query)
-                resIds = [r[0] for r in result]
-                pAt3 = eb.precisionAtK(resIds, relIds, 3)
-                pAtR = eb.precisionAtR(resIds, relIds)
-                ap = eb.avgPrecision(resIds, relIds)
-                print('\nQuery: {0}'.format(query))
-                print('P@3 {0:.2f} | P@R {1:.2f} | AP: {2:.2f}'.format(
-                    pAt3, pAtR, ap))
-                mpAt3 += pAt3
-                mpAtR += pAtR
-                mAp += ap
-                count += 1
-            mpAt3 = mpAt3 / count
-            mpAtR = mpAtR / count
-            mAp = mAp / count
-            print('\nAverage:')
-            print('MP@3 {0:.2f} | MP@R {1:.2f} | MAP: {2:.2f}'.format(
-                mpAt3, mpAtR, mAp))
+        processQuery = ii.processQuery
+        queries, metrics = eb.evaluateQueries('movies-benchmark.txt',
+                                              processQuery)
+        for i, query in enumerate(queries):
+            print('\nQuery: {0}'.format(query))
+            print('P@3 {0:.2f} | P@R {1:.2f} | AP: {2:.2f}'.format(
+                metrics['P@3'][i], metrics['P@R'][i], metrics['AP'][i]))
+        print('\nAverage:')
+        print('MP@3 {0:.2f} | MP@R {1:.2f} | MAP: {2:.2f}'.format(
+            metrics['P@3'].mean(), metrics['P@R'].mean(),
+            metrics['AP'].mean()))
     else:
         sys.exit()
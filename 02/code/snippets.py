@@ -0,0 +1 @@
+../../shared/snippets.py
\ No newline at end of file
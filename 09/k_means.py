@@ -6,13 +6,16 @@ it under the terms of the WTFPL, Version 2, as published
 by Sam Hocevar. See the COPYING file for more details.
 """
 
-import math
 import numpy
 import random
-import re
 import scipy.sparse
 import sys
 import time
+from metrics import METRICS, SIZE_BUCKETS, formatMemoryReport, \
+    memoryBreakdown
+from tokenizer import Tokenizer, Vocabulary
+
+_MODEL_VERSION = 1
 
 
 class KMeans:
@@ -27,12 +30,12 @@ class KMeans:
         >>> txt ='first docum.\nsecond second docum.\nthird third third docum.'
         >>> f = io.StringIO(txt)
         >>> km = KMeans(f, 1.75, 0.75)
-        >>> pprint.pprint(sorted(km.invListSimpleTf.items()))
+        >>> pprint.pprint(sorted(km.termLists(km.invListSimpleTf).items()))
         [('docum', [(0, 1), (1, 1), (2, 1)]),
          ('first', [(0, 1)]),
          ('second', [(1, 2)]),
          ('third', [(2, 3)])]
-        >>> pprint.pprint(sorted(km.invertedLists.items()))
+        >>> pprint.pprint(sorted(km.termLists().items()))
         [('docum', [(0, 0.0), (1, 0.0), (2, 0.0)]),
          ('first', [(0, 1.8848)]),
          ('second', [(1, 2.3246)]),
@@ -41,64 +44,98 @@ class KMeans:
 
         self.k = bm25k
         self.b = bm25b
-        self.invertedLists = {}
+        self.invertedLists = []  # term ID (= matrix row) -> inverted list
         self.records = {}
         self.avdl = 0
-        self.idfs = {}
-        self.words = {}
+        self.idfs = None  # term ID -> idf
+        self.tokenizer = Tokenizer()
+        self.vocab = self.tokenizer.vocab
         recordId = 0
 
         self.tdMatrix = None
 
         """ Pass 1: calculate tf, dl and avdl. """
+        passStart = time.perf_counter()
+        tokenizeSeconds = 0.0
         for line in fileObj:
             if recordId not in self.records:
                 self.records[recordId] = {}
             self.records[recordId]['line'] = line
             self.records[recordId]['dl'] = 0
-            for word in re.split('\W+', line):
-                if len(word) > 0:
-                    word = word.lower()
-                    self.records[recordId]['dl'] += 1
-                    self.avdl += 1
-
-                    """ First occurence of word in file, create inv. list. """
-                    if word not in self.invertedLists:
-                        self.invertedLists[word] = []
-
-                    """ First occurence of word in record, add tuple w/ 0. """
-                    if len(self.invertedLists[word]) == 0 or\
-                       self.invertedLists[word][-1][0] != recordId:
-                        self.invertedLists[word].append((recordId, 0))
-                    """ Increase tf by 1 from 0 or previous value. """
-                    currTf = self.invertedLists[word][-1][1]
-                    self.invertedLists[word][-1] = (recordId, currTf + 1)
+            start = time.perf_counter()
+            words = self.tokenizer.tokenize(line)
+            tokenizeSeconds += time.perf_counter() - start
+            for word in words:
+                self.records[recordId]['dl'] += 1
+                self.avdl += 1
+                termId = self.vocab.add(word)
+
+                """ First occurence of word in file, create inv. list. """
+                if termId == len(self.invertedLists):
+                    self.invertedLists.append([])
+                invList = self.invertedLists[termId]
+
+                """ First occurence of word in record, add tuple w/ 0. """
+                if len(invList) == 0 or invList[-1][0] != recordId:
+                    invList.append((recordId, 0))
+                    self.vocab.dfs[termId] += 1
+                """ Increase tf by 1 from 0 or previous value. """
+                currTf = invList[-1][1]
+                invList[-1] = (recordId, currTf + 1)
 
             recordId += 1
 
         self.numDocs = recordId  # started at 0, increased at loop end
+        METRICS.count('documents_indexed', self.numDocs)
+        METRICS.count('tokens_indexed', self.avdl)
+        METRICS.observe('tokenize_seconds', tokenizeSeconds)
+        METRICS.observe('pass1_seconds', time.perf_counter() - passStart)
         self.avdl = self.avdl / self.numDocs
 
+        passStart = time.perf_counter()
         """ Pass 2: calculate tf*idf and bm25. """
-        tmpInvLists = {}
-        for word, invList in self.invertedLists.items():
-            df = len(invList)
-            tmpInvLists[word] = []
+        self.idfs = self.vocab.idfs(self.numDocs)
+        tmpInvLists = []
+        for termId, invList in enumerate(self.invertedLists):
+            idf = self.idfs[termId]
+            tmpInvList = []
             for recId, tf in invList:
                 dl = self.records[recId]['dl']
                 numer = tf * (self.k+1)
                 denom = self.k * (1-self.b + ((self.b*dl) / self.avdl)) + tf
                 bm25tf = numer / denom
-                idf = math.log2(self.numDocs / df)
-                self.idfs[word] = idf
                 bm25score = bm25tf * idf
                 """ Precision to 4 decimals as in TIP file. """
                 bm25score = float('{0:.4f}'.format(bm25score))
-                tmpInvLists[word].append((recId, bm25score))
+                tmpInvList.append((recId, bm25score))
+            tmpInvLists.append(tmpInvList)
 
         self.invListSimpleTf = self.invertedLists  # save for doctest
         self.invertedLists = tmpInvLists
-
+        METRICS.observe('pass2_seconds', time.perf_counter() - passStart)
+
+    def termLists(self, lists=None):
+        """ Return the given inverted lists (default: self.invertedLists) as
+        a dict keyed by term instead of term ID. """
+
+        if lists is None:
+            lists = self.invertedLists
+        return {self.vocab.term(termId): invList
+                for termId, invList in enumerate(lists)}
+
+    def setTermLists(self, termLists):
+        """ Replace the vocabulary and inverted lists by the given dict of
+        term -> inverted list. """
+
+        self.tokenizer = Tokenizer()
+        self.vocab = self.tokenizer.vocab
+        self.invertedLists = []
+        for term, invList in termLists.items():
+            self.vocab.add(term)
+            self.vocab.dfs[-1] = len(invList)
+            self.invertedLists.append(invList)
+
+    @METRICS.timed('preprocess_vsm')
     def preprocessVsm(self, l2normalize=True):
         """ Compute sparse term-document matrix using inverted index created in
         the class's constructor.
@@ -108,7 +145,7 @@ class KMeans:
         >>> l1 = [(0, 0.2), (2, 0.6)] # ids decremented because my sheet 2 code
         >>>                           # counts record ids beginning at 0.
         >>> l2 = [(1, 0.4), (2, 0.1), (3, 0.8)]
-        >>> km.invertedLists = {"bla": l1, "blubb": l2}
+        >>> km.setTermLists({"bla": l1, "blubb": l2})
         >>> km.preprocessVsm(l2normalize=False)
         >>> r = km.tdMatrix.todense().tolist()
         >>> print(sorted(r))
@@ -116,7 +153,7 @@ class KMeans:
         >>> km = KMeans(io.StringIO('foo'), 1.75, 0.75)
         >>> l1 = [(0, 0.2), (1, 0.2), (2, 0.6)]
         >>> l2 = [(1, 0.4), (2, 0.1), (3, 0.8)]
-        >>> km.invertedLists = {"blibb": l1, "blabb": l2}
+        >>> km.setTermLists({"blibb": l1, "blabb": l2})
         >>> km.preprocessVsm(l2normalize=True)
         >>> r = km.tdMatrix.todense().tolist()
         >>> r[0] = [float('%.3f' % v) for v in r[0]]
@@ -128,14 +165,12 @@ class KMeans:
         nzVals = []
         rowInds = []
         colInds = []
-        row = 0
-        for word, invList in self.invertedLists.items():
+        # matrix row = term ID
+        for row, invList in enumerate(self.invertedLists):
             for recId, bm25score in invList:
                 nzVals.append(bm25score)
                 rowInds.append(row)
                 colInds.append(recId)
-            self.words[row] = word
-            row += 1
         A = scipy.sparse.csr_matrix((nzVals, (rowInds, colInds)))
 
         if l2normalize:
@@ -171,17 +206,21 @@ class KMeans:
         prevRSS = sys.maxsize
         iterations = 0
         while True:
+            start = time.perf_counter()
             distances = self.computeDistances(self.tdMatrix, prevCentroids)
             assignment = self.computeAssignment(distances)
             centroids = self.computeCentroids(self.tdMatrix, assignment)
             RSS = self.calcRSS(distances)
             iterations += 1
+            METRICS.observe('kmeans_iteration_seconds',
+                            time.perf_counter() - start)
             if (prevRSS - RSS < 10):
                 break
             if (centroids - prevCentroids).nnz == 0:
                 break
             prevCentroids = centroids
             prevRSS = RSS
+        METRICS.observe('kmeans_iterations', iterations, SIZE_BUCKETS)
         print('Clustering iterations: {0}'.format(iterations))
         print('Final RSS: {0}'.format(int(RSS)))
 
@@ -286,12 +325,172 @@ class KMeans:
         res = scipy.sparse.csr_matrix(docs * assignment.transpose())
         return self.l2normalizeCols(res)
 
+    def memoryReport(self, centroids=None):
+        r""" Return the deep memory usage of the index by structure (see
+        metrics.memoryBreakdown), with the term-document matrix split into
+        its CSR arrays, and of the given centroids.
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> km = KMeans(io.StringIO(txt), 1.75, 0.75)
+        >>> km.preprocessVsm()
+        >>> report = km.memoryReport(km.initializeCentroids(2))
+        >>> sorted(report['parts']) # doctest: +NORMALIZE_WHITESPACE
+        ['centroids', 'idfs', 'invListSimpleTf', 'invertedLists', 'other',
+         'records', 'tdMatrix.data', 'tdMatrix.indices', 'tdMatrix.indptr',
+         'vocab']
+        >>> report['numDocs'], report['numPostings']
+        (6, 15)
+        """
+
+        parts = [('records', self.records, 'docs'),
+                 ('invertedLists', self.invertedLists, 'docs')]
+        if hasattr(self, 'invListSimpleTf'):
+            parts.append(('invListSimpleTf', self.invListSimpleTf, 'docs'))
+        parts += [('vocab', self.vocab, 'vocab'),
+                  ('idfs', self.idfs, 'vocab')]
+        if self.tdMatrix is not None:
+            # rows are the terms
+            parts += [('tdMatrix.data', self.tdMatrix.data, 'docs'),
+                      ('tdMatrix.indices', self.tdMatrix.indices, 'docs'),
+                      ('tdMatrix.indptr', self.tdMatrix.indptr, 'vocab')]
+        if centroids is not None:
+            parts.append(('centroids', centroids, 'vocab'))
+        numPostings = sum(len(invList) for invList in self.invertedLists)
+        return memoryBreakdown(self, parts, self.numDocs, numPostings)
+
+    def saveModel(self, fileName, centroids):
+        """ Save the given centroids together with the term vocabulary, the
+        idfs and the BM25 parameters, so that new documents can be assigned to
+        clusters (see ClusterAssigner) without clustering again.
+
+        Centroids are stored as a sparse matrix in float32, terms as one
+        newline separated UTF-8 blob in the order of the matrix rows.
+        """
+
+        centroids = scipy.sparse.csr_matrix(centroids, dtype=numpy.float32)
+        numRows = centroids.get_shape()[0]
+        terms = '\n'.join(self.vocab.terms(range(numRows)))
+        idfs = self.idfs[0:numRows]
+        numpy.savez_compressed(
+            fileName,
+            version=numpy.int32(_MODEL_VERSION),
+            terms=numpy.frombuffer(terms.encode('utf-8'), dtype=numpy.uint8),
+            idfs=numpy.array(idfs, dtype=numpy.float32),
+            data=centroids.data,
+            indices=centroids.indices,
+            indptr=centroids.indptr,
+            shape=numpy.array(centroids.get_shape(), dtype=numpy.int64),
+            bm25=numpy.array([self.k, self.b, self.avdl]))
+
+
+class ClusterAssigner:
+    """ Class for assigning new documents to the clusters of a model saved
+    with KMeans.saveModel. """
+
+    def __init__(self, fileName):
+        r""" Load a model saved with KMeans.saveModel.
+
+        >>> import io
+        >>> import os
+        >>> import tempfile
+        >>> txt ='first docum.\nsecond second docum.\nthird third third docum.'
+        >>> km = KMeans(io.StringIO(txt), 1.75, 0.75)
+        >>> km.preprocessVsm()
+        >>> centroids = km.tdMatrix[:, [1, 2]]
+        >>> fileName = os.path.join(tempfile.mkdtemp(), 'model.npz')
+        >>> km.saveModel(fileName, centroids)
+        >>> ca = ClusterAssigner(fileName)
+        >>> sorted(ca.vocab.terms())
+        ['docum', 'first', 'second', 'third']
+        >>> ca.assign(['a second text', 'Third!', 'nothing known'])
+        array([ 0,  1, -1])
+        """
+
+        with numpy.load(fileName) as model:
+            if int(model['version']) != _MODEL_VERSION:
+                raise ValueError('Unsupported model version {0}'.format(
+                    int(model['version'])))
+            terms = model['terms'].tobytes().decode('utf-8').split('\n')
+            self.vocab = Vocabulary(terms)  # term ID = centroid row
+            self.idfs = model['idfs']
+            self.centroids = scipy.sparse.csr_matrix(
+                (model['data'], model['indices'], model['indptr']),
+                shape=tuple(model['shape']))
+            self.k, self.b, self.avdl = model['bm25'].tolist()
+        self.tokenizer = Tokenizer()
+
+    def vectorize(self, texts):
+        """ Compute the L2-normalized m x n term-document matrix for the given
+        n texts, using the vocabulary and BM25 parameters of the model. Texts
+        without any known term result in an all zero column.
+        """
+
+        rowInds = []
+        colInds = []
+        dls = []
+        for col, text in enumerate(texts):
+            dl = 0
+            for word in self.tokenizer.tokenize(text):
+                dl += 1
+                row = self.vocab.get(word)
+                if row is not None:
+                    rowInds.append(row)
+                    colInds.append(col)
+            dls.append(dl)
+
+        m = len(self.vocab)
+        n = len(dls)
+        # duplicate (row, col) pairs are summed up, which yields the tfs
+        tfs = scipy.sparse.coo_matrix(
+            (numpy.ones(len(rowInds)), (rowInds, colInds)), shape=(m, n))
+        tfs.sum_duplicates()
+        tf = tfs.data
+        dl = numpy.array(dls, dtype=numpy.float64)[tfs.col]
+        denom = self.k * (1 - self.b + ((self.b * dl) / self.avdl)) + tf
+        bm25 = (tf * (self.k + 1) / denom) * self.idfs[tfs.row]
+
+        A = scipy.sparse.csc_matrix((bm25, (tfs.row, tfs.col)), shape=(m, n))
+        norms = numpy.sqrt(numpy.asarray(A.multiply(A).sum(0))).ravel()
+        norms[norms == 0] = 1
+        return scipy.sparse.csr_matrix(A.multiply(1 / norms))
+
+    def assign(self, texts):
+        """ Assign each of the given texts to its closest centroid. Return an
+        array with one cluster index per text (-1 for texts without any known
+        term).
+        """
+
+        docs = self.vectorize(texts)
+        # closest centroid in terms of euclidean distance == highest dot
+        # product, because both centroids and documents are L2-normalized
+        prod = (self.centroids.transpose() * docs).toarray()
+        assignment = numpy.argmax(prod, axis=0)
+        assignment[docs.getnnz(axis=0) == 0] = -1
+        return assignment
+
 
 if __name__ == '__main__':
     """ Compute clusters and print output based on command line parameters. """
 
-    if len(sys.argv) != 3:
-        print('Usage: python3 k_means.py <filename> <k>')
+    if len(sys.argv) == 4 and sys.argv[1] == 'assign':
+        """ Assign each line of the given file to a cluster of a saved model.
+        """
+        ca = ClusterAssigner(sys.argv[2])
+        with open(sys.argv[3]) as f:
+            for clusterIdx in ca.assign(f):
+                print(clusterIdx + 1 if clusterIdx >= 0 else '-')
+        sys.exit()
+
+    memory = '--memory' in sys.argv  # print a memory report
+    if memory:
+        sys.argv.remove('--memory')
+
+    if len(sys.argv) not in [3, 4]:
+        print('Usage: python3 k_means.py <filename> <k> [<model-file>] '
+              '[--memory]\n'
+              '       python3 k_means.py assign <model-file> <filename>')
         sys.exit()
 
     fileName = sys.argv[1]
@@ -313,6 +512,8 @@ if __name__ == '__main__':
     end = time.time()
     timeClustering = int(end-start)
     print('Clustering time: {0}s'.format(timeClustering))
+    if memory:
+        print(formatMemoryReport(km.memoryReport(centroids)))
 
     for i in range(k):
         print('Cluster #{0}'.format(i+1))
@@ -320,10 +521,13 @@ if __name__ == '__main__':
         clusterVals = {}
         for j in range(len(clusterCol)):
             x = clusterCol[j][0]
-            idf = km.idfs[km.words[j]]
-            clusterVals[km.words[j]] = x * idf
+            clusterVals[km.vocab.term(j)] = x * km.idfs[j]
         s = [(k, clusterVals[k]) for k in sorted(clusterVals,
                                                  key=clusterVals.get,
                                                  reverse=True)]
         for word, val in s[0:10]:
             print('    - {0} ({1:.2f})'.format(word, val))
+
+    if len(sys.argv) == 4:
+        km.saveModel(sys.argv[3], centroids)
+        print('Model saved to {0}'.format(sys.argv[3]))
@@ -0,0 +1,89 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import argparse
+import random
+import sys
+import time
+from k_means import KMeans
+from metrics import METRICS
+from synthetic import addCorpusArguments, addScalingArguments, \
+    corpusParams, finishScaling, generateCorpus, phaseTimes, runScaling
+
+
+def runKMeans(numDocs, args):
+    """ Build the index and the term-document matrix of a synthetic corpus
+    of numDocs documents and cluster it into k clusters. Return a dict with
+    the times, the number of iterations and (with --memory) the memory
+    usage.
+
+    >>> args = parseArgs(['--vocab', '500', '--length', '20', '-k', '3',
+    ...                   '--memory'])
+    >>> run = runKMeans(300, args) # doctest: +ELLIPSIS
+    Clustering iterations: ...
+    >>> sorted(run) # doctest: +NORMALIZE_WHITESPACE
+    ['buildSeconds', 'bytesPerDoc', 'clusteringSeconds', 'indexMb',
+     'iterations', 'numPostings', 'numTerms', 'phases', 'vsmSeconds']
+    >>> run['iterations'] > 0, run['phases']['kmeans_iteration'] > 0
+    (True, True)
+    """
+
+    # the initial centroids are random documents
+    random.seed(args.seed)
+    run = {}
+    start = time.perf_counter()
+    km = KMeans(generateCorpus(numDocs, **corpusParams(args)), args.bm25k,
+                args.bm25b)
+    run['buildSeconds'] = round(time.perf_counter() - start, 3)
+    run['numTerms'] = len(km.vocab)
+    run['numPostings'] = sum(len(invList) for invList in km.invertedLists)
+
+    start = time.perf_counter()
+    km.preprocessVsm()
+    run['vsmSeconds'] = round(time.perf_counter() - start, 3)
+    start = time.perf_counter()
+    centroids = km.kMeans(args.k)
+    run['clusteringSeconds'] = round(time.perf_counter() - start, 3)
+    run['iterations'] = int(METRICS.histograms['kmeans_iterations'].sum)
+    run['phases'] = phaseTimes()
+
+    if args.memory:
+        report = km.memoryReport(centroids)
+        run['indexMb'] = round(report['total'] / 2 ** 20, 1)
+        run['bytesPerDoc'] = round(report['bytesPerDoc'], 1)
+    return run
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description='Scaling benchmark of k-means on synthetic Zipfian '
+                    'corpora: build time, peak RSS, matrix and clustering '
+                    'time per corpus size, written as JSON report.')
+    addCorpusArguments(parser)
+    addScalingArguments(parser)
+    parser.add_argument('-k', type=int, default=50, help='number of clusters')
+    parser.add_argument('--bm25k', type=float, default=1.2)
+    parser.add_argument('--bm25b', type=float, default=0.5)
+    parser.add_argument('--memory', action='store_true',
+                        help='add the memory report of the index (slow for '
+                             'large corpora)')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parseArgs(argv)
+    params = corpusParams(args)
+    params.update({'k': args.k, 'bm25k': args.bm25k, 'bm25b': args.bm25b})
+    sizes = [int(size) for size in args.sizes.split(',')]
+    report = runScaling('kmeans', lambda numDocs: runKMeans(numDocs, args),
+                        sizes, params, args.timeout)
+    finishScaling(report, args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
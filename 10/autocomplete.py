@@ -0,0 +1,178 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import bisect
+import numpy
+import sys
+import time
+from lsi import InvertedIndex
+
+_RANKINGS = ['df', 'bm25']
+
+
+def prefixEnd(prefix):
+    """ Return the smallest string that is larger than all strings starting
+    with the (non empty) prefix.
+
+    >>> prefixEnd('ab')
+    'ac'
+    """
+
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class Autocomplete:
+    """ Prefix completion over a sorted array of terms. The terms starting
+    with a prefix are a range of the array (found by binary search). For
+    prefixes with large ranges (the upper nodes of the implicit trie) the
+    best completions are precomputed, smaller ranges are ranked on the fly.
+    """
+
+    def __init__(self, terms, scores, k=10, maxRange=256):
+        r""" Create the completion index for the given terms and scores
+        (higher = better). Best lists of length k are precomputed for all
+        prefixes shared by more than maxRange terms.
+
+        >>> ac = Autocomplete(['surf', 'surfing', 'beach', 'sun', 'surfer'],
+        ...                   [2, 6, 3, 4, 1], k=2, maxRange=2)
+        >>> ac.terms
+        ['beach', 'sun', 'surf', 'surfer', 'surfing']
+        >>> sorted(ac.bestLists.items())
+        [('s', [4, 1]), ('su', [4, 1]), ('sur', [4, 2]), ('surf', [4, 2])]
+        """
+
+        order = sorted(range(len(terms)), key=lambda i: terms[i])
+        self.terms = [terms[i] for i in order]
+        self.scores = numpy.asarray(scores)[order]
+        self.k = k
+        self.maxRange = maxRange
+        self.bestLists = {}  # prefix -> indices of its best k terms
+        self.addBestLists('', 0, len(self.terms))
+
+    @staticmethod
+    def fromInvertedIndex(ii, ranking='df', k=10, maxRange=256):
+        """ Return the completion index for the vocabulary of ii, ranked by
+        df or by the sum of the BM25 scores of a term (see _RANKINGS). """
+
+        if ranking == 'df':
+            scores = ii.vocab.dfArray()
+        elif ranking == 'bm25':
+            scores = numpy.array([sum(score for recId, score in invList)
+                                  for invList in ii.invertedLists])
+        else:
+            raise ValueError('Unknown ranking {0}'.format(ranking))
+        return Autocomplete(ii.vocab.terms(), scores, k, maxRange)
+
+    def best(self, lo, hi, k):
+        """ Return the indices of the k best terms in [lo, hi), ties broken
+        alphabetically. """
+
+        order = numpy.argsort(-self.scores[lo:hi], kind='stable')[0:k]
+        return (order + lo).tolist()
+
+    def addBestLists(self, prefix, lo, hi):
+        """ Precompute the best lists of the prefix (the terms in [lo, hi)
+        start with it) and of its extensions with more than maxRange terms.
+        """
+
+        if prefix != '':
+            self.bestLists[prefix] = self.best(lo, hi, self.k)
+        depth = len(prefix)
+        pos = lo
+        if pos < hi and len(self.terms[pos]) == depth:
+            pos += 1  # the prefix itself is a term
+        while pos < hi:
+            child = self.terms[pos][0:depth + 1]
+            end = bisect.bisect_left(self.terms, prefixEnd(child), pos, hi)
+            if end - pos > self.maxRange:
+                self.addBestLists(child, pos, end)
+            pos = end
+
+    def complete(self, prefix, k=None):
+        r""" Return the k best (term, score) pairs of the terms starting with
+        the prefix (default k: the length of the precomputed lists).
+
+        >>> ac = Autocomplete(['surf', 'surfing', 'beach', 'sun', 'surfer'],
+        ...                   [2, 6, 3, 4, 1], k=2, maxRange=2)
+        >>> ac.complete('s')
+        [('surfing', 6), ('sun', 4)]
+        >>> ac.complete('Surf', 3)
+        [('surfing', 6), ('surf', 2), ('surfer', 1)]
+        >>> ac.complete('surfe'), ac.complete('x')
+        ([('surfer', 1)], [])
+        >>> ac.complete('s', -1)
+        Traceback (most recent call last):
+        ...
+        ValueError: k must be at least 1, got -1
+        """
+
+        if k is None:
+            k = self.k
+        if k < 1:
+            raise ValueError('k must be at least 1, got {0}'.format(k))
+        prefix = prefix.lower()
+        if k <= self.k and prefix in self.bestLists:
+            best = self.bestLists[prefix][0:k]
+        else:
+            lo = bisect.bisect_left(self.terms, prefix)
+            hi = bisect.bisect_left(self.terms, prefixEnd(prefix), lo) \
+                if prefix != '' else len(self.terms)
+            best = self.best(lo, hi, k)
+        return [(self.terms[i], self.scores[i].item()) for i in best]
+
+    def completeQuery(self, q, k=None):
+        """ Complete the last keyword of the query. Return the list of
+        completed queries.
+
+        >>> ac = Autocomplete(['surf', 'surfing', 'beach', 'sun', 'surfer'],
+        ...                   [2, 6, 3, 4, 1])
+        >>> ac.completeQuery('beach su', 2)
+        ['beach surfing', 'beach sun']
+        >>> ac.completeQuery('beach ')
+        []
+        """
+
+        keywords = q.split(' ')
+        if keywords[-1] == '':
+            return []
+        head = ' '.join(keywords[:-1] + [''])
+        return [head + term for term, score in self.complete(keywords[-1], k)]
+
+
+if __name__ == '__main__':
+    """ Build the completion index for the vocabulary of a records file,
+    report the completion latency for all prefixes of up to 4 characters
+    of the vocabulary, then complete prefixes read from stdin. """
+
+    if len(sys.argv) not in [2, 3]:
+        print('Usage: python3 autocomplete.py <recs> [df|bm25]')
+        sys.exit()
+
+    ranking = sys.argv[2] if len(sys.argv) == 3 else 'df'
+    print('Building inverted index ...')
+    with open(sys.argv[1]) as f:
+        ii = InvertedIndex(f, 1.75, 0.3)
+    start = time.time()
+    ac = Autocomplete.fromInvertedIndex(ii, ranking)
+    end = time.time()
+    print('done, completion index built in {0:.2f}s ({1} best lists)'.format(
+        end-start, len(ac.bestLists)))
+
+    prefixes = sorted(set(t[0:n] for t in ac.terms for n in range(1, 5)))
+    latencies = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        ac.complete(prefix)
+        latencies.append(time.perf_counter() - start)
+    latencies = numpy.array(latencies) * 1000
+    print('{0} prefixes: mean {1:.4f}ms | max {2:.4f}ms'.format(
+        len(prefixes), latencies.mean(), latencies.max()))
+
+    for line in sys.stdin:
+        for completion in ac.completeQuery(line.rstrip('\n')):
+            print(completion)
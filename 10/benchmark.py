@@ -0,0 +1,239 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import numpy
+import sys
+import time
+from lsi import EvaluateBenchmark, InvertedIndex
+from tokenizer import loadStopwords
+
+_RANKERS = ['bm25', 'vsm', 'lsi', 'lsicomb']
+_index = None  # index used by runQueries in worker processes
+
+
+def rankerFunction(ii, ranker, lam=0.67):
+    """ Return the query function of the InvertedIndex ii for the ranker with
+    the given name (see _RANKERS). lam is the weight of the VSM scores for
+    lsicomb. """
+
+    if ranker == 'bm25':
+        return ii.processQuery
+    if ranker == 'vsm':
+        return ii.processQueryVsm
+    if ranker == 'lsi':
+        return ii.processQueryLsi
+    if ranker == 'lsicomb':
+        def processQuery(q):
+            return ii.processQueryLsiComb(q, lam)
+        return processQuery
+    raise ValueError('Unknown ranker {0}'.format(ranker))
+
+
+def runQueries(args):
+    """ Worker of runBenchmark: run the given queries on the index inherited
+    from the parent process. Return a (top-N result IDs, latency in seconds)
+    pair per query. """
+
+    ranker, lam, queries, topN = args
+    processQuery = rankerFunction(_index, ranker, lam)
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        result = processQuery(query)[0:topN]
+        end = time.perf_counter()
+        results.append(([r[0] for r in result], end - start))
+    return results
+
+
+def runBenchmark(ii, ranker, queries, lam=0.67, topN=1000, workers=1):
+    r""" Run the queries with the given ranker on ii, spread over workers
+    processes that share the index (forked, copy-on-write). Return the list
+    of top-N result IDs per query, the array of query latencies and the wall
+    time (both in seconds).
+
+    >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+    >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+    >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+    >>> ii.preprocessVsm(4)
+    >>> queries = ['web', 'beach', 'internet surfing']
+    >>> resultIds, latencies, wallTime = runBenchmark(ii, 'vsm', queries,
+    ...                                               topN=2, workers=2)
+    >>> resultIds
+    [[2, 0], [4, 5], [1, 0]]
+    >>> len(latencies), bool(wallTime >= latencies.max())
+    (3, True)
+    """
+
+    global _index
+    _index = ii
+    # a few chunks per worker, so that slow queries do not stall one worker
+    chunkSize = max(1, len(queries) // (workers * 4))
+    args = [(ranker, lam, queries[i:i + chunkSize], topN)
+            for i in range(0, len(queries), chunkSize)]
+    if workers == 1:
+        start = time.perf_counter()
+        shards = [runQueries(a) for a in args]
+        end = time.perf_counter()
+    else:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(workers) as pool:
+            start = time.perf_counter()
+            shards = pool.map(runQueries, args)
+            end = time.perf_counter()
+    _index = None
+
+    results = [r for shard in shards for r in shard]
+    resultIds = [ids for ids, latency in results]
+    latencies = numpy.array([latency for ids, latency in results])
+    return resultIds, latencies, end - start
+
+
+def latencyStats(latencies, wallTime):
+    """ Return a dict with latency percentiles and mean (in ms), the wall
+    time and the throughput of a benchmark run.
+
+    >>> stats = latencyStats(numpy.arange(1, 101) / 1000, 2.0)
+    >>> [stats[key] for key in ['p50Ms', 'p95Ms', 'p99Ms', 'meanMs', 'qps']]
+    [50.5, 95.05, 99.01, 50.5, 50.0]
+    """
+
+    p50, p95, p99 = numpy.percentile(latencies * 1000, [50, 95, 99])
+    return {'p50Ms': round(float(p50), 3), 'p95Ms': round(float(p95), 3),
+            'p99Ms': round(float(p99), 3),
+            'meanMs': round(float(latencies.mean() * 1000), 3),
+            'wallTime': round(wallTime, 3),
+            'qps': round(len(latencies) / wallTime, 3)}
+
+
+def compareReports(baseline, report, tolerance):
+    """ Compare a report with a baseline report (both as written by this
+    script). Return a list of regressions: quality values that dropped or
+    latencies that grew by more than the given fraction.
+
+    >>> old = {'quality': {'MAP': 0.5}, 'latency': {'p95Ms': 10.0}}
+    >>> new = {'quality': {'MAP': 0.4}, 'latency': {'p95Ms': 10.5}}
+    >>> compareReports(old, new, 0.1)
+    ['MAP: 0.5 -> 0.4']
+    >>> new['latency']['p95Ms'] = 12.0
+    >>> compareReports(old, new, 0.1)
+    ['MAP: 0.5 -> 0.4', 'p95Ms: 10.0 -> 12.0']
+    """
+
+    regressions = []
+    for key, old in baseline['quality'].items():
+        new = report['quality'].get(key)
+        if new is not None and new < old * (1 - tolerance):
+            regressions.append('{0}: {1} -> {2}'.format(key, old, new))
+    for key in ['p50Ms', 'p95Ms', 'p99Ms']:
+        old = baseline['latency'].get(key)
+        new = report['latency'].get(key)
+        if old is not None and new is not None and \
+           new > old * (1 + tolerance):
+            regressions.append('{0}: {1} -> {2}'.format(key, old, new))
+    return regressions
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description='Run a benchmark file against one ranker and report '
+                    'quality and latency.')
+    parser.add_argument('benchmark', help='benchmark file (query<TAB>ids)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--recs', help='records file to build the index of')
+    source.add_argument('--model', help='LSI model dir (see lsi.py [w])')
+    parser.add_argument('--ranker', choices=_RANKERS, default='bm25')
+    parser.add_argument('--lambda', dest='lam', type=float, default=0.67,
+                        help='weight of VSM scores for lsicomb')
+    parser.add_argument('-k', type=int, default=50, help='LSI dimensions')
+    parser.add_argument('-m', type=int, default=10000,
+                        help='terms in the term-document matrix')
+    parser.add_argument('--bm25k', type=float, default=1.75)
+    parser.add_argument('--bm25b', type=float, default=0.3)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--top-n', dest='topN', type=int, default=1000)
+    parser.add_argument('--json', help='write the report to this file '
+                                       '(- for stdout)')
+    parser.add_argument('--baseline', help='report to compare with, exit '
+                                           'with status 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+    if args.model is not None and args.ranker != 'lsi':
+        parser.error('--model only supports --ranker lsi')
+    return args
+
+
+def main(argv):
+    args = parseArgs(argv)
+
+    start = time.time()
+    if args.model is not None:
+        ii = InvertedIndex(io.StringIO(''), args.bm25k, args.bm25b)
+        ii.loadLsi(args.model)
+    else:
+        with open(args.recs) as f:
+            ii = InvertedIndex(f, args.bm25k, args.bm25b)
+        if args.ranker != 'bm25':
+            ii.preprocessVsm(args.m)
+        if args.ranker in ['lsi', 'lsicomb']:
+            ii.preprocessLsi(args.k)
+    ii.setStopwords(loadStopwords())
+    buildTime = time.time() - start
+
+    eb = EvaluateBenchmark(args.topN)
+    queries, relevantIds = eb.readBenchmark(args.benchmark)
+    resultIds, latencies, wallTime = runBenchmark(
+        ii, args.ranker, queries, args.lam, args.topN, args.workers)
+    metrics = eb.evaluateResults(resultIds, relevantIds, ks=(3, 10))
+
+    names = [('MP@3', 'P@3'), ('MP@R', 'P@R'), ('MAP', 'AP'),
+             ('nDCG@10', 'nDCG@10'), ('R@10', 'R@10')]
+    report = {
+        'ranker': args.ranker,
+        'lambda': args.lam if args.ranker == 'lsicomb' else None,
+        'params': {'k': args.k, 'm': args.m, 'bm25k': args.bm25k,
+                   'bm25b': args.bm25b, 'topN': args.topN},
+        'workers': args.workers,
+        'numQueries': len(queries),
+        'buildTime': round(buildTime, 3),
+        'quality': {name: round(float(metrics[key].mean()), 4)
+                    for name, key in names},
+        'latency': latencyStats(latencies, wallTime)}
+
+    quality = report['quality']
+    latency = report['latency']
+    print('{0} ({1} queries, {2} workers)'.format(
+        args.ranker, len(queries), args.workers))
+    print('MP@3 {0:.2f} | MP@R {1:.2f} | MAP: {2:.2f} | nDCG@10 {3:.2f} | '
+          'R@10 {4:.2f}'.format(*[quality[name] for name, key in names]))
+    print('p50 {0:.2f}ms | p95 {1:.2f}ms | p99 {2:.2f}ms | {3:.1f} QPS'.format(
+        latency['p50Ms'], latency['p95Ms'], latency['p99Ms'],
+        latency['qps']))
+
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compareReports(baseline, report, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {0}'.format(regression))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,115 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import argparse
+import asyncio
+import json
+import numpy
+import sys
+import time
+import urllib.parse
+from search_server import readResponse
+
+
+async def client(host, port, queries, k, counter, numRequests, latencies,
+                 errors):
+    """ Send requests over one keep-alive connection until numRequests were
+    sent in total (counted by counter[0] over all clients). """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while counter[0] < numRequests:
+            query = queries[counter[0] % len(queries)]
+            counter[0] += 1
+            path = '/search?' + urllib.parse.urlencode({'q': query, 'k': k})
+            start = time.perf_counter()
+            writer.write('GET {0} HTTP/1.1\r\nHost: {1}\r\n\r\n'.format(
+                path, host).encode())
+            status, body = await readResponse(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def loadTest(host, port, queries, numRequests, concurrency, k=10):
+    r""" Send numRequests search requests with the given queries (round
+    robin) over concurrency connections. Return a dict with throughput and
+    latency statistics.
+
+    >>> import io
+    >>> from lsi import InvertedIndex
+    >>> from search_server import SearchServer
+    >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+    >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+    >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+    >>> ii.preprocessVsm(4)
+    >>> async def demo():
+    ...     server = SearchServer(ii, 'vsm')
+    ...     await server.start('127.0.0.1', 0)
+    ...     stats = await loadTest('127.0.0.1', server.port, ['web', 'beach'],
+    ...                            50, 4)
+    ...     await server.close()
+    ...     return stats
+    >>> stats = asyncio.run(demo())
+    >>> stats['requests'], stats['errors'], stats['qps'] > 0
+    (50, 0, True)
+    """
+
+    counter = [0]
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(host, port, queries, k, counter, numRequests, latencies,
+               errors) for i in range(concurrency)])
+    wallTime = time.perf_counter() - start
+
+    latencies = numpy.array(latencies) * 1000
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+    return {'requests': len(latencies), 'errors': len(errors),
+            'concurrency': concurrency, 'wallTime': round(wallTime, 3),
+            'qps': round(len(latencies) / wallTime, 3),
+            'p50Ms': round(float(p50), 3), 'p95Ms': round(float(p95), 3),
+            'p99Ms': round(float(p99), 3)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Load test a search_server.py instance.')
+    parser.add_argument('queries', help='file with one query per line (only '
+                                        'the part before a TAB is used, so '
+                                        'benchmark files work too)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('-k', type=int, default=10, help='results per query')
+    parser.add_argument('--json', action='store_true',
+                        help='print the statistics as JSON')
+    args = parser.parse_args(argv)
+
+    with open(args.queries) as f:
+        queries = [line.split('\t')[0].strip() for line in f]
+    queries = [q for q in queries if len(q) > 0]
+
+    stats = asyncio.run(loadTest(args.host, args.port, queries,
+                                 args.requests, args.concurrency, args.k))
+    if args.json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print('{0} requests ({1} errors), concurrency {2}: {3:.1f} QPS | '
+              'p50 {4:.2f}ms | p95 {5:.2f}ms | p99 {6:.2f}ms'.format(
+                  stats['requests'], stats['errors'], stats['concurrency'],
+                  stats['qps'], stats['p50Ms'], stats['p95Ms'],
+                  stats['p99Ms']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
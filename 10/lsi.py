@@ -6,24 +6,104 @@ it under the terms of the WTFPL, Version 2, as published
 by Sam Hocevar. See the COPYING file for more details.
 """
 
+import io
+import json
 import math
 import numpy
-import re
+import os
 import scipy.sparse
 import scipy.sparse.linalg
 import sys
+import time
+from metrics import METRICS, SIZE_BUCKETS, formatMemoryReport, \
+    memoryBreakdown
+from tokenizer import Tokenizer, loadStopwords
 
 _TF = False
 _TFIDF = False
 _L2 = False
+_LSI_MODEL_VERSION = 1
+_TOP_N = 1000  # results per query looked at by EvaluateBenchmark
+
+
+def topK(scores, k):
+    """ Return the indices of the k highest scores, sorted by descending
+    score (ties broken by index).
+
+    >>> topK(numpy.array([0.1, 0.5, 0.3, 0.5, 0.0]), 3)
+    array([1, 3, 2])
+    """
+
+    k = min(k, len(scores))
+    if k == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    cand = numpy.argpartition(-scores, k - 1)[:k]
+    return cand[numpy.lexsort((cand, -scores[cand]))]
+
+
+def arpackSvd(A, k):
+    """ Compute the truncated SVD of A using ARPACK. Note that the singular
+    values are returned in ascending order.
+    """
+
+    return scipy.sparse.linalg.svds(A, k)
+
+
+def randomizedSvd(A, k, oversample=10, powerIters=2, seed=None):
+    """ Compute the truncated SVD of A using the randomized range finder of
+    Halko et al. in float32. A Gaussian sketch of k + oversample columns is
+    taken of the range of A, refined with powerIters power iterations and
+    the SVD is then computed for the projection of A onto that (small) range.
+    Singular values are returned in descending order.
+
+    >>> A = [[1.0, 1.0, 0.0, 1.0, 0.0, 0.0],
+    ...      [1.0, 0.0, 1.0, 1.0, 0.0, 0.0],
+    ...      [1.0, 1.0, 1.0, 2.0, 1.0, 1.0],
+    ...      [0.0, 0.0, 0.0, 1.0, 1.0, 1.0]]
+    >>> U, S, Vt = randomizedSvd(A, 2, seed=42)
+    >>> U.shape, S.shape, Vt.shape, U.dtype
+    ((4, 2), (2,), (2, 6), dtype('float32'))
+    >>> [float('%.3f' % s) for s in S]
+    [3.803, 1.546]
+    >>> S2 = scipy.sparse.linalg.svds(scipy.sparse.csr_matrix(A), 2)[1]
+    >>> [float('%.3f' % s) for s in sorted(S2, reverse=True)]
+    [3.803, 1.546]
+    """
+
+    A = scipy.sparse.csr_matrix(A, dtype=numpy.float32)
+    m, n = A.get_shape()
+    size = min(k + oversample, m, n)
+    rng = numpy.random.default_rng(seed)
+
+    # sample the range of A
+    Omega = rng.standard_normal((n, size), dtype=numpy.float32)
+    Q, _ = numpy.linalg.qr(A.dot(Omega))
+    # power iterations, re-orthonormalized in each step for stability
+    for i in range(powerIters):
+        Z, _ = numpy.linalg.qr(A.T.dot(Q))
+        Q, _ = numpy.linalg.qr(A.dot(Z))
+
+    # B = Q^T * A is only l x n
+    B = A.T.dot(Q).T
+    Ub, S, Vt = numpy.linalg.svd(B, full_matrices=False)
+    U = Q.dot(Ub)
+    return U[:, :k], S[:k], Vt[:k, :]
+
+
+_SVD_BACKENDS = {
+    'arpack': arpackSvd,
+    'randomized': randomizedSvd
+}
 
 
 class InvertedIndex:
     """ Class for creating an inverted index with BM25 scores based a text file
     w/ one entry per line. """
 
-    def __init__(self, fileObj, bm25k, bm25b):
+    def __init__(self, fileObj, bm25k, bm25b, firstRecordId=0, bm25=True):
         r""" Create inverted index given a file object and BM25 parameters.
+        Record IDs start at firstRecordId. If bm25 is False, the inverted
+        lists keep the term frequencies until computeBm25 is called.
 
         >>> import io
         >>> import pprint
@@ -31,7 +111,7 @@ class InvertedIndex:
         >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
         >>> f = io.StringIO(txt)
         >>> ii = InvertedIndex(f, 1.75, 0.75)
-        >>> r = sorted(ii.invertedLists.items())
+        >>> r = sorted(ii.termLists().items())
         >>> # Note: indices decremented by one because I start them at 0.
         >>> pprint.pprint(r[0])
         ('beach', [(3, 0.7054), (4, 1.1355), (5, 1.1355)])
@@ -47,70 +127,127 @@ class InvertedIndex:
 
         self.k = bm25k
         self.b = bm25b
-        self.invertedLists = {}
+        self.invertedLists = []  # term ID -> inverted list
         self.records = {}
         self.avdl = 0
-        recordId = 0
-        self.stopwords = []
+        recordId = firstRecordId
+        self.stopwords = frozenset()
+        self.tokenizer = Tokenizer()
+        self.vocab = self.tokenizer.vocab
 
         self.tdMatrix = None
-        self.rowIds = {}
+        self.rowTerms = None  # matrix row -> term ID
+        self.termRows = None  # term ID -> matrix row (-1 if not in matrix)
 
         """ Pass 1: calculate tf, dl and avdl. """
+        passStart = time.perf_counter()
+        tokenizeSeconds = 0.0
         for line in fileObj:
             if recordId not in self.records:
                 self.records[recordId] = {}
             self.records[recordId]['line'] = line
             self.records[recordId]['dl'] = 0
-            for word in re.split('\W+', line):
-                if len(word) > 0:
-                    word = word.lower()
-                    self.records[recordId]['dl'] += 1
-                    self.avdl += 1
-
-                    """ First occurence of word in file, create inv. list. """
-                    if word not in self.invertedLists:
-                        self.invertedLists[word] = []
-
-                    """ First occurence of word in record, add tuple w/ 0. """
-                    if len(self.invertedLists[word]) == 0 or\
-                       self.invertedLists[word][-1][0] != recordId:
-                        self.invertedLists[word].append((recordId, 0))
-                    """ Increase tf by 1 from 0 or previous value. """
-                    currTf = self.invertedLists[word][-1][1]
-                    self.invertedLists[word][-1] = (recordId, currTf + 1)
+            start = time.perf_counter()
+            words = self.tokenizer.tokenize(line)
+            tokenizeSeconds += time.perf_counter() - start
+            for word in words:
+                self.records[recordId]['dl'] += 1
+                self.avdl += 1
+                termId = self.vocab.add(word)
+
+                """ First occurence of word in file, create inv. list. """
+                if termId == len(self.invertedLists):
+                    self.invertedLists.append([])
+                invList = self.invertedLists[termId]
+
+                """ First occurence of word in record, add tuple w/ 0. """
+                if len(invList) == 0 or invList[-1][0] != recordId:
+                    invList.append((recordId, 0))
+                    self.vocab.dfs[termId] += 1
+                """ Increase tf by 1 from 0 or previous value. """
+                currTf = invList[-1][1]
+                invList[-1] = (recordId, currTf + 1)
 
             recordId += 1
 
-        self.numDocs = recordId  # started at 0, increased at loop end
-        self.avdl = self.avdl / self.numDocs
+        self.numDocs = recordId - firstRecordId  # increased at loop end
+        METRICS.count('documents_indexed', self.numDocs)
+        METRICS.count('tokens_indexed', self.avdl)
+        METRICS.observe('tokenize_seconds', tokenizeSeconds)
+        METRICS.observe('pass1_seconds', time.perf_counter() - passStart)
+        self.avdl = self.avdl / max(self.numDocs, 1)
 
         # -------- tf switch --------
-        if _TF:
+        if _TF or not bm25:
             return
+        self.computeBm25()
 
-        """ Pass 2: calculate tf* idf. """
-        tmpInvLists = {}
-        for word, invList in self.invertedLists.items():
-            df = len(invList)
-            tmpInvLists[word] = []
+    def computeBm25(self, numDocs=None, avdl=None, dfs=None):
+        r""" Pass 2: replace the term frequencies in the inverted lists by
+        BM25 scores. numDocs, avdl and the array of dfs per term ID default
+        to the statistics of this index; other values (e.g. of a whole
+        corpus this index is one part of) keep scores comparable.
+
+        >>> import io
+        >>> txt = 'internet web\ninternet surfing\nweb surfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75, 10, bm25=False)
+        >>> ii.termLists()['web']
+        [(10, 1), (12, 1)]
+        >>> ii.computeBm25(6, 3.0, [3, 3, 6, 3])
+        >>> ii.termLists()['web']
+        [(10, 1.1892), (12, 1.0)]
+        """
+
+        passStart = time.perf_counter()
+        if numDocs is None:
+            numDocs = self.numDocs
+        if avdl is None:
+            avdl = self.avdl
+        tmpInvLists = []
+        for termId, invList in enumerate(self.invertedLists):
+            df = len(invList) if dfs is None else dfs[termId]
+            idf = math.log2(numDocs / df)
+            tmpInvList = []
             for recId, tf in invList:
                 dl = self.records[recId]['dl']
                 numer = tf * (self.k+1)
-                denom = self.k * (1-self.b + ((self.b*dl) / self.avdl)) + tf
+                denom = self.k * (1-self.b + ((self.b*dl) / avdl)) + tf
                 bm25tf = numer / denom
-                idf = math.log2(self.numDocs / df)
                 bm25score = bm25tf * idf
                 # -------- tf * idf switch --------
                 if _TFIDF:
                     bm25score = tf * idf
                 """ Precision to 4 decimals as in TIP file. """
                 bm25score = float('{0:.4f}'.format(bm25score))
-                tmpInvLists[word].append((recId, bm25score))
+                tmpInvList.append((recId, bm25score))
+            tmpInvLists.append(tmpInvList)
 
         self.invListSimpleTf = self.invertedLists  # save for doctest
         self.invertedLists = tmpInvLists
-
+        METRICS.observe('pass2_seconds', time.perf_counter() - passStart)
+
+    def termLists(self, lists=None):
+        """ Return the given inverted lists (default: self.invertedLists) as
+        a dict keyed by term instead of term ID. """
+
+        if lists is None:
+            lists = self.invertedLists
+        return {self.vocab.term(termId): invList
+                for termId, invList in enumerate(lists)}
+
+    def setTermLists(self, termLists):
+        """ Replace the vocabulary and inverted lists by the given dict of
+        term -> inverted list. """
+
+        self.tokenizer = Tokenizer()
+        self.vocab = self.tokenizer.vocab
+        self.invertedLists = []
+        for term, invList in termLists.items():
+            self.vocab.add(term)
+            self.vocab.dfs[-1] = len(invList)
+            self.invertedLists.append(invList)
+
+    @METRICS.timed('preprocess_vsm')
     def preprocessVsm(self, m, l2normalize=False):
         r""" Compute sparse term-document matrix using inverted index created
         in the class's constructor.
@@ -130,34 +267,35 @@ class InvertedIndex:
                 [ 0.9437,  1.1355,  0.    ,  0.7054,  1.1355,  1.1355]])
         """
 
-        # get sorted terms by df
-        srtdTerms = sorted(self.invertedLists,
-                           key=lambda x: len(self.invertedLists[x]),
-                           reverse=True)
-        # get m most frequent terms
-        mfTerms = srtdTerms[0:m]
+        # get term IDs sorted by df, keep the m most frequent terms
+        mfTerms = numpy.argsort(-self.vocab.dfArray(), kind='stable')[0:m]
 
         nzVals = []
         rowInds = []
         colInds = []
-        row = 0
-        for fTerm in mfTerms:
-            invList = self.invertedLists[fTerm]
+        for row, termId in enumerate(mfTerms):
+            invList = self.invertedLists[termId]
             for recId, bm25score in invList:
                 nzVals.append(bm25score)
                 rowInds.append(row)
                 colInds.append(recId)
-            self.rowIds[fTerm] = row
-            row += 1
         A = scipy.sparse.csr_matrix((nzVals, (rowInds, colInds)))
+        self.rowTerms = mfTerms
+        self.termRows = numpy.full(len(self.vocab), -1, dtype=numpy.int64)
+        self.termRows[mfTerms] = numpy.arange(len(mfTerms))
 
         if l2normalize:
             A = self.l2normalizeCols(A)
 
         self.tdMatrix = A
+        self.m = m
+        self.l2normalize = l2normalize
 
-    def preprocessLsi(self, k):
+    @METRICS.timed('preprocess_lsi')
+    def preprocessLsi(self, k, backend='arpack', **svdArgs):
         """Do LSI preprocessing. Perform SVD, compute V_k, U_k and U_k * S_k.
+        The SVD is computed by the given backend (see _SVD_BACKENDS), any
+        further keyword arguments are passed on to it.
 
         >>> import io
         >>> ii = InvertedIndex(io.StringIO('foo'), 1.75, 0.75)
@@ -192,11 +330,86 @@ class InvertedIndex:
                [-0.726,  1.397]])
         """
 
-        U, S, Vt = scipy.sparse.linalg.svds(self.tdMatrix, k)
+        U, S, Vt = _SVD_BACKENDS[backend](self.tdMatrix, k, **svdArgs)
         self.Uk = U[:, :k]
         self.Vk = Vt[:k, :]
         self.UkSk = self.Uk * S
+        self.kLsi = k
+
+    def saveLsi(self, dirName):
+        """ Save the LSI model (U_k * S_k, U_k, V_k, the term vocabulary and
+        the parameters used to compute them) to the given directory. Arrays
+        are stored as raw .npy files so that loadLsi can memory map them.
+        """
+
+        os.makedirs(dirName, exist_ok=True)
+        terms = '\n'.join(self.vocab.terms(self.rowTerms)).encode('utf-8')
+        arrays = {'UkSk': self.UkSk, 'Uk': self.Uk, 'Vk': self.Vk,
+                  'terms': numpy.frombuffer(terms, dtype=numpy.uint8)}
+        for name, array in arrays.items():
+            numpy.save(os.path.join(dirName, name + '.npy'),
+                       numpy.ascontiguousarray(array))
+        meta = {'version': _LSI_MODEL_VERSION, 'm': self.m, 'k': self.kLsi,
+                'l2normalize': self.l2normalize, 'bm25k': self.k,
+                'bm25b': self.b, 'numDocs': self.numDocs}
+        with open(os.path.join(dirName, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def loadLsi(self, dirName):
+        r""" Load an LSI model saved with saveLsi. The factor matrices are
+        memory mapped read-only, so loading is fast and processes loading the
+        same model share the memory of the factors.
 
+        >>> import io
+        >>> import tempfile
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> ii.preprocessVsm(4)
+        >>> ii.preprocessLsi(2)
+        >>> dirName = tempfile.mkdtemp()
+        >>> ii.saveLsi(dirName)
+        >>> ii2 = InvertedIndex(io.StringIO(''), 1.75, 0.75)
+        >>> ii2.loadLsi(dirName)
+        >>> ii2.m, ii2.kLsi, ii2.l2normalize
+        (4, 2, False)
+        >>> ii2.vocab.terms(ii2.rowTerms) == ii.vocab.terms(ii.rowTerms)
+        True
+        >>> type(ii2.Vk).__name__, ii2.Vk.flags.writeable
+        ('memmap', False)
+        >>> q = 'web surfing'
+        >>> ii2.processQueryLsi(q) == ii.processQueryLsi(q)
+        True
+        """
+
+        with open(os.path.join(dirName, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != _LSI_MODEL_VERSION:
+            raise ValueError('Unsupported LSI model version {0}'.format(
+                meta['version']))
+
+        def load(name):
+            return numpy.load(os.path.join(dirName, name + '.npy'),
+                              mmap_mode='r')
+
+        self.UkSk = load('UkSk')
+        self.Uk = load('Uk')
+        self.Vk = load('Vk')
+        terms = load('terms').tobytes().decode('utf-8').split('\n')
+        self.tokenizer = Tokenizer()
+        self.vocab = self.tokenizer.vocab
+        for term in terms:
+            self.vocab.add(term)
+        self.rowTerms = numpy.arange(len(terms))
+        self.termRows = numpy.arange(len(terms))
+        self.m = meta['m']
+        self.kLsi = meta['k']
+        self.l2normalize = meta['l2normalize']
+        self.k = meta['bm25k']
+        self.b = meta['bm25b']
+        self.numDocs = meta['numDocs']
+
+    @METRICS.timed('process_query_lsi')
     def processQueryLsi(self, q):
         r""" Execute the query by projecting the query vector to latent space.
 
@@ -213,6 +426,9 @@ class InvertedIndex:
         """
 
         Q = self.prepareQueryMatrix(q)
+        # the dense factors are scored for all documents, no postings read
+        METRICS.observe('query_postings', 0, SIZE_BUCKETS)
+        METRICS.observe('query_candidates', self.Vk.shape[1], SIZE_BUCKETS)
         qConc = Q * self.UkSk
         scores = qConc.dot(self.Vk)
         scores = numpy.round(scores, 3)
@@ -222,14 +438,29 @@ class InvertedIndex:
             result.append((i, scores[i]))
         return sorted(result, key=lambda x: (float(x[1]), x[0]), reverse=True)
 
+    @METRICS.timed('process_query_lsi_comb')
     def processQueryLsiComb(self, q, l):
         r""" Execute the query by projecting the query vector to latent space
         + linear combination with original scores.
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> ii.preprocessVsm(4)
+        >>> ii.preprocessLsi(2)
+        >>> res = ii.processQueryLsiComb("web surfing", 0.5)
+        >>> [(d, float('%.3f' % s)) for d, s in res[0:3]]
+        [(0, 0.944), (2, 0.852), (3, 0.705)]
         """
 
         Q = self.prepareQueryMatrix(q)
+        METRICS.observe('query_postings', self.queryPostings(Q),
+                        SIZE_BUCKETS)
+        METRICS.observe('query_candidates', self.Vk.shape[1], SIZE_BUCKETS)
         qConc = Q * self.UkSk
-        scores = l * Q * self.tdMatrix + (1 - l) * qConc.T * self.Vk
+        vsmScores = (Q * self.tdMatrix).toarray()
+        scores = l * vsmScores + (1 - l) * qConc.dot(self.Vk)
         scores = scores.tolist()[0]
         result = []
         for i in range(0, len(scores)):
@@ -270,15 +501,34 @@ class InvertedIndex:
         rowInds = []
         colInds = []
         for key, val in weighted.items():
-            if key not in self.rowIds:
+            termId = self.vocab.get(key)
+            if termId is None or self.termRows[termId] < 0:
                 continue
             nzVals.append(val)
             rowInds.append(0)
-            colInds.append(self.rowIds[key])
+            colInds.append(self.termRows[termId])
         Q = scipy.sparse.csr_matrix((nzVals, (rowInds, colInds)),
-                                    shape=(1, self.tdMatrix.shape[0]))
+                                    shape=(1, len(self.rowTerms)))
         return Q
 
+    def queryPostings(self, Q):
+        r""" Return the number of entries of the term-document matrix in
+        the rows of the query matrix Q (see prepareQueryMatrix), i.e. the
+        postings a query touches.
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> ii.preprocessVsm(4)
+        >>> ii.queryPostings(ii.prepareQueryMatrix('web surfing web'))
+        9
+        """
+
+        indptr = self.tdMatrix.indptr
+        return int((indptr[Q.indices + 1] - indptr[Q.indices]).sum())
+
+    @METRICS.timed('process_query_vsm')
     def processQueryVsm(self, q):
         """ Process a query using the VSM. Return relevant documents sorted by
         their BM25-scores.
@@ -287,7 +537,7 @@ class InvertedIndex:
         >>> ii = InvertedIndex(io.StringIO('foo'), 1.75, 0.75)
         >>> l1 = [(0, 0.2), (2, 0.6)]
         >>> l2 = [(1, 0.4), (2, 0.1), (3, 0.8)]
-        >>> ii.invertedLists = {"bla": l1, "blubb": l2}
+        >>> ii.setTermLists({"bla": l1, "blubb": l2})
         >>> ii.preprocessVsm(99)
         >>> ii.processQueryVsm("bla blubb") # as above, rec/doc ids from 0
         [(3, 0.8), (2, 0.7), (1, 0.4), (0, 0.2)]
@@ -296,13 +546,17 @@ class InvertedIndex:
         """
 
         Q = self.prepareQueryMatrix(q)
+        METRICS.observe('query_postings', self.queryPostings(Q),
+                        SIZE_BUCKETS)
         scores = Q.dot(self.tdMatrix)
+        METRICS.observe('query_candidates', scores.nnz, SIZE_BUCKETS)
         scores = scores.todense().tolist()[0]
         result = []
         for i in range(0, len(scores)):
             result.append((i, scores[i]))
         return sorted(result, key=lambda x: -x[1])
 
+    @METRICS.timed('process_query')
     def processQuery(self, q):
         r""" Given a list of keywords, find the 3 best maches accoding to
         BM25.
@@ -319,23 +573,27 @@ class InvertedIndex:
         keywords = q.split(' ')
         keywords = [w.lower() for w in keywords]
         keywords = [w for w in keywords if w not in self.stopwords]
+        termIds = [self.vocab.get(w) for w in keywords]
+        termIds = [t for t in termIds if t is not None]
+
+        METRICS.observe('query_postings', sum(
+            len(self.invertedLists[t]) for t in termIds), SIZE_BUCKETS)
 
         """ Special cases. """
-        if len(keywords) == 0:
+        if len(termIds) == 0:
             return []
-        if len(keywords) == 1:
-            if keywords[0] not in self.invertedLists:
-                return []
-            rawList = self.invertedLists[keywords[0]]
+        if len(termIds) == 1:
+            rawList = self.invertedLists[termIds[0]]
+            METRICS.observe('query_candidates', len(rawList), SIZE_BUCKETS)
             sortdList = sorted(rawList, key=lambda x: -x[1])
             return sortdList
 
         """ Actual merging. """
-        list1 = self.invertedLists[keywords[0]]
-        for i in range(1, len(keywords)):
-            if keywords[i] in self.invertedLists:
-                list2 = self.invertedLists[keywords[i]]
-                list1 = self.merge(list1, list2)
+        list1 = self.invertedLists[termIds[0]]
+        for i in range(1, len(termIds)):
+            list2 = self.invertedLists[termIds[i]]
+            list1 = self.merge(list1, list2)
+        METRICS.observe('query_candidates', len(list1), SIZE_BUCKETS)
 
         sortdList = sorted(list1, key=lambda x: -x[1])
         return sortdList
@@ -374,19 +632,58 @@ class InvertedIndex:
         return res
 
     def setStopwords(self, lisd):
-        self.stopwords = lisd
+        self.stopwords = frozenset(lisd)
+
+    def memoryReport(self):
+        r""" Return the deep memory usage of the index by structure (see
+        metrics.memoryBreakdown), with the term-document matrix split into
+        its CSR arrays and the LSI factors, if computed.
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> ii.preprocessVsm(4)
+        >>> ii.preprocessLsi(2)
+        >>> report = ii.memoryReport()
+        >>> sorted(report['parts']) # doctest: +NORMALIZE_WHITESPACE
+        ['Uk', 'UkSk', 'Vk', 'invListSimpleTf', 'invertedLists', 'other',
+         'records', 'tdMatrix.data', 'tdMatrix.indices', 'tdMatrix.indptr',
+         'vocab']
+        >>> report['numDocs'], report['numPostings']
+        (6, 15)
+        """
 
-    def relatedTermPairs(self, k):
+        parts = [('records', self.records, 'docs'),
+                 ('invertedLists', self.invertedLists, 'docs')]
+        if hasattr(self, 'invListSimpleTf'):
+            parts.append(('invListSimpleTf', self.invListSimpleTf, 'docs'))
+        parts.append(('vocab', self.vocab, 'vocab'))
+        if self.tdMatrix is not None:
+            # rows are the (at most m) terms of the matrix
+            parts += [('tdMatrix.data', self.tdMatrix.data, 'docs'),
+                      ('tdMatrix.indices', self.tdMatrix.indices, 'docs'),
+                      ('tdMatrix.indptr', self.tdMatrix.indptr, 'fixed')]
+        if hasattr(self, 'Uk'):
+            parts += [('Uk', self.Uk, 'fixed'), ('UkSk', self.UkSk, 'fixed'),
+                      ('Vk', self.Vk, 'docs')]
+        numPostings = sum(len(invList) for invList in self.invertedLists)
+        return memoryBreakdown(self, parts, self.numDocs, numPostings)
+
+    def relatedTermPairs(self, k, blockSize=1024):
         """ Compute the term-term association matrix T. Return the k term pairs
-        with highest values, sorted by their values.
+        with highest values, sorted by their values. T is computed in blocks
+        of rows and only the best k pairs of each block are kept, so T is
+        never held in memory as a whole.
 
         >>> import io
         >>> ii = InvertedIndex(io.StringIO('foo'), 1.75, 0.75)
-        >>> ii.invertedLists = {}
-        >>> ii.invertedLists["lirum"] = [(2, 0.1)]
-        >>> ii.invertedLists["larum"] = [(8, 0.8)]
-        >>> ii.invertedLists["spoon"] = [(1, 0.2), (3, 0.6), (4, 0.1)]
-        >>> ii.invertedLists["handle"] = [(2, 0.4), (3, 0.1), (4, 0.8)]
+        >>> lists = {}
+        >>> lists["lirum"] = [(2, 0.1)]
+        >>> lists["larum"] = [(8, 0.8)]
+        >>> lists["spoon"] = [(1, 0.2), (3, 0.6), (4, 0.1)]
+        >>> lists["handle"] = [(2, 0.4), (3, 0.1), (4, 0.8)]
+        >>> ii.setTermLists(lists)
         >>> ii.preprocessVsm(4)
         >>> ii.preprocessLsi(2)
         >>> r = ii.relatedTermPairs(1)[0]
@@ -398,23 +695,148 @@ class InvertedIndex:
         0.285
         """
 
-        T = self.Uk.dot(self.Uk.T)
-        numpy.fill_diagonal(T, 0)  # get rid of same term values
-        T = numpy.tril(T)          # get rid of duplicate values
-        termMap = {v: k for k, v in self.rowIds.items()}
-        vals = [item for sublist in T.tolist() for item in sublist]
-        vals = sorted(vals, reverse=True)
+        Uk = numpy.asarray(self.Uk)
+        m = Uk.shape[0]
+        candRows = []
+        candCols = []
+        candVals = []
+        for start in range(0, m, blockSize):
+            end = min(start + blockSize, m)
+            # only the part below the diagonal (no same term or duplicate
+            # pairs), i.e. columns 0 .. end-1 for rows start .. end-1
+            T = Uk[start:end].dot(Uk[:end].T)
+            rows = numpy.arange(start, end)[:, numpy.newaxis]
+            T[numpy.arange(end)[numpy.newaxis, :] >= rows] = -numpy.inf
+            best = topK(T.ravel(), k)
+            r, c = numpy.unravel_index(best, T.shape)
+            candRows.append(r + start)
+            candCols.append(c)
+            candVals.append(T[r, c])
+        rows = numpy.concatenate(candRows)
+        cols = numpy.concatenate(candCols)
+        vals = numpy.concatenate(candVals)
+        best = topK(vals, k)
+        best = best[numpy.isfinite(vals[best])]
         termPairs = []
-        for val in vals[0:k]:
-            pos = numpy.where(T == val)
-            t1 = termMap[pos[0][0]]
-            t2 = termMap[pos[1][0]]
-            termPairs.append((t1, t2, val))
+        for i in best:
+            termPairs.append((self.vocab.term(self.rowTerms[rows[i]]),
+                              self.vocab.term(self.rowTerms[cols[i]]),
+                              float(vals[i])))
         return termPairs
 
+    def relatedTerms(self, term, k, blockSize=65536):
+        """ Return the k terms with the highest association to the given term
+        (see relatedTermPairs) as (term, value) pairs.
+
+        >>> import io
+        >>> ii = InvertedIndex(io.StringIO('foo'), 1.75, 0.75)
+        >>> lists = {}
+        >>> lists["lirum"] = [(2, 0.1)]
+        >>> lists["larum"] = [(8, 0.8)]
+        >>> lists["spoon"] = [(1, 0.2), (3, 0.6), (4, 0.1)]
+        >>> lists["handle"] = [(2, 0.4), (3, 0.1), (4, 0.8)]
+        >>> ii.setTermLists(lists)
+        >>> ii.preprocessVsm(4)
+        >>> ii.preprocessLsi(2)
+        >>> [(t, '{0:.3f}'.format(v)) for t, v in ii.relatedTerms('spoon', 2)]
+        [('handle', '0.285'), ('lirum', '0.013')]
+        >>> ii.relatedTerms('nonexistent', 2)
+        []
+        """
+
+        termId = self.vocab.get(term)
+        if termId is None or self.termRows[termId] < 0:
+            return []
+        Uk = numpy.asarray(self.Uk)
+        row = self.termRows[termId]
+        vec = Uk[row]
+        m = Uk.shape[0]
+        candRows = []
+        candVals = []
+        for start in range(0, m, blockSize):
+            vals = Uk[start:start + blockSize].dot(vec)
+            if start <= row < start + blockSize:
+                vals[row - start] = -numpy.inf
+            best = topK(vals, k)
+            candRows.append(best + start)
+            candVals.append(vals[best])
+        rows = numpy.concatenate(candRows)
+        vals = numpy.concatenate(candVals)
+        best = topK(vals, k)
+        best = best[numpy.isfinite(vals[best])]
+        return [(self.vocab.term(self.rowTerms[rows[i]]), float(vals[i]))
+                for i in best]
+
 
 class EvaluateBenchmark:
-    """ Class with functions for computing MP@3, MP@R and MAP. """
+    """ Class with functions for computing MP@3, MP@R and MAP (and nDCG@k,
+    recall@k). All metrics are computed for a batch of queries at once from
+    a boolean relevance mask of their top-N results. """
+
+    def __init__(self, topN=_TOP_N):
+        """ Create an evaluator that looks at the topN results per query. """
+
+        self.topN = topN
+
+    def relevanceMask(self, resultIds, relevantIds, n):
+        """ Given a list of result ID lists (one per query, best first) and a
+        list of relevant ID lists, return a #queries x n boolean matrix whose
+        entry (q, i) tells whether the result at rank i + 1 of query q is
+        relevant. Shorter result lists are padded with False.
+
+        >>> eb = EvaluateBenchmark()
+        >>> eb.relevanceMask([[3, 1, 2], [5]], [[1, 2], [7]], 4).astype(int)
+        array([[0, 1, 1, 0],
+               [0, 0, 0, 0]])
+        """
+
+        mask = numpy.zeros((len(resultIds), n), dtype=bool)
+        for q, (res, rel) in enumerate(zip(resultIds, relevantIds)):
+            res = numpy.asarray(res[0:n], dtype=numpy.int64)
+            mask[q, 0:len(res)] = numpy.isin(res, rel)
+        return mask
+
+    def metrics(self, mask, numRelevant, ks=(3,)):
+        """ Given a relevance mask (see relevanceMask) and the number of
+        relevant documents per query, return a dict of per query arrays for
+        P@k, R@k (recall) and nDCG@k (binary gains) for each k in ks, P@R and
+        AP.
+
+        >>> eb = EvaluateBenchmark()
+        >>> mask = eb.relevanceMask([[0, 1, 2, 5, 6], [9, 4]],
+        ...                         [[0, 2, 5, 6, 7, 8], [4]], 6)
+        >>> m = eb.metrics(mask, [6, 1], ks=[3])
+        >>> for name in sorted(m):
+        ...     print(name, [float('%.3f' % v) for v in m[name]])
+        AP [0.536, 0.5]
+        P@3 [0.667, 0.333]
+        P@R [0.667, 0.0]
+        R@3 [0.333, 1.0]
+        nDCG@3 [0.704, 0.631]
+        """
+
+        mask = numpy.asarray(mask, dtype=bool)
+        numRelevant = numpy.asarray(numRelevant, dtype=numpy.int64)
+        numQueries, n = mask.shape
+        hits = numpy.cumsum(mask, axis=1)  # relevant results up to rank i+1
+        safeR = numpy.maximum(numRelevant, 1)
+        result = {}
+        for k in ks:
+            hitsAtK = hits[:, min(k, n) - 1]
+            result['P@{0}'.format(k)] = hitsAtK / k
+            result['R@{0}'.format(k)] = hitsAtK / safeR
+            discounts = 1 / numpy.log2(numpy.arange(2, k + 2))
+            dcg = mask[:, 0:k].dot(discounts[0:min(k, n)])
+            # ideal DCG: all min(R, k) relevant documents ranked first
+            idealDcgs = numpy.concatenate(([1], numpy.cumsum(discounts)))
+            idcg = idealDcgs[numpy.minimum(numRelevant, k)]
+            result['nDCG@{0}'.format(k)] = dcg / idcg
+        rows = numpy.arange(numQueries)
+        hitsAtR = hits[rows, numpy.clip(numRelevant, 1, n) - 1]
+        result['P@R'] = numpy.where(numRelevant > 0, hitsAtR / safeR, 0)
+        precisions = hits / numpy.arange(1, n + 1)
+        result['AP'] = (precisions * mask).sum(axis=1) / safeR
+        return result
 
     def precisionAtK(self, resultIds, relevantIds, k):
         """ Given lists of calculated, actually relevant record IDs and k,
@@ -425,12 +847,9 @@ class EvaluateBenchmark:
         0.75
         """
 
-        res = resultIds[0:k]
-        hit = 0
-        for r in relevantIds:
-            if r in res:
-                hit += 1
-        return hit/k
+        mask = self.relevanceMask([resultIds], [relevantIds], k)
+        return float(self.metrics(mask, [len(relevantIds)],
+                                  [k])['P@{0}'.format(k)][0])
 
     def precisionAtR(self, resultIds, relevantIds):
         """ Given lists of calculated and actually relevant record IDs,
@@ -452,20 +871,88 @@ class EvaluateBenchmark:
         0.525
         """
 
-        sum = 0.0
-        matchedRelevant = 0
-        for i, r in enumerate(resultIds):
-            if r in relevantIds:
-                matchedRelevant += 1
-                sum += (matchedRelevant / (i + 1))
-        return sum / len(relevantIds)
+        mask = self.relevanceMask([resultIds], [relevantIds],
+                                  max(len(resultIds), 1))
+        return float(self.metrics(mask, [len(relevantIds)], [])['AP'][0])
+
+    def evaluateQueries(self, bmFileName, processQuery, ks=(3,)):
+        """ Run all queries of the given benchmark file through the given
+        query function (returning (record ID, score) pairs, best first). Return
+        the list of queries and a dict of per query metric arrays (see
+        metrics), computed on the top self.topN results of each query.
+        """
+
+        queries, relevantIds = self.readBenchmark(bmFileName)
+        resultIds = []
+        for query in queries:
+            result = processQuery(query)[0:self.topN]
+            resultIds.append([r[0] for r in result])
+        return queries, self.evaluateResults(resultIds, relevantIds, ks)
+
+    def readBenchmark(self, bmFileName):
+        """ Read a benchmark file (<query>\t<space separated relevant IDs>).
+        Return the list of queries and the list of relevant ID arrays. """
+
+        queries = []
+        relevantIds = []
+        with open(bmFileName) as f:
+            for line in f:
+                query, idLine = line.strip().split('\t')
+                """ movies-benchmark.txt assumes movie IDs starting at 1
+                whereas I work with IDs starting at 0, therefore I decrement
+                all relevant IDs by 1. """
+                relIds = numpy.array(idLine.split(' '), dtype=numpy.int64) - 1
+                queries.append(query)
+                relevantIds.append(relIds)
+        return queries, relevantIds
+
+    def evaluateResults(self, resultIds, relevantIds, ks=(3,)):
+        """ Return the dict of per query metric arrays (see metrics) for the
+        given result ID lists (best first) and relevant ID lists. """
+
+        numRelevant = [len(relIds) for relIds in relevantIds]
+        n = max([self.topN] + numRelevant + list(ks))
+        mask = self.relevanceMask(resultIds, relevantIds, n)
+        return self.metrics(mask, numRelevant, ks)
+
+    def evaluate(self, bmFileName, processQuery):
+        """ Run all queries of the given benchmark file through the given
+        query function and return MP@3, MP@R and MAP.
+        """
+
+        queries, metrics = self.evaluateQueries(bmFileName, processQuery)
+        return (float(metrics['P@3'].mean()), float(metrics['P@R'].mean()),
+                float(metrics['AP'].mean()))
 
 
 if __name__ == '__main__':
     """ Answer user queries for a file given as command line parameter. """
 
+    memory = '--memory' in sys.argv  # print memory reports
+    if memory:
+        sys.argv.remove('--memory')
+
+    if len(sys.argv) == 4 and sys.argv[1] == '--model':
+        """ Run the benchmark on a model saved with the [w]rite mode. """
+        start = time.time()
+        ii = InvertedIndex(io.StringIO(''), 1.75, 0.3)
+        ii.loadLsi(sys.argv[2])
+        end = time.time()
+        ii.setStopwords(loadStopwords())
+        print('Model load time: {0:.3f}s'.format(end-start))
+        if memory:
+            print(formatMemoryReport(ii.memoryReport()))
+        eb = EvaluateBenchmark()
+        mpAt3, mpAtR, mAp = eb.evaluate(sys.argv[3], ii.processQueryLsi)
+        print('MP@3 {0:.2f} | MP@R {1:.2f} | MAP: {2:.2f}'.format(
+            mpAt3, mpAtR, mAp))
+        sys.exit()
+
     if len(sys.argv) != 5:
-        print('Usage: python3 inverted_index.py <recs> <k> <m> <benchmark>')
+        print('Usage: python3 inverted_index.py <recs> <k> <m> <benchmark> '
+              '[--memory]\n'
+              '       python3 inverted_index.py --model <dir> <benchmark> '
+              '[--memory]')
         sys.exit()
 
     recFileName = sys.argv[1]
@@ -477,14 +964,13 @@ if __name__ == '__main__':
     with open(recFileName) as f:
         ii = InvertedIndex(f, 1.75, 0.3)
     print('done')
+    if memory:
+        print(formatMemoryReport(ii.memoryReport()))
 
-    stopwords = []
-    with open('stopwords_en.txt') as f:
-        for line in f:
-            stopwords.append(line.strip())
-    ii.setStopwords(stopwords)
+    ii.setStopwords(loadStopwords())
 
-    mode = input('\n[t]erm pairs or [b]enchmark?\n> ')
+    mode = input('\n[t]erm pairs, [b]enchmark, [s]vd comparison or [w]rite '
+                 'LSI model?\n> ')
     if mode == 't':
         ii.preprocessVsm(m, l2normalize=_L2)
         ii.preprocessLsi(k)
@@ -494,40 +980,45 @@ if __name__ == '__main__':
                 f.write('{0}, {1}   [{2}]\n'.format(t[0], t[1], t[2]))
     elif mode == 'b':
         eb = EvaluateBenchmark()
-        with open(bmFileName) as f:
-            mpAt3 = 0
-            mpAtR = 0
-            mAp = 0
-            count = 0
-            ii.preprocessVsm(m, l2normalize=_L2)
-            ii.preprocessLsi(k)
-            for line in f:
-                query, idLine = line.strip().split('\t')
-                relIds = idLine.split(' ')
-                """ movies-benchmark.txt assumes movie IDs starting at 1
-                whereas I work with IDs starting at 0, therefore I decrement
-                all relevant IDs by 1. """
-                relIds = [int(x)-1 for x in relIds]
-                # result = ii.processQuery(query)
-                # result = ii.processQueryVsm(query)
-                # result = ii.processQueryLsi(query)
-                result = ii.processQueryLsiComb(query, 0.67)
-                resIds = [r[0] for r in result]
-                pAt3 = eb.precisionAtK(resIds, relIds, 3)
-                pAtR = eb.precisionAtR(resIds, relIds)
-                ap = eb.avgPrecision(resIds, relIds)
-                # print('\nQuery: {0}'.format(query))
-                # print('P@3 {0:.2f} | P@R {1:.2f} | AP: {2:.2f}'.format(
-                #     pAt3, pAtR, ap))
-                mpAt3 += pAt3
-                mpAtR += pAtR
-                mAp += ap
-                count += 1
-            mpAt3 = mpAt3 / count
-            mpAtR = mpAtR / count
-            mAp = mAp / count
-            print('\nAverage:')
-            print('MP@3 {0:.2f} | MP@R {1:.2f} | MAP: {2:.2f}'.format(
-                mpAt3, mpAtR, mAp))
+        ii.preprocessVsm(m, l2normalize=_L2)
+        ii.preprocessLsi(k)
+
+        def processQuery(query):
+            # return ii.processQuery(query)
+            # return ii.processQueryVsm(query)
+            # return ii.processQueryLsi(query)
+            return ii.processQueryLsiComb(query, 0.67)
+
+        queries, metrics = eb.evaluateQueries(bmFileName, processQuery,
+                                              ks=(3, 10))
+        print('\nAverage:')
+        print('MP@3 {0:.2f} | MP@R {1:.2f} | MAP: {2:.2f} | nDCG@10 {3:.2f} '
+              '| R@10 {4:.2f}'.format(
+                  *[metrics[name].mean()
+                    for name in ['P@3', 'P@R', 'AP', 'nDCG@10', 'R@10']]))
+    elif mode == 's':
+        """ Compare the SVD backends w.r.t. time and retrieval quality. """
+        eb = EvaluateBenchmark()
+        ii.preprocessVsm(m, l2normalize=_L2)
+        backends = [('arpack', {}),
+                    ('randomized', {'powerIters': 0}),
+                    ('randomized', {'powerIters': 2}),
+                    ('randomized', {'powerIters': 4})]
+        for backend, svdArgs in backends:
+            start = time.time()
+            ii.preprocessLsi(k, backend, **svdArgs)
+            end = time.time()
+            mpAt3, mpAtR, mAp = eb.evaluate(bmFileName, ii.processQueryLsi)
+            print('{0} {1}: {2:.2f}s | MP@3 {3:.2f} | MP@R {4:.2f} | '
+                  'MAP: {5:.2f}'.format(backend, svdArgs, end-start, mpAt3,
+                                        mpAtR, mAp))
+    elif mode == 'w':
+        dirName = input('\nModel directory\n> ')
+        ii.preprocessVsm(m, l2normalize=_L2)
+        ii.preprocessLsi(k)
+        if memory:
+            print(formatMemoryReport(ii.memoryReport()))
+        ii.saveLsi(dirName)
+        print('LSI model saved to {0}'.format(dirName))
     else:
         sys.exit()
@@ -0,0 +1,238 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import numpy
+import sys
+import time
+from lsi import EvaluateBenchmark, InvertedIndex, topK
+from tokenizer import loadStopwords
+
+
+class LsiSearchEngine:
+    """ Class for answering LSI queries against precomputed, L2-normalized
+    document vectors in latent space. """
+
+    def __init__(self, ii, blockSize=65536):
+        r""" Create the engine given an InvertedIndex on which preprocessLsi
+        was run (or an LSI model was loaded).
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> ii.preprocessVsm(4)
+        >>> ii.preprocessLsi(2)
+        >>> se = LsiSearchEngine(ii, blockSize=4)
+        >>> se.docVecs.shape, se.docVecs.dtype, se.docVecs.flags.c_contiguous
+        ((6, 2), dtype('float32'), True)
+        >>> [(d, '%.3f' % s) for d, s in se.search('beach', 3)]
+        [(4, '0.980'), (5, '0.980'), (3, '0.689')]
+        """
+
+        self.ii = ii
+        self.blockSize = blockSize
+        docVecs = numpy.array(numpy.asarray(ii.Vk).T, dtype=numpy.float32,
+                              order='C')
+        norms = numpy.linalg.norm(docVecs, axis=1)
+        norms[norms == 0] = 1
+        docVecs /= norms[:, numpy.newaxis]
+        self.docVecs = docVecs
+
+    def queryVector(self, q):
+        """ Project the query to latent space and L2-normalize it. """
+
+        Q = self.ii.prepareQueryMatrix(q)
+        qVec = numpy.asarray(Q * self.ii.UkSk, dtype=numpy.float32).ravel()
+        norm = numpy.linalg.norm(qVec)
+        return qVec / norm if norm > 0 else qVec
+
+    def search(self, q, k):
+        """ Return the k best (document ID, score) pairs for the query. """
+
+        return self.searchVectors(self.queryVector(q)[numpy.newaxis, :],
+                                  k)[0]
+
+    def searchVectors(self, qVecs, k):
+        """ Return the k best (document ID, score) pairs for each row of the
+        given b x k query matrix. The document matrix is scanned in blocks,
+        keeping only the best k candidates per block and query.
+        """
+
+        qVecs = numpy.asarray(qVecs, dtype=numpy.float32)
+        numQueries = qVecs.shape[0]
+        candIds = [[] for i in range(numQueries)]
+        candScores = [[] for i in range(numQueries)]
+        for start in range(0, self.docVecs.shape[0], self.blockSize):
+            block = self.docVecs[start:start + self.blockSize]
+            blockScores = qVecs.dot(block.T)
+            for i in range(numQueries):
+                best = topK(blockScores[i], k)
+                candIds[i].append(best + start)
+                candScores[i].append(blockScores[i][best])
+
+        results = []
+        for i in range(numQueries):
+            ids = numpy.concatenate(candIds[i])
+            scores = numpy.concatenate(candScores[i])
+            best = topK(scores, k)
+            results.append(list(zip(ids[best].tolist(),
+                                    scores[best].tolist())))
+        return results
+
+
+class IvfIndex:
+    """ Class for approximate search over the document vectors of a
+    LsiSearchEngine, using an inverted file with a (spherical) k-means coarse
+    quantiser. """
+
+    def __init__(self, engine, numLists, iterations=10, seed=None):
+        r""" Cluster the document vectors into numLists lists (at most one
+        per document).
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> ii.preprocessVsm(4)
+        >>> ii.preprocessLsi(2)
+        >>> se = LsiSearchEngine(ii)
+        >>> ivf = IvfIndex(se, 2, seed=0)
+        >>> int(ivf.offsets[-1])
+        6
+        >>> q = 'web surfing'
+        >>> ivf.search(q, 3, nprobe=2) == se.search(q, 3)
+        True
+        >>> len(IvfIndex(se, 10, seed=0).centroids)
+        6
+        >>> import types
+        >>> IvfIndex(types.SimpleNamespace(docVecs=numpy.zeros((0, 2))), 2)
+        Traceback (most recent call last):
+        ...
+        ValueError: cannot build an IVF index over 0 documents
+        """
+
+        self.engine = engine
+        docVecs = engine.docVecs
+        n = docVecs.shape[0]
+        if n == 0:
+            raise ValueError('cannot build an IVF index over 0 documents')
+        # at most one list per document
+        numLists = min(numLists, n)
+        rng = numpy.random.default_rng(seed)
+        centroids = docVecs[rng.choice(n, numLists, replace=False)]
+        for i in range(iterations):
+            assignment = self.assign(docVecs, centroids)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, assignment, docVecs)
+            norms = numpy.linalg.norm(sums, axis=1)
+            # keep the old centroid for lists that ran empty
+            nonEmpty = norms > 0
+            centroids[nonEmpty] = sums[nonEmpty] / norms[nonEmpty, None]
+        assignment = self.assign(docVecs, centroids)
+
+        self.centroids = centroids
+        # lists stored CSR style: docIds[offsets[l]:offsets[l+1]] is list l
+        self.docIds = numpy.argsort(assignment, kind='stable')
+        counts = numpy.bincount(assignment, minlength=numLists)
+        self.offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+
+    def assign(self, docVecs, centroids, blockSize=65536):
+        """ Return the index of the closest centroid for each vector. """
+
+        assignment = numpy.empty(docVecs.shape[0], dtype=numpy.int64)
+        for start in range(0, docVecs.shape[0], blockSize):
+            block = docVecs[start:start + blockSize]
+            assignment[start:start + blockSize] = numpy.argmax(
+                block.dot(centroids.T), axis=1)
+        return assignment
+
+    def search(self, q, k, nprobe=8):
+        """ Return the k best (document ID, score) pairs for the query among
+        the documents of the nprobe lists closest to the query.
+        """
+
+        qVec = self.engine.queryVector(q)
+        lists = topK(self.centroids.dot(qVec), nprobe)
+        ids = numpy.concatenate(
+            [self.docIds[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+        scores = self.engine.docVecs[ids].dot(qVec)
+        best = topK(scores, k)
+        # final order as in LsiSearchEngine: by score, ties by document ID
+        order = numpy.lexsort((ids[best], -scores[best]))
+        best = best[order]
+        return list(zip(ids[best].tolist(), scores[best].tolist()))
+
+
+def recallReport(engine, ivf, queries, k, nprobes):
+    """ Compare exact search with IVF search for each nprobe value. Return a
+    list of (label, recall@k, mean latency in ms) triples.
+    """
+
+    exact = []
+    start = time.time()
+    for q in queries:
+        exact.append(set(d for d, s in engine.search(q, k)))
+    end = time.time()
+    report = [('exact', 1.0, (end - start) * 1000 / len(queries))]
+
+    for nprobe in nprobes:
+        hits = 0
+        relevant = 0
+        start = time.time()
+        for q, truth in zip(queries, exact):
+            res = ivf.search(q, k, nprobe)
+            hits += len(truth.intersection(d for d, s in res))
+            relevant += len(truth)
+        end = time.time()
+        report.append(('nprobe={0}'.format(nprobe),
+                       hits / max(relevant, 1),
+                       (end - start) * 1000 / len(queries)))
+    return report
+
+
+if __name__ == '__main__':
+    """ Build the search engine + IVF index and report recall vs latency as
+    well as the benchmark quality of exact latent space search. """
+
+    if len(sys.argv) != 5:
+        print('Usage: python3 lsi_search.py <recs> <k> <m> <benchmark>')
+        sys.exit()
+
+    recFileName = sys.argv[1]
+    k = int(sys.argv[2])
+    m = int(sys.argv[3])
+    bmFileName = sys.argv[4]
+
+    print('Building inverted index ...')
+    with open(recFileName) as f:
+        ii = InvertedIndex(f, 1.75, 0.3)
+    ii.setStopwords(loadStopwords())
+    ii.preprocessVsm(m)
+    ii.preprocessLsi(k)
+    print('done')
+
+    engine = LsiSearchEngine(ii)
+    numLists = max(1, int(numpy.sqrt(engine.docVecs.shape[0])))
+    start = time.time()
+    ivf = IvfIndex(engine, numLists, seed=0)
+    end = time.time()
+    print('IVF build time ({0} lists): {1:.2f}s'.format(numLists, end-start))
+
+    with open(bmFileName) as f:
+        queries = [line.split('\t')[0] for line in f]
+    print('\nRecall@10 vs latency:')
+    for label, recall, latency in recallReport(engine, ivf, queries, 10,
+                                               [1, 2, 4, 8, 16, 32]):
+        print('{0:>10}: recall {1:.3f} | {2:.3f}ms/query'.format(
+            label, recall, latency))
+
+    eb = EvaluateBenchmark()
+    mpAt3, mpAtR, mAp = eb.evaluate(
+        bmFileName, lambda q: engine.search(q, ii.numDocs))
+    print('\nMP@3 {0:.2f} | MP@R {1:.2f} | MAP: {2:.2f}'.format(
+        mpAt3, mpAtR, mAp))
@@ -0,0 +1,296 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import array
+import bisect
+import heapq
+import sys
+import time
+from lsi import EvaluateBenchmark, InvertedIndex
+from tokenizer import loadStopwords
+
+
+def encodeDeltas(positions, out):
+    """ Append the gaps between the given sorted positions (the first one
+    relative to 0) to the bytearray out, as variable length integers with
+    7 bits per byte.
+
+    >>> out = bytearray()
+    >>> encodeDeltas([3, 5, 300], out)
+    >>> list(out)
+    [3, 2, 167, 2]
+    >>> decodeDeltas(out, 0, len(out))
+    [3, 5, 300]
+    """
+
+    prev = 0
+    for pos in positions:
+        delta = pos - prev
+        prev = pos
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+
+
+def decodeDeltas(data, start, end):
+    """ Return the positions encoded in data[start:end] by encodeDeltas. """
+
+    positions = []
+    pos = 0
+    delta = 0
+    shift = 0
+    for i in range(start, end):
+        byte = data[i]
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            pos += delta
+            positions.append(pos)
+            delta = 0
+            shift = 0
+    return positions
+
+
+def minSpan(positionLists):
+    """ Return the length (in words) of the smallest window that contains a
+    position of each of the given sorted lists.
+
+    >>> minSpan([[0, 9], [4, 10], [7]])
+    4
+    >>> minSpan([[5]])
+    1
+    """
+
+    heap = [(positions[0], i, 0) for i, positions in enumerate(positionLists)]
+    heapq.heapify(heap)
+    maxPos = max(pos for pos, i, j in heap)
+    best = maxPos - heap[0][0] + 1
+    while True:
+        pos, i, j = heapq.heappop(heap)
+        best = min(best, maxPos - pos + 1)
+        if j + 1 == len(positionLists[i]):
+            return best
+        nextPos = positionLists[i][j + 1]
+        maxPos = max(maxPos, nextPos)
+        heapq.heappush(heap, (nextPos, i, j + 1))
+
+
+class PositionalIndex:
+    """ Word positions of the postings of an InvertedIndex, for phrase and
+    proximity queries. The positions of the postings of a term are delta
+    coded into one bytearray per term; an offset array parallel to the
+    term's inverted list points to the positions of each posting. """
+
+    def __init__(self, ii):
+        r""" Collect the positions for the InvertedIndex ii (from the lines
+        stored in ii.records).
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> pi = PositionalIndex(ii)
+        >>> surfing = ii.vocab.get('surfing')
+        >>> [pi.positions(surfing, i) for i in range(4)]
+        [[2], [1], [1], [2, 3]]
+        >>> web = ii.vocab.get('web')
+        >>> pi.postingIndex(surfing, 3), pi.postingIndex(web, 1)
+        (3, -1)
+        """
+
+        self.ii = ii
+        numTerms = len(ii.invertedLists)
+        self.data = [bytearray() for i in range(numTerms)]
+        self.offsets = [array.array('q', [0]) for i in range(numTerms)]
+        for recId, record in ii.records.items():
+            termPositions = {}
+            words = ii.tokenizer.tokenize(record['line'])
+            for pos, word in enumerate(words):
+                termId = ii.vocab.get(word)
+                if termId not in termPositions:
+                    termPositions[termId] = []
+                termPositions[termId].append(pos)
+            """ Records are visited in ID order, as in the inverted lists. """
+            for termId, positions in termPositions.items():
+                encodeDeltas(positions, self.data[termId])
+                self.offsets[termId].append(len(self.data[termId]))
+
+    def positions(self, termId, i):
+        """ Return the positions of the i-th posting of the term. """
+
+        offsets = self.offsets[termId]
+        return decodeDeltas(self.data[termId], offsets[i], offsets[i + 1])
+
+    def postingIndex(self, termId, recId):
+        """ Return the index of the posting of the record in the inverted
+        list of the term, -1 if the record does not contain the term. """
+
+        invList = self.ii.invertedLists[termId]
+        i = bisect.bisect_left(invList, (recId,))
+        if i < len(invList) and invList[i][0] == recId:
+            return i
+        return -1
+
+    def queryTermIds(self, q, removeStopwords):
+        """ Return the term IDs of the words of the query (None for unknown
+        words). """
+
+        words = self.ii.tokenizer.tokenize(q)
+        if removeStopwords:
+            words = [w for w in words if w not in self.ii.stopwords]
+        return [self.ii.vocab.get(w) for w in words]
+
+    def matches(self, termIds):
+        """ Yield (record ID, list of posting indices) for the records that
+        contain all of the given terms. """
+
+        invLists = self.ii.invertedLists
+        rarest = min(termIds, key=lambda t: len(invLists[t]))
+        for recId, score in invLists[rarest]:
+            indices = [self.postingIndex(t, recId) for t in termIds]
+            if min(indices) >= 0:
+                yield recId, indices
+
+    def score(self, termIds, indices):
+        """ Sum of the BM25 scores of the given postings. """
+
+        invLists = self.ii.invertedLists
+        return round(sum(invLists[t][i][1] for t, i in zip(termIds, indices)),
+                     4)
+
+    def phraseQuery(self, q):
+        r""" Return the (record ID, BM25 score) pairs of the records that
+        contain the words of q as a phrase, sorted by score. Stopwords are
+        part of the phrase.
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> pi = PositionalIndex(ii)
+        >>> pi.phraseQuery('web surfing')
+        [(2, 1.1355), (0, 0.9437), (3, 0.7054)]
+        >>> pi.phraseQuery('surfing web'), pi.phraseQuery('web foo')
+        ([], [])
+        """
+
+        termIds = self.queryTermIds(q, False)
+        if len(termIds) == 0 or None in termIds:
+            return []
+        result = []
+        for recId, indices in self.matches(termIds):
+            """ Start positions of the phrase: for the i-th word pos - i. """
+            starts = None
+            for i, (termId, j) in enumerate(zip(termIds, indices)):
+                shifted = set(pos - i for pos in self.positions(termId, j))
+                starts = shifted if starts is None else starts & shifted
+                if len(starts) == 0:
+                    break
+            if len(starts) > 0:
+                result.append((recId, self.score(termIds, indices)))
+        return sorted(result, key=lambda x: -x[1])
+
+    def proximityQuery(self, q, window):
+        r""" Return the (record ID, BM25 score) pairs of the records that
+        contain all (non stopword) words of q within window consecutive
+        words, sorted by score.
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> pi = PositionalIndex(ii)
+        >>> pi.proximityQuery('internet surfing', 2)
+        [(1, 1.1355)]
+        >>> pi.proximityQuery('surfing internet', 3)
+        [(1, 1.1355), (0, 0.9437), (3, 0.7054)]
+        """
+
+        termIds = list(dict.fromkeys(self.queryTermIds(q, True)))
+        if len(termIds) == 0 or None in termIds:
+            return []
+        result = []
+        for recId, indices in self.matches(termIds):
+            positionLists = [self.positions(t, i)
+                             for t, i in zip(termIds, indices)]
+            if minSpan(positionLists) <= window:
+                result.append((recId, self.score(termIds, indices)))
+        return sorted(result, key=lambda x: -x[1])
+
+    def processQuery(self, q, topN=100, weight=1.0):
+        r""" BM25 query (see InvertedIndex.processQuery) whose topN results
+        are rescored: records that contain n > 1 of the query words within a
+        window of s words get weight * (n - 1) / (s - 1) added to the score,
+        i.e. up to weight for adjacent words. Only topN records are looked
+        at, so the cost of the rescoring is bounded.
+
+        >>> import io
+        >>> txt = 'web surfing\nsurfing the web\nweb and more surfing'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> ii.processQuery('surfing web')
+        [(0, 0.0), (1, 0.0), (2, 0.0)]
+        >>> PositionalIndex(ii).processQuery('surfing web')
+        [(0, 1.0), (1, 0.5), (2, 0.3333)]
+        >>> PositionalIndex(ii).processQuery('Surfing, web.')
+        [(0, 1.0), (1, 0.5), (2, 0.3333)]
+        """
+
+        # the base ranking gets the same keywords as the rescoring
+        q = ' '.join(self.ii.tokenizer.tokenize(q))
+        result = self.ii.processQuery(q)
+        termIds = [t for t in dict.fromkeys(self.queryTermIds(q, True))
+                   if t is not None]
+        if len(termIds) < 2:
+            return result
+
+        rescored = []
+        for recId, score in result[0:topN]:
+            positionLists = []
+            for termId in termIds:
+                i = self.postingIndex(termId, recId)
+                if i >= 0:
+                    positionLists.append(self.positions(termId, i))
+            if len(positionLists) > 1:
+                span = minSpan(positionLists)
+                score = round(score + weight * (len(positionLists) - 1) /
+                              (span - 1), 4)
+            rescored.append((recId, score))
+        """ Rescoring only increases scores, the rest stays behind. """
+        return sorted(rescored, key=lambda x: -x[1]) + result[topN:]
+
+
+if __name__ == '__main__':
+    """ Compare BM25 with BM25 + proximity rescoring on a benchmark. """
+
+    if len(sys.argv) != 3:
+        print('Usage: python3 positional.py <recs> <benchmark>')
+        sys.exit()
+
+    recFileName = sys.argv[1]
+    bmFileName = sys.argv[2]
+
+    print('Building inverted index ...')
+    with open(recFileName) as f:
+        ii = InvertedIndex(f, 1.75, 0.3)
+    ii.setStopwords(loadStopwords())
+    start = time.time()
+    pi = PositionalIndex(ii)
+    end = time.time()
+    print('done, positions collected in {0:.2f}s ({1} bytes)'.format(
+        end-start, sum(len(data) for data in pi.data)))
+
+    eb = EvaluateBenchmark()
+    for label, processQuery in [('BM25', ii.processQuery),
+                                ('BM25 + proximity', pi.processQuery)]:
+        start = time.time()
+        mpAt3, mpAtR, mAp = eb.evaluate(bmFileName, processQuery)
+        end = time.time()
+        print('{0}: MP@3 {1:.2f} | MP@R {2:.2f} | MAP: {3:.2f} | '
+              '{4:.2f}s'.format(label, mpAt3, mpAtR, mAp, end-start))
@@ -0,0 +1,304 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import argparse
+import asyncio
+import bisect
+import gc
+import mmap
+import numpy
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from search_server import SearchServer, addIndexArguments, loadCompleter, \
+    loadIndex
+
+# upper bounds (in ms) of the latency histogram buckets, the last one is open
+_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')]
+# columns of a worker's row in the SharedStats table
+_PID, _STARTED, _HEARTBEAT, _REQUESTS, _ERRORS, _LATENCY_SUM, _RESTARTS, \
+    _HISTOGRAM = range(8)
+_COLUMNS = _HISTOGRAM + len(_BUCKETS_MS)
+
+
+class SharedStats:
+    """ Health and latency statistics of the workers of a pre-fork server,
+    kept in an anonymous shared memory map so that the supervisor and every
+    worker see the rows of all workers. Each row is only written by its
+    worker (and by the supervisor while the worker is not running), so no
+    locking is needed. """
+
+    def __init__(self, numWorkers, staleAfter=5.0):
+        """ Create the (zeroed) table for numWorkers workers. A worker whose
+        last heartbeat is older than staleAfter seconds is reported as
+        stale. """
+
+        self.numWorkers = numWorkers
+        self.staleAfter = staleAfter
+        self.mmap = mmap.mmap(-1, numWorkers * _COLUMNS * 8)
+        self.table = numpy.frombuffer(self.mmap, dtype=numpy.float64).reshape(
+            numWorkers, _COLUMNS)
+        self.worker = None
+
+    def attach(self, worker, pid):
+        """ Start the statistics of the given worker (called in the worker
+        process, record and heartbeat then update its row). Counters of a
+        previous process of the same worker are reset. """
+
+        self.worker = worker
+        row = self.table[worker]
+        row[_REQUESTS:_RESTARTS] = 0
+        row[_HISTOGRAM:] = 0
+        row[_STARTED] = time.time()
+        row[_HEARTBEAT] = row[_STARTED]
+        row[_PID] = pid
+
+    def detach(self, worker, restarted=False):
+        """ Mark the given worker as not running. """
+
+        self.table[worker, _PID] = 0
+        if restarted:
+            self.table[worker, _RESTARTS] += 1
+
+    def heartbeat(self):
+        self.table[self.worker, _HEARTBEAT] = time.time()
+
+    def record(self, seconds, error):
+        """ Count one request of the attached worker that took the given
+        number of seconds. """
+
+        row = self.table[self.worker]
+        row[_REQUESTS] += 1
+        if error:
+            row[_ERRORS] += 1
+        row[_LATENCY_SUM] += seconds
+        row[_HISTOGRAM + bisect.bisect_left(_BUCKETS_MS, seconds * 1000)] += 1
+
+    def report(self, now=None):
+        """ Return a list with a dict of statistics per worker. Latency
+        percentiles are the upper bounds of the histogram buckets they fall
+        into (None for the open last bucket).
+
+        >>> stats = SharedStats(2)
+        >>> stats.attach(0, 123)
+        >>> for ms in [0.3, 0.8, 3, 3, 40]:
+        ...     stats.record(ms / 1000, False)
+        >>> stats.record(2, True)
+        >>> report = stats.report()
+        >>> [report[0][key] for key in ['pid', 'status', 'requests', 'errors',
+        ...                             'p50Ms', 'p95Ms', 'p99Ms']]
+        [123, 'ok', 6, 1, 5, None, None]
+        >>> report[1]['status'], report[1]['requests']
+        ('dead', 0)
+        >>> stats.report(now=time.time() + 10)[0]['status']
+        'stale'
+        >>> stats.detach(0, restarted=True)
+        >>> stats.report()[0]['status'], stats.report()[0]['restarts']
+        ('dead', 1)
+        """
+
+        if now is None:
+            now = time.time()
+        report = []
+        for worker, row in enumerate(self.table.copy()):
+            requests = int(row[_REQUESTS])
+            if row[_PID] == 0:
+                status = 'dead'
+            elif now - row[_HEARTBEAT] > self.staleAfter:
+                status = 'stale'
+            else:
+                status = 'ok'
+            stats = {'worker': worker, 'pid': int(row[_PID]),
+                     'status': status,
+                     'uptime': round(now - row[_STARTED], 3)
+                     if row[_PID] != 0 else 0,
+                     'restarts': int(row[_RESTARTS]),
+                     'requests': requests, 'errors': int(row[_ERRORS]),
+                     'meanMs': round(row[_LATENCY_SUM] * 1000 /
+                                     max(requests, 1), 3)}
+            cumulative = numpy.cumsum(row[_HISTOGRAM:])
+            for q in [50, 95, 99]:
+                bound = None
+                if requests > 0:
+                    i = numpy.searchsorted(cumulative, requests * q / 100)
+                    bound = _BUCKETS_MS[i]
+                stats['p{0}Ms'.format(q)] = \
+                    None if bound == float('inf') else bound
+            report.append(stats)
+        return report
+
+
+def runWorker(ii, sock, stats, worker, serverArgs, heartbeatInterval=1.0):
+    """ Serve requests accepted on the shared listening socket until SIGTERM
+    (called in a forked worker process). """
+
+    stats.attach(worker, os.getpid())
+
+    async def serve():
+        server = SearchServer(ii, monitor=stats, **serverArgs)
+        await server.start(sock=sock)
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM,
+                                                      stop.set)
+        while not stop.is_set():
+            stats.heartbeat()
+            try:
+                await asyncio.wait_for(stop.wait(), heartbeatInterval)
+            except asyncio.TimeoutError:
+                pass
+        await server.close()
+
+    asyncio.run(serve())
+
+
+class Supervisor:
+    """ Pre-fork server: the index is loaded once in the supervisor process,
+    which then forks the workers. They share the index memory copy-on-write
+    (and the memory mapped LSI factors of a loaded model) and all accept
+    connections on one listening socket, so the kernel dispatches the
+    connections to idle workers. Workers that die are restarted. """
+
+    def __init__(self, ii, sock, numWorkers, serverArgs=None,
+                 heartbeatInterval=1.0):
+        r""" Create the supervisor for the (loaded) index ii and the bound
+        and listening socket sock. serverArgs are passed to the SearchServer
+        of each worker.
+
+        >>> import asyncio, io
+        >>> from lsi import InvertedIndex
+        >>> from load_test import loadTest
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> ii.preprocessVsm(4)
+        >>> sock = socket.create_server(('127.0.0.1', 0))
+        >>> supervisor = Supervisor(ii, sock, 2, {'ranker': 'vsm'})
+        >>> supervisor.start()
+        >>> stats = asyncio.run(loadTest('127.0.0.1', sock.getsockname()[1],
+        ...                              ['web', 'beach'], 100, 4))
+        >>> stats['requests'], stats['errors']
+        (100, 0)
+        >>> report = supervisor.stats.report()
+        >>> [r['status'] for r in report], sum(r['requests'] for r in report)
+        (['ok', 'ok'], 100)
+        >>> supervisor.stop()
+        >>> supervisor.run()
+        >>> [r['status'] for r in supervisor.stats.report()]
+        ['dead', 'dead']
+        >>> sock.close()
+        """
+
+        self.ii = ii
+        self.sock = sock
+        self.numWorkers = numWorkers
+        self.serverArgs = serverArgs or {}
+        self.heartbeatInterval = heartbeatInterval
+        self.stats = SharedStats(numWorkers, staleAfter=5 * heartbeatInterval)
+        self.pids = {}  # pid -> worker
+        self.startTimes = [0] * numWorkers
+        self.stopping = False
+
+    def start(self):
+        """ Fork all workers. """
+
+        # Move the objects of the index out of the generations the garbage
+        # collector scans, so that the workers do not touch (and copy) their
+        # pages. Reference count updates still copy the pages of the objects
+        # used by a query.
+        gc.collect()
+        gc.freeze()
+        for worker in range(self.numWorkers):
+            self.fork(worker)
+
+    def fork(self, worker):
+        self.startTimes[worker] = time.time()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                runWorker(self.ii, self.sock, self.stats, worker,
+                          self.serverArgs, self.heartbeatInterval)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.pids[pid] = worker
+
+    def stop(self, *args):
+        """ Terminate all workers (usable as signal handler). """
+
+        self.stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """ Wait for the workers, restart those that die until stop was
+        called. Return when all workers have exited. """
+
+        while len(self.pids) > 0:
+            pid, status = os.wait()
+            if pid not in self.pids:
+                continue
+            worker = self.pids.pop(pid)
+            restart = not self.stopping
+            self.stats.detach(worker, restart)
+            if restart:
+                print('Worker {0} (pid {1}) died with status {2}, '
+                      'restarting'.format(worker, pid, status))
+                # do not busy loop if a worker dies right away
+                if time.time() - self.startTimes[worker] < 1:
+                    time.sleep(1)
+                if not self.stopping:
+                    self.fork(worker)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Pre-fork HTTP/JSON search server: the index is loaded '
+                    'once and shared by --processes worker processes '
+                    '(GET /search?q=...&k=10, GET /complete?q=...&k=10, '
+                    'GET /health, GET /metrics).')
+    addIndexArguments(parser)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='queries processed at a time per worker')
+    parser.add_argument('--max-batch', dest='maxBatch', type=int, default=32)
+    parser.add_argument('--max-wait-ms', dest='maxWait', type=float,
+                        default=2.0)
+    args = parser.parse_args(argv)
+    ii = loadIndex(parser, args)
+    completer = loadCompleter(parser, args, ii)
+
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    serverArgs = {'ranker': args.ranker, 'lam': args.lam,
+                  'concurrency': args.concurrency, 'maxBatch': args.maxBatch,
+                  'maxWait': args.maxWait / 1000, 'completer': completer}
+    supervisor = Supervisor(ii, sock, args.processes, serverArgs)
+    supervisor.start()
+    print('Listening on port {0} with {1} workers'.format(
+        sock.getsockname()[1], args.processes))
+    signal.signal(signal.SIGINT, supervisor.stop)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    supervisor.run()
+    sock.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
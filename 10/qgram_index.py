@@ -0,0 +1,359 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import array
+import numpy
+import re
+import sys
+import time
+from lsi import InvertedIndex
+from tokenizer import loadStopwords
+
+_NON_WORD = re.compile(r'\W')
+_CHAR_COLUMNS = 16  # characters per word kept in QGramIndex.chars
+
+
+class QGramIndex:
+    """ Error tolerant prefix search over a list of words (e.g. the
+    vocabulary of an InvertedIndex), as in sheet 05. The inverted list of a
+    q-gram is a slice of one array of word IDs. """
+
+    def __init__(self, q=3):
+        self.q = q
+        self.padding = '$' * (q - 1)
+        self.words = []
+        self.normalized = []  # normalized words (for the PED computation)
+        self.lengths = numpy.zeros(0, dtype=numpy.int32)
+        self.chars = numpy.zeros((0, _CHAR_COLUMNS), dtype=numpy.uint16)
+        self.scores = numpy.zeros(0, dtype=numpy.int64)
+        self.qgramIds = {}  # q-gram -> index of its inverted list
+        self.listOffsets = numpy.zeros(1, dtype=numpy.int64)
+        self.listWordIds = numpy.zeros(0, dtype=numpy.int32)
+        self.listPositions = numpy.zeros(0, dtype=numpy.int16)
+
+    def normalize(self, word):
+        return _NON_WORD.sub('', word.lower())
+
+    def qgrams(self, word):
+        """ Return the q-grams of the normalized, left padded word.
+
+        >>> QGramIndex(3).qgrams('lirum')
+        ['$$l', '$li', 'lir', 'iru', 'rum']
+        """
+
+        padded = self.padding + self.normalize(word)
+        return [padded[i:i + self.q] for i in range(len(padded) - self.q + 1)]
+
+    def build(self, words, scores):
+        r""" Build the index for the given words (word ID = position in the
+        list) and scores (higher = better).
+
+        >>> qgi = QGramIndex(3)
+        >>> qgi.build(['Football', 'foobar', 'Footsal', 'Foot Barca'],
+        ...           [3, 1, 2, 1])
+        >>> len(qgi.qgramIds)
+        16
+        >>> [qgi.invertedList(qgram).tolist() for qgram in ['$fo', 'oot']]
+        [[0, 1, 2, 3], [0, 2, 3]]
+        """
+
+        self.words = list(words)
+        self.normalized = []
+        self.scores = numpy.asarray(scores, dtype=numpy.int64)
+        self.qgramIds = {}
+        listIds = array.array('i')
+        wordIds = array.array('i')
+        positions = array.array('h')
+        for wordId, word in enumerate(self.words):
+            normalized = self.normalize(word)
+            self.normalized.append(word if normalized == word else normalized)
+            for pos, qgram in enumerate(self.qgrams(normalized)):
+                listId = self.qgramIds.setdefault(qgram, len(self.qgramIds))
+                listIds.append(listId)
+                wordIds.append(wordId)
+                positions.append(min(pos, 0x7fff))
+
+        self.lengths = numpy.array([len(word) for word in self.normalized],
+                                   dtype=numpy.int32)
+        self.chars = self.charCodes(self.normalized, _CHAR_COLUMNS)
+        if len(self.words) == 0 or self.chars.max() <= 0xffff:
+            self.chars = self.chars.astype(numpy.uint16)
+
+        """ Group the word IDs by q-gram, stable so that lists are sorted. """
+        listIds = numpy.frombuffer(listIds, dtype=numpy.int32)
+        order = numpy.argsort(listIds, kind='stable')
+        self.listWordIds = numpy.frombuffer(wordIds, dtype=numpy.int32)[order]
+        self.listPositions = numpy.frombuffer(positions,
+                                              dtype=numpy.int16)[order]
+        self.listOffsets = numpy.zeros(len(self.qgramIds) + 1,
+                                       dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(listIds, minlength=len(self.qgramIds)),
+                     out=self.listOffsets[1:])
+
+    def buildFromFile(self, fileName):
+        """ Build the index from a file with one word<TAB>score per line. """
+
+        words = []
+        scores = []
+        with open(fileName) as f:
+            for line in f:
+                columns = line.rstrip('\n').split('\t')
+                words.append(columns[0])
+                scores.append(int(columns[1]))
+        self.build(words, scores)
+
+    @staticmethod
+    def fromVocabulary(vocab, q=3):
+        """ Return the index for the terms of the Vocabulary vocab, scored by
+        their df. Word IDs are term IDs. """
+
+        qgi = QGramIndex(q)
+        qgi.build(vocab.terms(), vocab.dfArray())
+        return qgi
+
+    def invertedList(self, qgram, positions=False):
+        """ Return the array of IDs of the words with the q-gram (and the
+        array of the positions of the q-gram in them if positions is True).
+        """
+
+        listId = self.qgramIds.get(qgram)
+        start, end = 0, 0
+        if listId is not None:
+            start, end = self.listOffsets[listId:listId + 2]
+        if positions:
+            return self.listWordIds[start:end], self.listPositions[start:end]
+        return self.listWordIds[start:end]
+
+    def computeUnion(self, qgrams, maxShift=None):
+        """ Return the IDs of the words that have any of the given q-grams
+        and the number of q-grams each of them has (both as arrays). If
+        maxShift is given, the i-th q-gram only counts for words that have it
+        at a position in [i - maxShift, i + maxShift].
+
+        >>> qgi = QGramIndex(3)
+        >>> qgi.build(['foot', 'bar', 'boot'], [1, 1, 1])
+        >>> [a.tolist() for a in qgi.computeUnion(['$$f', 'oot', 'xyz'])]
+        [[0, 2], [2, 1]]
+        >>> [a.tolist() for a in qgi.computeUnion(['oot'], maxShift=1)]
+        [[], []]
+        """
+
+        if maxShift is None:
+            lists = [self.invertedList(qgram) for qgram in qgrams]
+        else:
+            lists = []
+            for i, qgram in enumerate(qgrams):
+                wordIds, positions = self.invertedList(qgram, True)
+                lists.append(wordIds[numpy.abs(positions - i) <= maxShift])
+        union = numpy.sort(numpy.concatenate(lists + [self.listWordIds[0:0]]))
+        if len(union) == 0:
+            return union, numpy.zeros(0, dtype=numpy.int64)
+        starts = numpy.flatnonzero(numpy.diff(union)) + 1
+        starts = numpy.concatenate(([0], starts))
+        counts = numpy.diff(numpy.append(starts, len(union)))
+        return union[starts], counts
+
+    def prefixEditDistance(self, prefix, word, delta):
+        """ Return the prefix edit distance of the prefix to the word
+        (minimal edit distance to any prefix of the word), delta + 1 if it
+        is larger than delta.
+
+        >>> qgi = QGramIndex(3)
+        >>> qgi.prefixEditDistance('foot', 'football', 1)
+        0
+        >>> qgi.prefixEditDistance('foot', 'foobar', 1)
+        1
+        >>> qgi.prefixEditDistance('woob', 'foobar', 1)
+        1
+        >>> qgi.prefixEditDistance('abcd', 'xyz', 2)
+        3
+        """
+
+        numCols = min(len(word), len(prefix) + delta)
+        prev = list(range(numCols + 1))
+        for i in range(1, len(prefix) + 1):
+            char = prefix[i - 1]
+            curr = [i]
+            for j in range(1, numCols + 1):
+                curr.append(min(prev[j] + 1, curr[j - 1] + 1,
+                                prev[j - 1] + (char != word[j - 1])))
+            """ Values in a row never drop below the row minimum. """
+            if min(curr) > delta:
+                return delta + 1
+            prev = curr
+        return min(min(prev), delta + 1)
+
+    def charCodes(self, words, numCols):
+        """ Return the matrix of the code points of the first numCols
+        characters of the words (0 for missing characters). """
+
+        chars = numpy.array(words, dtype='<U{0}'.format(max(numCols, 1)))
+        return chars.view(numpy.int32).reshape(len(words), max(numCols, 1))
+
+    def prefixEditDistances(self, prefix, wordIds, delta):
+        """ Return the array of prefix edit distances (capped at delta + 1)
+        of the normalized prefix to the words with the given IDs. The
+        dynamic program runs on all words at once, one cell at a time.
+
+        >>> qgi = QGramIndex(3)
+        >>> qgi.build(['Football', 'foobar', 'xyz', 'fo'], [1, 1, 1, 1])
+        >>> qgi.prefixEditDistances('foot', [0, 1, 2, 3], 1).tolist()
+        [0, 1, 2, 2]
+        """
+
+        numCols = len(prefix) + delta
+        wordIds = numpy.asarray(wordIds, dtype=numpy.int64)
+        lengths = self.lengths[wordIds]
+        if numCols <= _CHAR_COLUMNS:
+            chars = self.chars[wordIds, 0:numCols]
+        else:
+            words = [self.normalized[wordId] for wordId in wordIds.tolist()]
+            chars = self.charCodes(words, numCols)
+        """ Values are capped at delta + 1, so only the band of cells within
+        delta of the diagonal has to be computed. """
+        cap = delta + 1
+        prev = numpy.minimum(numpy.arange(numCols + 1, dtype=numpy.int16),
+                             cap)
+        prev = numpy.tile(prev, (len(wordIds), 1))
+        for i in range(1, len(prefix) + 1):
+            code = ord(prefix[i - 1])
+            curr = numpy.full_like(prev, cap)
+            curr[:, 0] = min(i, cap)
+            for j in range(max(1, i - delta), min(numCols, i + delta) + 1):
+                val = prev[:, j - 1] + (chars[:, j - 1] != code)
+                numpy.minimum(val, prev[:, j] + 1, out=val)
+                numpy.minimum(val, curr[:, j - 1] + 1, out=val)
+                numpy.minimum(val, cap, out=curr[:, j])
+            prev = curr
+
+        """ Only prefixes of the words count, not the padding. """
+        cols = numpy.arange(numCols + 1)
+        prev[cols[numpy.newaxis, :] > lengths[:, numpy.newaxis]] = cap
+        return prev.min(axis=1)
+
+    def findMatches(self, prefix, delta):
+        r""" Return the (word ID, score, PED) triples of all words to which
+        the prefix edit distance of the prefix is at most delta. A word like
+        this shares at least len(prefix) - q * delta q-grams with the prefix
+        (at positions shifted by at most delta), only words that do are
+        checked.
+
+        >>> qgi = QGramIndex(3)
+        >>> qgi.build(['Football', 'foobar', 'Footsal', 'Foot Barca'],
+        ...           [3, 1, 2, 1])
+        >>> sorted(qgi.findMatches('foot', 1))
+        [(0, 3, 0), (1, 1, 1), (2, 2, 0), (3, 1, 0)]
+        >>> qgi.findMatches('woob', 1)
+        [(1, 1, 1)]
+        """
+
+        prefix = self.normalize(prefix)
+        threshold = len(prefix) - self.q * delta
+        if threshold > 0:
+            wordIds, counts = self.computeUnion(self.qgrams(prefix), delta)
+            candidates = wordIds[counts >= threshold]
+        else:
+            candidates = numpy.arange(len(self.words))
+        """ Words shorter than that have a larger PED. """
+        candidates = candidates[self.lengths[candidates] >=
+                                len(prefix) - delta]
+        if len(candidates) == 0:
+            return []
+
+        peds = self.prefixEditDistances(prefix, candidates, delta)
+        isMatch = peds <= delta
+        return list(zip(candidates[isMatch].tolist(),
+                        self.scores[candidates[isMatch]].tolist(),
+                        peds[isMatch].tolist()))
+
+    def sortResult(self, matches):
+        """ Sort (word ID, score, PED) triples by PED, then by score
+        (descending).
+
+        >>> QGramIndex(3).sortResult([(1, 3, 3), (2, 4, 2), (3, 1, 6),
+        ...                           (4, 2, 3), (5, 5, 6)])
+        [(2, 4, 2), (1, 3, 3), (4, 2, 3), (5, 5, 6), (3, 1, 6)]
+        """
+
+        return sorted(matches, key=lambda x: (x[2], -x[1]))
+
+    def correctQuery(self, q, ii, delta=1):
+        r""" Return the query with each keyword that is not in the vocabulary
+        of the InvertedIndex ii (and no stopword of it) replaced by its best
+        match, so that it can be passed to the rankers of ii. The keywords
+        are the tokens of ii's tokenizer. Keywords without match and
+        keywords of at most delta characters (which would match any word)
+        are kept.
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> qgi = QGramIndex.fromVocabulary(ii.vocab)
+        >>> qgi.correctQuery('Surfng intrnet web xyz', ii)
+        'surfing internet web xyz'
+        >>> ii.processQuery(qgi.correctQuery('beech', ii))[0]
+        (4, 1.1355)
+        >>> qgi.correctQuery('web  beach', ii)
+        'web beach'
+        >>> qgi.correctQuery('web beach ', ii)
+        'web beach'
+        >>> qgi.correctQuery('a', ii), qgi.correctQuery('', ii)
+        ('a', '')
+        """
+
+        keywords = []
+        for keyword in ii.tokenizer.tokenize(q):
+            if keyword in ii.vocab or keyword in ii.stopwords or \
+                    len(keyword) <= delta:
+                keywords.append(keyword)
+                continue
+            matches = self.sortResult(self.findMatches(keyword, delta))
+            if len(matches) > 0:
+                keyword = self.words[matches[0][0]]
+            keywords.append(keyword)
+        return ' '.join(keywords)
+
+
+if __name__ == '__main__':
+    """ Build the q-gram index over the vocabulary of a records file, report
+    the lookup time for misspelled vocabulary terms, then answer queries
+    (with corrected keywords) read from stdin. """
+
+    if len(sys.argv) != 2:
+        print('Usage: python3 qgram_index.py <recs>')
+        sys.exit()
+
+    print('Building inverted index ...')
+    with open(sys.argv[1]) as f:
+        ii = InvertedIndex(f, 1.75, 0.3)
+    ii.setStopwords(loadStopwords())
+    start = time.time()
+    qgi = QGramIndex.fromVocabulary(ii.vocab)
+    end = time.time()
+    print('done, q-gram index over {0} terms built in {1:.2f}s'.format(
+        len(ii.vocab), end-start))
+
+    """ Misspell frequent terms of length >= 5 by dropping a character. """
+    rng = numpy.random.RandomState(0)
+    terms = [t for t in ii.vocab.terms() if len(t) >= 5]
+    sample = rng.choice(len(terms), min(1000, len(terms)), replace=False)
+    typos = [terms[i][:2] + terms[i][3:] for i in sample]
+    if len(typos) > 0:
+        start = time.perf_counter()
+        for typo in typos:
+            qgi.findMatches(typo, 1)
+        end = time.perf_counter()
+        print('findMatches: {0:.3f}ms per term'.format(
+            (end - start) * 1000 / len(typos)))
+
+    for line in sys.stdin:
+        q = qgi.correctQuery(line, ii)
+        print('Query: {0}'.format(q))
+        for recId, score in ii.processQuery(q)[0:3]:
+            print('{0}\t{1}'.format(recId, score))
@@ -0,0 +1,116 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import argparse
+import sys
+import time
+from benchmark import latencyStats, runBenchmark
+from lsi import InvertedIndex
+from synthetic import addCorpusArguments, addScalingArguments, \
+    corpusParams, finishScaling, generateCorpus, generateQueries, \
+    phaseTimes, runScaling
+
+_RANKERS = ['bm25', 'vsm', 'lsi']
+
+
+def runLsi(numDocs, args):
+    """ Build the inverted index of a synthetic corpus of numDocs documents,
+    the term-document matrix and the LSI factors (as far as needed for the
+    requested rankers) and measure the query latency of each ranker. Return
+    a dict with the times, latencies and (with --memory) the memory usage.
+
+    >>> args = parseArgs(['--vocab', '1000', '--length', '20', '-k', '5',
+    ...                   '-m', '200', '--queries', '20', '--memory'])
+    >>> run = runLsi(500, args)
+    >>> sorted(run) # doctest: +NORMALIZE_WHITESPACE
+    ['buildSeconds', 'bytesPerDoc', 'bytesPerPosting', 'indexMb', 'latency',
+     'numPostings', 'numTerms', 'phases', 'svdSeconds', 'vsmSeconds']
+    >>> sorted(run['latency']), run['latency']['lsi']['wallTime'] > 0
+    (['bm25', 'lsi', 'vsm'], True)
+    >>> sorted(run['phases'])[0:3]
+    ['pass1', 'pass2', 'preprocess_lsi']
+    """
+
+    run = {}
+    start = time.perf_counter()
+    ii = InvertedIndex(generateCorpus(numDocs, **corpusParams(args)),
+                       args.bm25k, args.bm25b)
+    run['buildSeconds'] = round(time.perf_counter() - start, 3)
+    run['numTerms'] = len(ii.vocab)
+    run['numPostings'] = sum(len(invList) for invList in ii.invertedLists)
+
+    queries = generateQueries(args.queries, args.vocab, args.zipf, args.seed)
+    latency = {}
+    for ranker in args.rankers:
+        if ranker in ['vsm', 'lsi'] and ii.tdMatrix is None:
+            start = time.perf_counter()
+            ii.preprocessVsm(args.m)
+            run['vsmSeconds'] = round(time.perf_counter() - start, 3)
+        if ranker == 'lsi':
+            start = time.perf_counter()
+            ii.preprocessLsi(args.k, args.svd)
+            run['svdSeconds'] = round(time.perf_counter() - start, 3)
+        resultIds, latencies, wallTime = runBenchmark(ii, ranker, queries,
+                                                      topN=args.topN)
+        latency[ranker] = latencyStats(latencies, wallTime)
+    run['latency'] = latency
+    run['phases'] = phaseTimes()
+
+    if args.memory:
+        report = ii.memoryReport()
+        run['indexMb'] = round(report['total'] / 2 ** 20, 1)
+        run['bytesPerPosting'] = round(report['bytesPerPosting'], 1)
+        run['bytesPerDoc'] = round(report['bytesPerDoc'], 1)
+    return run
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description='Scaling benchmark on synthetic Zipfian corpora: build '
+                    'time, peak RSS, VSM and SVD preprocessing time and query '
+                    'latency per corpus size, written as JSON report.')
+    addCorpusArguments(parser)
+    addScalingArguments(parser)
+    parser.add_argument('--rankers', default='bm25,vsm,lsi',
+                        help='comma separated subset of ' + ','.join(
+                            _RANKERS))
+    parser.add_argument('-k', type=int, default=50, help='LSI dimensions')
+    parser.add_argument('-m', type=int, default=10000,
+                        help='terms in the term-document matrix')
+    parser.add_argument('--svd', choices=['arpack', 'randomized'],
+                        default='arpack', help='SVD backend')
+    parser.add_argument('--bm25k', type=float, default=1.75)
+    parser.add_argument('--bm25b', type=float, default=0.3)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--top-n', dest='topN', type=int, default=1000)
+    parser.add_argument('--memory', action='store_true',
+                        help='add the memory report of the index (slow for '
+                             'large corpora)')
+    args = parser.parse_args(argv)
+    args.rankers = args.rankers.split(',')
+    for ranker in args.rankers:
+        if ranker not in _RANKERS:
+            parser.error('unknown ranker {0}'.format(ranker))
+    return args
+
+
+def main(argv):
+    args = parseArgs(argv)
+    params = corpusParams(args)
+    params.update({'rankers': args.rankers, 'k': args.k, 'm': args.m,
+                   'svd': args.svd, 'bm25k': args.bm25k,
+                   'bm25b': args.bm25b, 'queries': args.queries,
+                   'topN': args.topN})
+    sizes = [int(size) for size in args.sizes.split(',')]
+    report = runScaling('lsi', lambda numDocs: runLsi(numDocs, args), sizes,
+                        params, args.timeout)
+    finishScaling(report, args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,509 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import io
+import json
+import multiprocessing
+import numpy
+import scipy.sparse
+import signal
+import sys
+import time
+import urllib.parse
+from autocomplete import _RANKINGS, Autocomplete
+from lsi import InvertedIndex, topK
+from metrics import METRICS, formatMemoryReport
+from tokenizer import loadStopwords
+
+_RANKERS = ['bm25', 'vsm', 'lsi', 'lsicomb']
+_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error'}
+_index = None  # index used by scoreBatchWorker in executor processes
+
+
+def scoreBatch(ii, queries, k, ranker='bm25', lam=0.67):
+    r""" Return the k best (record ID, score) pairs for each of the queries.
+    VSM and LSI queries are scored together with one matrix product, BM25
+    queries are merged one by one.
+
+    >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+    >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+    >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+    >>> ii.preprocessVsm(4)
+    >>> ii.preprocessLsi(2)
+    >>> queries = ['web surfing', 'beach']
+    >>> [r[0:2] for r in scoreBatch(ii, queries, 2, 'vsm')]
+    [[(2, 1.1355), (0, 0.9437)], [(4, 1.1355), (5, 1.1355)]]
+    >>> scoreBatch(ii, queries, 3, 'lsi')[0]
+    [(0, 0.944), (3, 0.705), (1, 0.568)]
+    >>> scoreBatch(ii, queries, 1, 'bm25')
+    [[(2, 1.1355)], [(4, 1.1355)]]
+    """
+
+    if ranker == 'bm25':
+        return [ii.processQuery(q)[0:k] for q in queries]
+    Q = scipy.sparse.vstack([ii.prepareQueryMatrix(q) for q in queries],
+                            format='csr')
+    if ranker == 'vsm':
+        scores = (Q * ii.tdMatrix).toarray()
+    else:
+        lsiScores = numpy.asarray(Q * ii.UkSk).dot(ii.Vk)
+        if ranker == 'lsi':
+            # rounded as in InvertedIndex.processQueryLsi
+            scores = numpy.round(lsiScores, 3)
+        else:
+            scores = lam * (Q * ii.tdMatrix).toarray() + (1 - lam) * lsiScores
+    results = []
+    for row in scores:
+        best = topK(row, k)
+        results.append(list(zip(best.tolist(), row[best].tolist())))
+    return results
+
+
+def scoreBatchWorker(queries, k, ranker, lam):
+    """ scoreBatch with the index inherited from the parent process (for
+    process executors). """
+
+    return scoreBatch(_index, queries, k, ranker, lam)
+
+
+class MicroBatcher:
+    """ Class for coalescing concurrently submitted queries into batches,
+    which are scored together in an executor. """
+
+    def __init__(self, scoreFn, executor, maxBatch=32, maxWait=0.002,
+                 parallelism=1):
+        """ scoreFn(queries, k) is called in the executor and must return
+        one result list per query. A batch is closed when it has maxBatch
+        queries or maxWait seconds passed since its first query. At most
+        parallelism batches are scored at the same time; while all are
+        busy, new queries queue up and form bigger batches.
+        """
+
+        self.scoreFn = scoreFn
+        self.executor = executor
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+        self.parallelism = parallelism
+        self.numBatches = 0
+        self.numQueries = 0
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        """ Start collecting batches (needs a running event loop). """
+
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.parallelism)
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def submit(self, query, k):
+        """ Queue the query and return its k best results once its batch was
+        scored. """
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, k, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.maxWait
+            while len(batch) < self.maxBatch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+            asyncio.ensure_future(self.score(batch))
+
+    async def score(self, batch):
+        """ Score a batch in the executor and resolve its futures. """
+
+        try:
+            queries = [query for query, k, future in batch]
+            maxK = max(k for query, k, future in batch)
+            self.numBatches += 1
+            self.numQueries += len(batch)
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.scoreFn, queries, maxK)
+            except Exception as e:
+                for query, k, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            for (query, k, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result[0:k])
+        finally:
+            self.slots.release()
+
+
+async def readResponse(reader):
+    """ Read an HTTP response with a Content-Length header. Return the status
+    code and the body. """
+
+    statusLine = await reader.readline()
+    if len(statusLine) == 0:
+        raise ConnectionError('connection closed')
+    status = int(statusLine.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+class SearchServer:
+    """ Class for an HTTP/JSON search server answering queries with one of
+    the rankers of an InvertedIndex, using asyncio streams. """
+
+    def __init__(self, ii, ranker='bm25', lam=0.67, concurrency=64,
+                 maxBatch=32, maxWait=0.002, workers=1, executor='thread',
+                 monitor=None, completer=None):
+        r""" Create the server for the given (loaded) index. At most
+        concurrency queries are processed at a time, further ones wait.
+        Scoring runs in a pool of workers threads or (forked) processes.
+        If given, monitor.record(seconds, error) is called for each search
+        request and monitor.report() is added to the /health output. If an
+        Autocomplete completer is given, /complete?q=...&k=... returns the
+        completions of the last keyword of q. /metrics returns the METRICS
+        of this process as JSON (or with ?format=prometheus as Prometheus
+        text, scoring in executor processes is not included).
+
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.75, 0.75)
+        >>> ii.preprocessVsm(4)
+        >>> async def demo():
+        ...     completer = Autocomplete.fromInvertedIndex(ii)
+        ...     server = SearchServer(ii, 'vsm', completer=completer)
+        ...     await server.start('127.0.0.1', 0)
+        ...     reader, writer = await asyncio.open_connection('127.0.0.1',
+        ...                                                    server.port)
+        ...     responses = []
+        ...     for path in ['/search?q=web+surfing&k=2',
+        ...                  '/search?q=web+surfing&k=-1',
+        ...                  '/complete?q=web+s&k=2', '/complete?q=web&k=-1',
+        ...                  '/nothing',
+        ...                  '/metrics?format=prometheus']:
+        ...         writer.write('GET {0} HTTP/1.1\r\n\r\n'.format(
+        ...             path).encode())
+        ...         responses.append(await readResponse(reader))
+        ...     writer.close()
+        ...     await server.close()
+        ...     return responses
+        >>> for status, body in asyncio.run(demo()):
+        ...     print(status, body.decode())
+        ... # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
+        200 {"query": "web surfing", "ranker": "vsm",
+             "results": [{"id": 2, "score": 1.1355, "text": "web surfing"},
+                         {"id": 0, "score": 0.9437,
+                          "text": "internet web surfing"}]}
+        400 {"error": "k must be a positive integer"}
+        200 {"query": "web s", "completions": ["web surfing"]}
+        400 {"error": "k must be a positive integer"}
+        404 {"error": "unknown path /nothing"}
+        200 # TYPE ir_documents_indexed counter
+        ...
+        """
+
+        self.ii = ii
+        self.ranker = ranker
+        self.concurrency = concurrency
+        self.monitor = monitor
+        self.completer = completer
+        if executor == 'process':
+            global _index
+            _index = ii  # inherited by the forked workers
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('fork'))
+            # fork the workers now, before the listening socket exists
+            self.executor.submit(int).result()
+            scoreFn = functools.partial(scoreBatchWorker, ranker=ranker,
+                                        lam=lam)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+            scoreFn = functools.partial(scoreBatch, ii, ranker=ranker,
+                                        lam=lam)
+        self.batcher = MicroBatcher(scoreFn, self.executor, maxBatch, maxWait,
+                                    workers)
+        self.numRequests = 0
+        self.numErrors = 0
+        self.startTime = time.time()
+        self.server = None
+        self.port = None
+
+    async def start(self, host=None, port=None, sock=None):
+        """ Start listening on host and port (port 0: any free port, see
+        self.port) or on an already bound socket. """
+
+        self.limit = asyncio.Semaphore(self.concurrency)
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle, host, port,
+                                                 sock=sock)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+        self.executor.shutdown()
+
+    async def handle(self, reader, writer):
+        r""" Answer the requests of one (keep-alive) connection. A request
+        line or header longer than the stream limit is answered with 400
+        and closes the connection.
+
+        >>> ii = InvertedIndex(io.StringIO('web surfing'), 1.75, 0.75)
+        >>> async def demo():
+        ...     server = SearchServer(ii, 'bm25')
+        ...     await server.start('127.0.0.1', 0)
+        ...     reader, writer = await asyncio.open_connection('127.0.0.1',
+        ...                                                    server.port)
+        ...     writer.write(b'GET /search?q=' + b'a' * 2 ** 17 + b'\r\n')
+        ...     response = await readResponse(reader)
+        ...     writer.close()
+        ...     await server.close()
+        ...     return response
+        >>> asyncio.run(demo())
+        (400, b'{"error": "request line or header too long"}')
+        """
+
+        try:
+            while True:
+                try:
+                    requestLine = await reader.readline()
+                    if len(requestLine) == 0:
+                        break
+                    keepAlive = True
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        if line.lower().startswith(b'connection:') and \
+                           b'close' in line.lower():
+                            keepAlive = False
+                except ValueError:  # line longer than the stream limit
+                    self.numRequests += 1
+                    await self.writeResponse(
+                        writer, 400,
+                        {'error': 'request line or header too long'}, False)
+                    break
+                status, content = await self.respond(requestLine)
+                await self.writeResponse(writer, status, content, keepAlive)
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def writeResponse(self, writer, status, content, keepAlive):
+        """ Write an HTTP response with the JSON content (or text). """
+
+        if isinstance(content, str):
+            body = content.encode('utf-8')
+            contentType = 'text/plain; version=0.0.4'
+        else:
+            body = json.dumps(content).encode('utf-8')
+            contentType = 'application/json'
+        writer.write(
+            'HTTP/1.1 {0} {1}\r\nContent-Type: {2}\r\n'
+            'Content-Length: {3}\r\nConnection: {4}\r\n\r\n'.format(
+                status, _STATUS[status], contentType, len(body),
+                'keep-alive' if keepAlive else 'close').encode())
+        writer.write(body)
+        await writer.drain()
+
+    async def respond(self, requestLine):
+        """ Return the status code and the JSON content (or text) for a
+        request. """
+
+        self.numRequests += 1
+        parts = requestLine.decode('latin-1').split()
+        if len(parts) != 3:
+            return 400, {'error': 'malformed request'}
+        if parts[0] != 'GET':
+            return 405, {'error': 'only GET is supported'}
+        url = urllib.parse.urlsplit(parts[1])
+        params = urllib.parse.parse_qs(url.query)
+        if url.path == '/health':
+            return 200, self.stats()
+        if url.path == '/metrics':
+            if params.get('format', ['json'])[0] == 'prometheus':
+                return 200, METRICS.toPrometheus() + '\n'
+            return 200, METRICS.report()
+        if url.path not in ['/search', '/complete'] or \
+           (url.path == '/complete' and self.completer is None):
+            return 404, {'error': 'unknown path {0}'.format(url.path)}
+        if 'q' not in params:
+            return 400, {'error': 'missing parameter q'}
+        query = params['q'][0]
+        try:
+            k = int(params.get('k', ['10'])[0])
+        except ValueError:
+            return 400, {'error': 'k must be an integer'}
+        if k < 1:
+            return 400, {'error': 'k must be a positive integer'}
+        if url.path == '/complete':
+            try:
+                completions = self.completer.completeQuery(query, k)
+            except Exception as e:
+                self.numErrors += 1
+                return 500, {'error': str(e)}
+            return 200, {'query': query, 'completions': completions}
+
+        start = time.perf_counter()
+        try:
+            async with self.limit:
+                matches = await self.batcher.submit(query, k)
+        except Exception as e:
+            self.numErrors += 1
+            if self.monitor is not None:
+                self.monitor.record(time.perf_counter() - start, True)
+            return 500, {'error': str(e)}
+        METRICS.observe('search_request_seconds', time.perf_counter() - start)
+        if self.monitor is not None:
+            self.monitor.record(time.perf_counter() - start, False)
+        results = []
+        for recId, score in matches:
+            result = {'id': recId, 'score': score}
+            if recId in self.ii.records:
+                result['text'] = self.ii.records[recId]['line'].strip()
+            results.append(result)
+        return 200, {'query': query, 'ranker': self.ranker,
+                     'results': results}
+
+    def stats(self):
+        """ Return a dict with request and batching statistics. """
+
+        batcher = self.batcher
+        stats = {'status': 'ok', 'ranker': self.ranker,
+                 'uptime': round(time.time() - self.startTime, 3),
+                 'requests': self.numRequests, 'errors': self.numErrors,
+                 'batches': batcher.numBatches,
+                 'meanBatchSize': round(batcher.numQueries /
+                                        max(batcher.numBatches, 1), 3)}
+        if self.monitor is not None:
+            stats['workers'] = self.monitor.report()
+        return stats
+
+
+def addIndexArguments(parser):
+    """ Add the arguments read by loadIndex to the argparse parser. """
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--recs', help='records file to build the index of')
+    source.add_argument('--model', help='LSI model dir (see lsi.py [w])')
+    parser.add_argument('--ranker', choices=_RANKERS, default='bm25')
+    parser.add_argument('--lambda', dest='lam', type=float, default=0.67)
+    parser.add_argument('-k', type=int, default=50, help='LSI dimensions')
+    parser.add_argument('-m', type=int, default=10000,
+                        help='terms in the term-document matrix')
+    parser.add_argument('--autocomplete', choices=_RANKINGS,
+                        help='serve /complete, completions ranked by df or '
+                             'BM25 mass of the terms')
+    parser.add_argument('--memory-report', dest='memoryReport',
+                        action='store_true',
+                        help='print the memory usage of the loaded index')
+
+
+def loadIndex(parser, args):
+    """ Build (or load) the index for the parsed arguments of a parser set
+    up with addIndexArguments. """
+
+    if args.model is not None and args.ranker != 'lsi':
+        parser.error('--model only supports --ranker lsi')
+
+    print('Building index ...')
+    if args.model is not None:
+        ii = InvertedIndex(io.StringIO(''), 1.75, 0.3)
+        ii.loadLsi(args.model)
+    else:
+        with open(args.recs) as f:
+            ii = InvertedIndex(f, 1.75, 0.3)
+        if args.ranker != 'bm25':
+            ii.preprocessVsm(args.m)
+        if args.ranker in ['lsi', 'lsicomb']:
+            ii.preprocessLsi(args.k)
+    ii.setStopwords(loadStopwords())
+    print('done')
+    if args.memoryReport:
+        print(formatMemoryReport(ii.memoryReport()))
+    return ii
+
+
+def loadCompleter(parser, args, ii):
+    """ Build the Autocomplete index requested by the parsed arguments (None
+    if there is none). """
+
+    if args.autocomplete is None:
+        return None
+    if args.model is not None and args.autocomplete == 'bm25':
+        parser.error('--model only supports --autocomplete df')
+    return Autocomplete.fromInvertedIndex(ii, args.autocomplete)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='HTTP/JSON search server (GET /search?q=...&k=10, '
+                    'GET /complete?q=...&k=10, GET /health, GET /metrics).')
+    addIndexArguments(parser)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--max-batch', dest='maxBatch', type=int, default=32)
+    parser.add_argument('--max-wait-ms', dest='maxWait', type=float,
+                        default=2.0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--executor', choices=['thread', 'process'],
+                        default='thread')
+    args = parser.parse_args(argv)
+    ii = loadIndex(parser, args)
+    completer = loadCompleter(parser, args, ii)
+
+    async def serve():
+        server = SearchServer(ii, args.ranker, args.lam, args.concurrency,
+                              args.maxBatch, args.maxWait / 1000,
+                              args.workers, args.executor,
+                              completer=completer)
+        await server.start(args.host, args.port)
+        print('Listening on port {0}'.format(server.port))
+        stop = asyncio.Event()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        await stop.wait()
+        await server.close()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,232 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import argparse
+import heapq
+import multiprocessing
+import numpy
+import os
+import sys
+import time
+from lsi import EvaluateBenchmark, InvertedIndex
+from tokenizer import loadStopwords
+
+
+def splitCorpus(fileName, numShards):
+    r""" Split the records file (one record per line) into numShards ranges
+    of about the same size that start at line boundaries. Return a list of
+    (start byte, end byte, first record ID) triples.
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile('w', delete=False)
+    >>> _ = f.write('aaaa\nbb\ncc\ndddddd\ne')
+    >>> f.close()
+    >>> splitCorpus(f.name, 2)
+    [(0, 11, 0), (11, 19, 3)]
+    >>> splitCorpus(f.name, 4)
+    [(0, 5, 0), (5, 11, 1), (11, 18, 3), (18, 19, 4)]
+    """
+
+    size = os.path.getsize(fileName)
+    bounds = [0]
+    with open(fileName, 'rb') as f:
+        for i in range(1, numShards):
+            f.seek(max(size * i // numShards - 1, bounds[-1]))
+            f.readline()  # move to the start of the next line
+            bounds.append(min(f.tell(), size))
+        bounds.append(size)
+
+        ranges = []
+        recordId = 0
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            ranges.append((start, end, recordId))
+            f.seek(start)
+            data = f.read(end - start)
+            recordId += data.count(b'\n')
+            if len(data) > 0 and not data.endswith(b'\n'):
+                recordId += 1  # last line without line break
+    return ranges
+
+
+def readLines(fileName, start, end):
+    """ Yield the lines of the given byte range of a file. """
+
+    with open(fileName, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            pos += len(line)
+            yield line.decode('utf-8')
+
+
+def serveShard(conn, fileName, start, end, firstRecordId, bm25k, bm25b):
+    """ Shard process: index the given range of the records file, exchange
+    statistics with the coordinator, then answer its requests. """
+
+    ii = InvertedIndex(readLines(fileName, start, end), bm25k, bm25b,
+                       firstRecordId, bm25=False)
+    totalDl = sum(record['dl'] for record in ii.records.values())
+    conn.send((ii.vocab.terms(), ii.vocab.dfArray(), ii.numDocs, totalDl))
+    dfs, numDocs, avdl = conn.recv()
+    ii.computeBm25(numDocs, avdl, dfs)
+    conn.send(len(ii.records))
+
+    while True:
+        request = conn.recv()
+        if request[0] == 'search':
+            queries, k = request[1:]
+            conn.send([ii.processQuery(q)[0:k] for q in queries])
+        elif request[0] == 'stopwords':
+            ii.setStopwords(request[1])
+        elif request[0] == 'stop':
+            break
+    conn.close()
+
+
+class ShardedIndex:
+    """ Document partitioned BM25 index: the records file is split into
+    ranges of records that are indexed by one shard process each. BM25
+    scores are computed with the df, number of records and avdl of the whole
+    corpus, so that the results of the shards can be merged. """
+
+    def __init__(self, fileName, numShards, bm25k, bm25b):
+        r""" Index the records file with numShards shards.
+
+        >>> import tempfile
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> f = tempfile.NamedTemporaryFile('w', delete=False)
+        >>> _ = f.write(txt)
+        >>> f.close()
+        >>> si = ShardedIndex(f.name, 3, 1.75, 0.75)
+        >>> si.numDocs, round(si.avdl, 3)
+        (6, 2.667)
+        >>> si.search('web beach', 4)
+        [(3, 1.4108), (2, 1.1355), (4, 1.1355), (5, 1.1355)]
+        >>> with open(f.name) as recs:
+        ...     ii = InvertedIndex(recs, 1.75, 0.75)
+        >>> si.searchBatch(['internet', 'beach surfing']) == \
+        ...     [ii.processQuery('internet'), ii.processQuery('beach surfing')]
+        True
+        >>> si.close()
+        """
+
+        ctx = multiprocessing.get_context('fork')
+        self.conns = []
+        self.processes = []
+        for start, end, firstRecordId in splitCorpus(fileName, numShards):
+            conn, child = ctx.Pipe()
+            process = ctx.Process(target=serveShard, args=(
+                child, fileName, start, end, firstRecordId, bm25k, bm25b))
+            process.start()
+            child.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+        """ Collect the statistics of the shards. """
+        shardStats = [conn.recv() for conn in self.conns]
+        globalDfs = {}
+        for terms, dfs, numDocs, totalDl in shardStats:
+            for term, df in zip(terms, dfs.tolist()):
+                globalDfs[term] = globalDfs.get(term, 0) + df
+        self.numDocs = sum(stats[2] for stats in shardStats)
+        self.avdl = sum(stats[3] for stats in shardStats) / \
+            max(self.numDocs, 1)
+
+        """ Send the global statistics, let the shards compute BM25. """
+        for conn, (terms, dfs, numDocs, totalDl) in zip(self.conns,
+                                                        shardStats):
+            dfs = numpy.array([globalDfs[term] for term in terms],
+                              dtype=numpy.int64)
+            conn.send((dfs, self.numDocs, self.avdl))
+        self.shardSizes = [conn.recv() for conn in self.conns]
+
+    def setStopwords(self, stopwords):
+        for conn in self.conns:
+            conn.send(('stopwords', stopwords))
+
+    def searchBatch(self, queries, k=None):
+        """ Return the k best (record ID, BM25 score) pairs (all matches if
+        k is None) for each of the queries. The queries are sent to all
+        shards (which search in parallel), the per shard results are merged
+        with a heap. Shards hold increasing ranges of record IDs, so ties
+        are ordered by record ID as in a single InvertedIndex. """
+
+        for conn in self.conns:
+            conn.send(('search', queries, k))
+        shardResults = [conn.recv() for conn in self.conns]
+
+        results = []
+        for i in range(len(queries)):
+            merged = heapq.merge(*[shard[i] for shard in shardResults],
+                                 key=lambda x: -x[1])
+            results.append(list(merged)[0:k])
+        return results
+
+    def search(self, q, k=None):
+        return self.searchBatch([q], k)[0]
+
+    def close(self):
+        """ Stop the shard processes. """
+
+        for conn in self.conns:
+            conn.send(('stop',))
+            conn.close()
+        for process in self.processes:
+            process.join()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Sharded BM25 index: evaluate a benchmark file or answer '
+                    'queries read from stdin.')
+    parser.add_argument('recs', help='records file to index')
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--benchmark', help='benchmark file (query<TAB>ids)')
+    parser.add_argument('--bm25k', type=float, default=1.75)
+    parser.add_argument('--bm25b', type=float, default=0.3)
+    parser.add_argument('--top-n', dest='topN', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=64,
+                        help='queries sent to the shards at a time')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    si = ShardedIndex(args.recs, args.shards, args.bm25k, args.bm25b)
+    si.setStopwords(loadStopwords())
+    print('Indexed {0} records in {1} shards {2} in {3:.2f}s'.format(
+        si.numDocs, args.shards, si.shardSizes, time.time() - start))
+
+    try:
+        if args.benchmark is not None:
+            eb = EvaluateBenchmark(args.topN)
+            queries, relevantIds = eb.readBenchmark(args.benchmark)
+            start = time.perf_counter()
+            resultIds = []
+            for i in range(0, len(queries), args.batch):
+                for result in si.searchBatch(queries[i:i + args.batch],
+                                             args.topN):
+                    resultIds.append([r[0] for r in result])
+            wallTime = time.perf_counter() - start
+            metrics = eb.evaluateResults(resultIds, relevantIds)
+            print('MP@3 {0:.2f} | MP@R {1:.2f} | MAP: {2:.2f} | '
+                  '{3:.1f} QPS'.format(
+                      metrics['P@3'].mean(), metrics['P@R'].mean(),
+                      metrics['AP'].mean(), len(queries) / wallTime))
+        else:
+            for line in sys.stdin:
+                for recId, score in si.search(line.strip(), 3):
+                    print('{0}\t{1}'.format(recId, score))
+    finally:
+        si.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,303 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import argparse
+import array
+import itertools
+import json
+import multiprocessing
+import numpy
+import scipy.sparse
+import sys
+import time
+from lsi import _SVD_BACKENDS, EvaluateBenchmark, topK
+from tokenizer import Tokenizer, loadStopwords
+
+_QUERY_BLOCK = 256  # queries scored at once (bounds the dense score block)
+_engine = None  # engine used by evaluatePoint in worker processes
+
+
+class SweepEngine:
+    """ Class for evaluating a grid of BM25, VSM and LSI parameters on a
+    benchmark. The corpus is tokenized once; raw tf, dl and df are kept so
+    that the term-document matrix for every grid point is one vectorized
+    expression. """
+
+    def __init__(self, fileObj, queries, relevantIds, stopwords=(),
+                 topN=1000):
+        r""" Tokenize the records of fileObj (one per line) and the queries.
+        relevantIds holds the relevant record IDs (from 0) of each query.
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> se = SweepEngine(io.StringIO(txt), ['web', 'beach'],
+        ...                  [[0, 2], [4, 5]])
+        >>> se.numDocs, se.tf.shape, se.dfs.tolist()
+        (6, (4, 6), [3, 3, 6, 3])
+        >>> se.Q.toarray().tolist()
+        [[0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 0.0, 1.0]]
+        """
+
+        tokenizer = Tokenizer()
+        self.vocab = tokenizer.vocab
+        self.stopwords = frozenset(stopwords)
+        termInds = array.array('q')
+        indptr = array.array('q', [0])
+        for line in fileObj:
+            for word in tokenizer.tokenize(line):
+                termInds.append(self.vocab.add(word))
+            indptr.append(len(termInds))
+        indptr = numpy.frombuffer(indptr, numpy.int64)
+
+        self.numDocs = len(indptr) - 1
+        # documents x terms occurrences, duplicates are summed up to the tfs
+        X = scipy.sparse.csr_matrix(
+            (numpy.ones(len(termInds)),
+             numpy.frombuffer(termInds, numpy.int64), indptr),
+            shape=(self.numDocs, len(self.vocab)))
+        X.sum_duplicates()
+        self.tf = scipy.sparse.csr_matrix(X.T)  # terms x documents
+        self.dls = numpy.diff(indptr).astype(numpy.float64)
+        self.dfs = numpy.diff(self.tf.indptr)
+        self.avdl = self.dls.sum() / max(self.numDocs, 1)
+
+        self.queries = queries
+        self.relevantIds = relevantIds
+        self.Q = self.queryMatrix(queries)
+        self.eb = EvaluateBenchmark(topN)
+
+    def queryMatrix(self, queries):
+        """ Return the #queries x #terms matrix of keyword counts, with
+        keywords processed as in lsi.InvertedIndex.prepareQueryMatrix. """
+
+        rowInds = []
+        colInds = []
+        for row, q in enumerate(queries):
+            for w in q.split(' '):
+                w = w.lower()
+                termId = self.vocab.get(w)
+                if w not in self.stopwords and termId is not None:
+                    rowInds.append(row)
+                    colInds.append(termId)
+        return scipy.sparse.csr_matrix(
+            (numpy.ones(len(rowInds)), (rowInds, colInds)),
+            shape=(len(queries), len(self.vocab)))
+
+    def bm25Matrix(self, bm25k, bm25b, m, l2normalize=False):
+        r""" Return the BM25 term-document matrix of the m terms with the
+        highest df (rows ordered as in lsi.InvertedIndex.preprocessVsm) and
+        the array mapping its rows to term IDs.
+
+        >>> import io
+        >>> from lsi import InvertedIndex
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> se = SweepEngine(io.StringIO(txt), [], [])
+        >>> ii = InvertedIndex(io.StringIO(txt), 1.2, 0.5)
+        >>> ii.preprocessVsm(4, l2normalize=True)
+        >>> A, rowTerms = se.bm25Matrix(1.2, 0.5, 4, l2normalize=True)
+        >>> rowTerms.tolist() == ii.rowTerms.tolist()
+        True
+        >>> bool(abs(A - ii.tdMatrix).max() < 1e-9)
+        True
+        """
+
+        rowTerms = numpy.argsort(-self.dfs, kind='stable')[0:m]
+        tf = self.tf[rowTerms].tocoo()
+        dl = self.dls[tf.col]
+        idf = numpy.log2(self.numDocs / self.dfs[rowTerms])[tf.row]
+        bm25 = (tf.data * (bm25k + 1) /
+                (bm25k * (1 - bm25b + bm25b * dl / self.avdl) + tf.data))
+        # precision to 4 decimals as in lsi.InvertedIndex
+        scores = numpy.round(bm25 * idf, 4)
+        A = scipy.sparse.csr_matrix((scores, (tf.row, tf.col)),
+                                    shape=(len(rowTerms), self.numDocs))
+        if l2normalize:
+            norms = numpy.sqrt(numpy.asarray(A.multiply(A).sum(0))).ravel()
+            norms[norms == 0] = 1
+            A = scipy.sparse.csr_matrix(A.multiply(1 / norms))
+        return A, rowTerms
+
+    def evaluateScores(self, scoreBlock):
+        """ Rank the documents for all queries and return the mean metrics.
+        scoreBlock(start, end) must return the dense score matrix of queries
+        start to end - 1. """
+
+        resultIds = []
+        for start in range(0, len(self.queries), _QUERY_BLOCK):
+            end = min(start + _QUERY_BLOCK, len(self.queries))
+            scores = numpy.asarray(scoreBlock(start, end))
+            for row in scores:
+                resultIds.append(topK(row, self.eb.topN).tolist())
+        metrics = self.eb.evaluateResults(resultIds, self.relevantIds,
+                                          ks=(3, 10))
+        names = [('MP@3', 'P@3'), ('MP@R', 'P@R'), ('MAP', 'AP'),
+                 ('nDCG@10', 'nDCG@10')]
+        return {name: round(float(metrics[key].mean()), 4)
+                for name, key in names}
+
+    def evaluatePoint(self, bm25k, bm25b, m, l2normalize, ks, lams,
+                      backend='arpack'):
+        r""" Evaluate VSM for the given matrix parameters, LSI for each k in
+        ks and the linear combination of VSM and LSI for each lambda in lams.
+        One SVD of rank max(ks) is computed and truncated for the smaller ks.
+        Return a list of dicts (parameters and metrics), one per ranker.
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> se = SweepEngine(io.StringIO(txt), ['web', 'beach'],
+        ...                  [[0, 2], [4, 5]])
+        >>> rows = se.evaluatePoint(1.75, 0.75, 4, False, [1, 2], [0.5])
+        >>> [(r['ranker'], r['k'], r['lambda'], r['MAP']) for r in rows]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [('vsm', None, None, 1.0), ('lsi', 1, None, 0.3833),
+         ('lsicomb', 1, 0.5, 1.0), ('lsi', 2, None, 0.875),
+         ('lsicomb', 2, 0.5, 1.0)]
+        """
+
+        A, rowTerms = self.bm25Matrix(bm25k, bm25b, m, l2normalize)
+        Q = self.Q[:, rowTerms]
+        point = {'bm25k': bm25k, 'bm25b': bm25b, 'm': m,
+                 'l2normalize': l2normalize}
+
+        def vsmBlock(start, end):
+            return (Q[start:end] * A).toarray()
+
+        rows = [dict(point, ranker='vsm', k=None, **{'lambda': None},
+                     **self.evaluateScores(vsmBlock))]
+        if len(ks) == 0:
+            return rows
+
+        kMax = min(max(ks), min(A.shape) - 1)
+        U, S, Vt = _SVD_BACKENDS[backend](A, kMax)
+        # sort by descending singular value, so that truncating keeps the
+        # k' largest ones
+        order = numpy.argsort(-S, kind='stable')
+        QUS = Q * (U[:, order] * S[order])
+        Vt = Vt[order]
+        for k in sorted(set(min(k, kMax) for k in ks)):
+            def lsiScores(start, end):
+                return QUS[start:end, :k].dot(Vt[:k])
+
+            def lsiBlock(start, end):
+                # rounded as in lsi.InvertedIndex.processQueryLsi
+                return numpy.round(lsiScores(start, end), 3)
+
+            rows.append(dict(point, ranker='lsi', k=k, **{'lambda': None},
+                             **self.evaluateScores(lsiBlock)))
+            for lam in lams:
+                def combBlock(start, end):
+                    return (lam * vsmBlock(start, end) +
+                            (1 - lam) * lsiScores(start, end))
+
+                rows.append(dict(point, ranker='lsicomb', k=k,
+                                 **{'lambda': lam},
+                                 **self.evaluateScores(combBlock)))
+        return rows
+
+    def run(self, bm25ks, bm25bs, ms, l2normalizes, ks, lams, workers=1,
+            backend='arpack'):
+        r""" Evaluate all points of the grid, spread over workers processes
+        that share the engine (forked, copy-on-write). Return the list of
+        result dicts (see evaluatePoint).
+
+        >>> import io
+        >>> txt ='internet web surfing\ninternet surfing\nweb surfing\nintern'
+        >>> txt +='et web surfing surfing beach\nsurfing beach\nsurfing beach'
+        >>> se = SweepEngine(io.StringIO(txt), ['web', 'beach'],
+        ...                  [[0, 2], [4, 5]])
+        >>> rows = se.run([1.2, 1.75], [0.5], [3, 4], [False], [2], [],
+        ...               workers=2)
+        >>> [(r['bm25k'], r['m'], r['ranker']) for r in rows]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [(1.2, 3, 'vsm'), (1.2, 3, 'lsi'), (1.2, 4, 'vsm'), (1.2, 4, 'lsi'),
+         (1.75, 3, 'vsm'), (1.75, 3, 'lsi'), (1.75, 4, 'vsm'),
+         (1.75, 4, 'lsi')]
+        """
+
+        global _engine
+        points = [point + (ks, lams, backend) for point in
+                  itertools.product(bm25ks, bm25bs, ms, l2normalizes)]
+        if workers == 1:
+            shards = [self.evaluatePoint(*point) for point in points]
+        else:
+            _engine = self
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(workers) as pool:
+                shards = pool.map(evaluatePoint, points)
+            _engine = None
+        return [row for shard in shards for row in shard]
+
+
+def evaluatePoint(args):
+    """ Worker of SweepEngine.run: evaluate one grid point with the engine
+    inherited from the parent process. """
+
+    return _engine.evaluatePoint(*args)
+
+
+def parseList(convert):
+    """ Return a function parsing a comma separated list of values. """
+
+    def parse(value):
+        return [convert(v) for v in value.split(',') if v != '']
+    return parse
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Evaluate a grid of BM25 / VSM / LSI parameters on a '
+                    'benchmark, tokenizing the records only once.')
+    parser.add_argument('recs', help='records file (one record per line)')
+    parser.add_argument('benchmark', help='benchmark file (query<TAB>ids)')
+    parser.add_argument('--bm25k', type=parseList(float), default=[1.75])
+    parser.add_argument('--bm25b', type=parseList(float), default=[0.3])
+    parser.add_argument('-m', type=parseList(int), default=[10000])
+    parser.add_argument('--l2', type=parseList(int), default=[0],
+                        help='0 and/or 1: L2-normalize document vectors')
+    parser.add_argument('-k', type=parseList(int), default=[],
+                        help='LSI dimensions (empty: VSM only)')
+    parser.add_argument('--lambda', dest='lams', type=parseList(float),
+                        default=[], help='weights of VSM scores for lsicomb')
+    parser.add_argument('--backend', choices=sorted(_SVD_BACKENDS),
+                        default='arpack')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--top-n', dest='topN', type=int, default=1000)
+    parser.add_argument('--json', help='write all results to this file')
+    args = parser.parse_args(argv)
+
+    queries, relevantIds = EvaluateBenchmark().readBenchmark(args.benchmark)
+    start = time.time()
+    with open(args.recs) as f:
+        se = SweepEngine(f, queries, relevantIds, loadStopwords(), args.topN)
+    print('Tokenized {0} records in {1:.2f}s'.format(se.numDocs,
+                                                     time.time() - start))
+
+    start = time.time()
+    rows = se.run(args.bm25k, args.bm25b, args.m,
+                  [bool(l2) for l2 in args.l2], args.k, args.lams,
+                  args.workers, args.backend)
+    print('Evaluated {0} configurations in {1:.2f}s\n'.format(
+        len(rows), time.time() - start))
+
+    for row in sorted(rows, key=lambda r: -r['MAP']):
+        print('MAP {0:.4f} | MP@3 {1:.2f} | MP@R {2:.2f} | nDCG@10 {3:.2f} | '
+              '{4} k1={5} b={6} m={7} l2={8} k={9} lambda={10}'.format(
+                  row['MAP'], row['MP@3'], row['MP@R'], row['nDCG@10'],
+                  row['ranker'], row['bm25k'], row['bm25b'], row['m'],
+                  row['l2normalize'], row['k'], row['lambda']))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
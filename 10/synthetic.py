@@ -0,0 +1 @@
+../shared/synthetic.py
\ No newline at end of file
@@ -6,145 +6,597 @@ it under the terms of the WTFPL, Version 2, as published
 by Sam Hocevar. See the COPYING file for more details.
 """
 
+import array
+import itertools
+import locale
 import math
-import re
+import multiprocessing
+import numpy
+import os
+import scipy.sparse
 import sys
+from metrics import METRICS, formatMemoryReport, memoryBreakdown
+from tokenizer import Tokenizer, Vocabulary, loadStopwords
 
 _EPSILON = .1
+_BATCH_SIZE = 10000
+_model = None  # model used by predictRange in worker processes
 
 
 class NaiveBayes():
 
-    def __init__(self, filename, test=False):
-        """ Create a NaiveBayes instance given a training file.
+    def __init__(self, filename=None, test=False, workers=1):
+        """ Create a NaiveBayes instance given a training file. Without a
+        file, the instance is empty and can be trained with partialFit. With
+        workers > 1, the file is counted in parallel (see fitParallel).
+
+        The documents are turned into a sparse document-term count matrix X,
+        the class-conditional term counts are then computed for all classes
+        at once as Y^T * X, where Y is the one-hot document-class matrix.
 
         >>> nb = NaiveBayes("example.txt", True)
         >>> [val['pc'] for val in list(nb.c.values())]
         [0.5, 0.5]
-        >>> print('{0:.3f}'.format(nb.c['A']['pwcs']['a']))
+        >>> nb.logPwc.shape, nb.logPwc.dtype
+        ((2, 2), dtype('float64'))
+        >>> print('{0:.3f}'.format(nb.pwc('A', 'a')))
         0.664
-        >>> print('{0:.3f}'.format(nb.c['A']['pwcs']['b']))
+        >>> print('{0:.3f}'.format(nb.pwc('A', 'b')))
         0.336
-        >>> print('{0:.3f}'.format(nb.c['B']['pwcs']['a']))
+        >>> print('{0:.3f}'.format(nb.pwc('B', 'a')))
         0.335
-        >>> print('{0:.3f}'.format(nb.c['B']['pwcs']['b']))
+        >>> print('{0:.3f}'.format(nb.pwc('B', 'b')))
         0.665
         """
 
         self.test = test
 
-        self.stopwords = []
-        with open('stopwords_en.txt') as f:
-            for line in f:
-                self.stopwords.append(line.strip())
+        self.tokenizer = Tokenizer(loadStopwords())
 
         self.c = {}  # classes
-        vocab = []
-        documentCount = 0
+        self.labels = []  # class index -> label
+        # term ID = column of the count/probability tables
+        self.vocab = self.tokenizer.vocab
+        # classes x terms word counts n_wc, a view on a buffer that grows
+        # by doubling its capacity
+        self.countsBuf = numpy.zeros((0, 0))
+        self.counts = self.countsBuf
+        self.docCounts = numpy.zeros(0, dtype=numpy.int64)
+        self.dirty = True  # probabilities not up to date with counts
 
-        with open(filename, 'r') as f:
-            for line in f:
-                parts = line.strip().split('\t')
-                label, text = parts[0], parts[1]
-                if label not in self.c:
-                    self.c[label] = {}
-                    self.c[label]['nwcs'] = {}
-                    self.c[label]['pwcs'] = {}
-                    self.c[label]['nc'] = 0
-                    self.c[label]['docCount'] = 0
-
-                words = re.sub('\W+', ' ', text.lower()).split()
-                if not self.test:
-                    words = [w for w in words if w not in self.stopwords]
-                self.c[label]['docCount'] += 1
-                for w in words:
-                    if w not in self.c[label]['nwcs']:
-                        self.c[label]['nwcs'][w] = 0
-                    self.c[label]['nwcs'][w] += 1
-                    self.c[label]['nc'] += 1
-                    vocab.append(w)
-                documentCount += 1
-
-        vocabSize = len(set(vocab))
-        for label, cls in self.c.items():
-            self.c[label]['pc'] = cls['docCount'] / documentCount
-            for w, cnt in cls['nwcs'].items():
-                self.c[label]['pwcs'][w] = (cnt + _EPSILON) /\
-                                            (cls['nc'] + _EPSILON * vocabSize)
-
-    def predict(self, filename):
-        """ Predict a label for each document in the given test file.
+        if filename is not None and workers > 1:
+            self.fitParallel(filename, workers)
+        elif filename is not None:
+            with open(filename, 'r') as f:
+                self.partialFit(f)
+        if filename is not None:
+            self.computeProbabilities()
+
+    @METRICS.timed('nb_partial_fit')
+    def partialFit(self, lines):
+        """ Update the class and term counts with the given labelled lines
+        (<label>\t<text>), which can be any iterable, e.g. a file object.
+        The lines are consumed in chunks of _BATCH_SIZE. Probabilities are
+        recomputed lazily, the next time they are needed.
+
+        >>> nb = NaiveBayes(test=True)
+        >>> with open('example.txt') as f:
+        ...     lines = f.readlines()
+        >>> nb.partialFit(lines[0:2])
+        >>> nb.labels, nb.counts.tolist()
+        (['A'], [[7.0, 3.0]])
+        >>> nb.partialFit(iter(lines[2:]))
+        >>> nb.labels, nb.counts.tolist()
+        (['A', 'B'], [[10.0, 5.0], [6.0, 12.0]])
+        >>> print('{0:.3f}'.format(nb.pwc('A', 'a')))
+        0.664
+        """
+
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, _BATCH_SIZE))
+            if len(chunk) == 0:
+                break
+            labelInds, X = self.countMatrix(chunk)
+            numDocs = X.get_shape()[0]
+            numClasses = len(self.labels)
+            self.resizeCounts(numClasses, len(self.vocab))
+            Y = scipy.sparse.csr_matrix(
+                (numpy.ones(numDocs), (numpy.arange(numDocs), labelInds)),
+                shape=(numDocs, numClasses))
+            chunkCounts = (Y.T * X).tocoo()
+            # (row, col) pairs are unique, so fancy indexing adds correctly
+            self.counts[chunkCounts.row, chunkCounts.col] += chunkCounts.data
+            self.docCounts += numpy.bincount(labelInds, minlength=numClasses)
+            self.dirty = True
+            METRICS.count('nb_documents_trained', numDocs)
+
+    @METRICS.timed('nb_fit_parallel')
+    def fitParallel(self, filename, workers):
+        """ Split the training file into byte ranges, count each range in
+        its own process and add up the counts. Labels and terms are merged
+        in file order, so the model is identical to one trained serially.
+
+        >>> nb = NaiveBayes("example.txt", True, workers=4)
+        >>> nb.labels, nb.counts.tolist()
+        (['A', 'B'], [[10.0, 5.0], [6.0, 12.0]])
+        """
+
+        ranges = byteRanges(filename, workers)
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(workers) as pool:
+            shards = pool.map(countRange,
+                              [(filename, s, e, self.test) for s, e in ranges])
+        for labels, terms, counts, docCounts in shards:
+            self.mergeCounts(labels, terms, counts, docCounts)
 
+    def mergeCounts(self, labels, terms, counts, docCounts):
+        """ Add counts given w.r.t. another list of labels and terms. """
+
+        for label in labels:
+            if label not in self.c:
+                self.c[label] = {'idx': len(self.labels)}
+                self.labels.append(label)
+        colMap = numpy.empty(len(terms), dtype=numpy.int64)
+        for idx, term in enumerate(terms):
+            colMap[idx] = self.tokenizer.termId(term)
+        rowMap = numpy.array([self.c[label]['idx'] for label in labels],
+                             dtype=numpy.int64)
+
+        self.resizeCounts(len(self.labels), len(self.vocab))
+        counts = scipy.sparse.coo_matrix(counts)
+        self.counts[rowMap[counts.row], colMap[counts.col]] += counts.data
+        self.docCounts[rowMap] += docCounts
+        self.dirty = True
+
+    def resizeCounts(self, numClasses, vocabSize):
+        """ Make self.counts a numClasses x vocabSize view, growing the
+        underlying buffer if necessary. """
+
+        rows, cols = self.countsBuf.shape
+        if numClasses > rows or vocabSize > cols:
+            buf = numpy.zeros((max(numClasses, rows),
+                               max(vocabSize, 2 * cols)))
+            buf[:rows, :cols] = self.countsBuf
+            self.countsBuf = buf
+        self.counts = self.countsBuf[:numClasses, :vocabSize]
+        self.docCounts = numpy.concatenate(
+            (self.docCounts,
+             numpy.zeros(numClasses - len(self.docCounts), dtype=numpy.int64)))
+
+    @METRICS.timed('nb_compute_probabilities')
+    def computeProbabilities(self):
+        """ (Re)compute the smoothed log probabilities from the counts, if the
+        counts changed since they were last computed. """
+
+        if not self.dirty:
+            return
+        vocabSize = len(self.vocab)
+        numDocs = self.docCounts.sum()
+        ncs = self.counts.sum(axis=1)
+
+        self.logPwc = numpy.log((self.counts + _EPSILON) /
+                                (ncs + _EPSILON * vocabSize)[:, None])
+        self.logPc = numpy.log(self.docCounts / numDocs)
+        # log probability of a word that did not occur in training at all
+        self.logUnseen = numpy.log(_EPSILON / (ncs + _EPSILON * vocabSize))
+        for idx, label in enumerate(self.labels):
+            self.c[label]['pc'] = float(self.docCounts[idx] / numDocs)
+            self.c[label]['nc'] = int(ncs[idx])
+            self.c[label]['docCount'] = int(self.docCounts[idx])
+        self.dirty = False
+
+    def saveCounts(self, fileName):
+        """ Save a checkpoint of the counts, from which training can be
+        resumed with loadCounts and partialFit.
+
+        >>> import os
+        >>> import tempfile
         >>> nb = NaiveBayes("example.txt", True)
-        >>> nb.predict("example_test.txt")
-        >>> [val['predLabel'] for val in nb.predictions]
-        ['A', 'B']
-        >>> nb.predict("example.txt")
-        >>> [val['predLabel'] for val in nb.predictions]
-        ['A', 'A', 'B', 'A', 'B', 'B']
+        >>> fileName = os.path.join(tempfile.mkdtemp(), 'counts.npz')
+        >>> nb.saveCounts(fileName)
+        >>> nb2 = NaiveBayes(test=True)
+        >>> nb2.loadCounts(fileName)
+        >>> nb2.labels == nb.labels and nb2.vocab.ids == nb.vocab.ids
+        True
+        >>> print('{0:.3f}'.format(nb2.pwc('B', 'b')))
+        0.665
         """
 
-        self.predictions = []
+        counts = scipy.sparse.csr_matrix(self.counts)
+        table, offsets = self.vocab.packed()
+        numpy.savez_compressed(
+            fileName,
+            labels=numpy.array(self.labels),
+            table=table, offsets=offsets,
+            data=counts.data, indices=counts.indices, indptr=counts.indptr,
+            shape=numpy.array(counts.shape),
+            docCounts=self.docCounts)
+
+    def loadCounts(self, fileName):
+        """ Replace the counts by the ones saved with saveCounts. """
+
+        with numpy.load(fileName) as cp:
+            self.labels = cp['labels'].tolist()
+            self.c = {label: {'idx': idx}
+                      for idx, label in enumerate(self.labels)}
+            self.tokenizer.vocab = Vocabulary.fromPacked(cp['table'],
+                                                         cp['offsets'])
+            self.vocab = self.tokenizer.vocab
+            self.countsBuf = scipy.sparse.csr_matrix(
+                (cp['data'], cp['indices'], cp['indptr']),
+                shape=tuple(cp['shape'])).toarray()
+            self.counts = self.countsBuf
+            self.docCounts = cp['docCounts']
+        self.dirty = True
+
+    def memoryReport(self):
+        """ Return the deep memory usage of the model by structure (see
+        metrics.memoryBreakdown). Postings are the non-zero class-term
+        counts.
+
+        >>> nb = NaiveBayes("example.txt", True)
+        >>> report = nb.memoryReport()
+        >>> sorted(report['parts'])
+        ['classes', 'counts', 'logPwc', 'other', 'tokenizer', 'vocab']
+        >>> report['numDocs'], report['numPostings']
+        (6, 4)
+        """
+
+        self.computeProbabilities()
+        parts = [('counts', self.countsBuf, 'vocab'),
+                 ('logPwc', self.logPwc, 'vocab'),
+                 ('vocab', self.vocab, 'vocab'),
+                 ('tokenizer', self.tokenizer, 'fixed'),
+                 ('classes', [self.c, self.labels, self.docCounts,
+                              self.logPc, self.logUnseen], 'fixed')]
+        return memoryBreakdown(self, parts, int(self.docCounts.sum()),
+                               int(numpy.count_nonzero(self.counts)))
+
+    def tokenize(self, text):
+        """ Split a document into words. """
+
+        return self.tokenizer.tokenize(text, removeStopwords=not self.test)
+
+    def countMatrix(self, lines):
+        """ Given labelled lines (<label>\t<text>), return an array with the
+        class index of each line and the sparse document-term count matrix.
+        New labels and terms are added to self.labels and self.vocab.
+        """
+
+        labelInds = array.array('q')
+        termInds = array.array('q')
+        indptr = array.array('q', [0])
+        for line in lines:
+            parts = line.strip().split('\t')
+            label, text = parts[0], parts[1]
+            if label not in self.c:
+                self.c[label] = {'idx': len(self.labels)}
+                self.labels.append(label)
+            labelInds.append(self.c[label]['idx'])
+            for w in self.tokenize(text):
+                termInds.append(self.tokenizer.termId(w))
+            indptr.append(len(termInds))
+
+        X = scipy.sparse.csr_matrix(
+            (numpy.ones(len(termInds)),
+             numpy.frombuffer(termInds, numpy.int64),
+             numpy.frombuffer(indptr, numpy.int64)),
+            shape=(len(labelInds), len(self.vocab)))
+        X.sum_duplicates()
+        return numpy.frombuffer(labelInds, numpy.int64), X
+
+    def pwc(self, label, word):
+        """ Return the (smoothed) probability of the word given the class. """
+
+        self.computeProbabilities()
+        return math.exp(self.logPwc[self.c[label]['idx'],
+                                    self.vocab.ids[word]])
+
+    @METRICS.timed('nb_predict')
+    def predict(self, filename, workers=1):
+        """ Predict a label for each document in the given test file and
+        return the ConfusionMatrix of real vs predicted labels. Only the
+        matrix is kept, so memory does not grow with the test set. With
+        workers > 1, the file is split into byte ranges which are predicted
+        by that many processes, each filling its own matrix.
+
+        >>> nb = NaiveBayes("example.txt", True)
+        >>> nb.predict("example_test.txt").matrix.tolist()
+        [[1, 0], [0, 1]]
+        >>> nb.predict("example.txt").matrix.tolist()
+        [[3, 0], [0, 3]]
+        >>> nb.predict("example.txt", workers=3).matrix.tolist()
+        [[3, 0], [0, 3]]
+        """
+
+        if workers > 1:
+            global _model
+            # compute the probabilities once, not in each worker
+            self.computeProbabilities()
+            _model = self  # inherited by the forked workers
+            ranges = byteRanges(filename, workers)
+            ctx = multiprocessing.get_context('fork')
+            try:
+                with ctx.Pool(workers) as pool:
+                    shards = pool.map(predictRange,
+                                      [(filename, s, e) for s, e in ranges])
+            finally:
+                _model = None
+            cm = ConfusionMatrix(self.labels)
+            for shard in shards:
+                cm.merge(shard)
+            return cm
 
         with open(filename, 'r') as f:
-            for line in f:
-                parts = line.strip().split('\t')
-                realLabel, text = parts[0], parts[1]
-                words = re.sub('\W+', ' ', text.lower()).split()
-                if not self.test:
-                    words = [w for w in words if w not in self.stopwords]
-                prediction = None
-                bestP = -sys.maxsize
-                for label, cls in self.c.items():
-                    prob = 0
-                    for w in words:
-                        if w in cls['pwcs']:
-                            prob += math.log(cls['pwcs'][w])
-                    prob += math.log(cls['pc'])
-                    if prob > bestP:
-                        prediction = label
-                        bestP = prob
-                predObj = {}
-                predObj['doc'] = text
-                predObj['realLabel'] = realLabel
-                predObj['predLabel'] = prediction
-                self.predictions.append(predObj)
-                # pre eval code
-                if 'testDocs' not in self.c[realLabel]:
-                    self.c[realLabel]['testDocs'] = 0
-                self.c[realLabel]['testDocs'] += 1
-                if 'predDocs' not in self.c[prediction]:
-                    self.c[prediction]['predDocs'] = 0
-                self.c[prediction]['predDocs'] += 1
-                if realLabel == prediction:
-                    if 'rightPreds' not in self.c[realLabel]:
-                        self.c[realLabel]['rightPreds'] = 0
-                    self.c[realLabel]['rightPreds'] += 1
+            return self.predictLines(f)
+
+    def predictLines(self, lines):
+        """ Predict labels for labelled lines in chunks of _BATCH_SIZE and
+        return the ConfusionMatrix of real vs predicted labels. """
+
+        cm = ConfusionMatrix(self.labels)
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, _BATCH_SIZE))
+            if len(chunk) == 0:
+                break
+            parts = [line.strip().split('\t') for line in chunk]
+            predLabels = self.predictBatch([p[1] for p in parts])
+            cm.add([p[0] for p in parts], predLabels)
+        return cm
+
+    def vectorize(self, texts):
+        """ Return the sparse document-term count matrix of the given texts
+        w.r.t. the training vocabulary and an array with the number of
+        out-of-vocabulary words of each text.
+        """
+
+        termInds = array.array('q')
+        indptr = array.array('q', [0])
+        oov = array.array('q')
+        for text in texts:
+            unknown = 0
+            for w in self.tokenize(text):
+                termId = self.vocab.get(w)
+                if termId is None:
+                    unknown += 1
+                else:
+                    termInds.append(termId)
+            indptr.append(len(termInds))
+            oov.append(unknown)
+
+        X = scipy.sparse.csr_matrix(
+            (numpy.ones(len(termInds)),
+             numpy.frombuffer(termInds, numpy.int64),
+             numpy.frombuffer(indptr, numpy.int64)),
+            shape=(len(oov), len(self.vocab)))
+        X.sum_duplicates()
+        return X, numpy.frombuffer(oov, numpy.int64)
+
+    @METRICS.timed('nb_predict_batch')
+    def predictBatch(self, texts, scores=False):
+        """ Predict a label for each of the given texts. All class scores are
+        computed at once as X * log(P)^T + log(prior). Words not seen in a
+        class get the smoothed probability mass, words not seen in training
+        at all the mass of an unseen word. Return an array of labels and, if
+        scores is True, also the documents x classes score matrix.
+
+        >>> nb = NaiveBayes("example.txt", True)
+        >>> nb.predictBatch(['a a b', 'b b a c'])
+        array(['A', 'B'], dtype='<U1')
+        >>> labels, scores = nb.predictBatch(['a', 'b'], scores=True)
+        >>> scores.shape
+        (2, 2)
+        >>> [['%.3f' % v for v in row] for row in scores]
+        [['-1.102', '-1.786'], ['-1.785', '-1.101']]
+        """
+
+        self.computeProbabilities()
+        X, oov = self.vectorize(texts)
+        S = numpy.asarray(X * self.logPwc.T) + self.logPc
+        S += oov[:, None] * self.logUnseen
+        labels = numpy.array(self.labels)[numpy.argmax(S, axis=1)]
+        if scores:
+            return labels, S
+        return labels
+
+    def evaluate(self, cm):
+        """ Output the evaluation given by the ConfusionMatrix cm.
+        """
+
+        self.computeProbabilities()
+        ev = cm.evaluate()
+        for idx, label in enumerate(cm.labels):
+            if label in self.c:
+                pc = self.c[label]['pc']
+                print('\nClass {0} (p_c = {1:.3f})'.format(label, pc))
+            else:
+                print('\nClass {0} (not in training data)'.format(label))
+            print('  Precision: {0:.2f}%'.format(ev['precision'][idx]*100))
+            print('  Recall: {0:.2f}%'.format(ev['recall'][idx]*100))
+            print('  F-Score: {0:.2f}%'.format(ev['fscore'][idx]*100))
+            if label in self.c:
+                bestIds = numpy.argsort(-self.logPwc[self.c[label]['idx']],
+                                        kind='stable')
+                bestWords = self.vocab.terms(bestIds[0:30])
+                print('  Top 30 words: {0}'.format(', '.join(bestWords)))
+
+        for avg in ['macro', 'micro']:
+            print('\n{0}-average'.format(avg.capitalize()))
+            print('  Precision: {0:.2f}%'.format(ev[avg + 'Precision']*100))
+            print('  Recall: {0:.2f}%'.format(ev[avg + 'Recall']*100))
+            print('  F-Score: {0:.2f}%'.format(ev[avg + 'Fscore']*100))
+
+
+class ConfusionMatrix():
+    """ Class for counting (real, predicted) label pairs in a classes x
+    classes matrix and computing evaluation measures from it. """
+
+    def __init__(self, labels):
+        """ Create an empty matrix for the given labels. Labels not given here
+        are added when they first occur.
+
+        >>> cm = ConfusionMatrix(['A', 'B'])
+        >>> cm.add(['A', 'A', 'B', 'C'], ['A', 'B', 'B', 'A'])
+        >>> cm.labels, cm.matrix.tolist()
+        (['A', 'B', 'C'], [[1, 1, 0], [0, 1, 0], [1, 0, 0]])
+        """
+
+        self.labels = []
+        self.labelIds = {}
+        self.matrix = numpy.zeros((0, 0), dtype=numpy.int64)
+        self.addLabels(labels)
+
+    def addLabels(self, labels):
+        """ Add unknown labels as new rows/columns. """
+
+        for label in labels:
+            if label not in self.labelIds:
+                self.labelIds[label] = len(self.labels)
+                self.labels.append(label)
+        n = len(self.labels)
+        if n > self.matrix.shape[0]:
+            matrix = numpy.zeros((n, n), dtype=numpy.int64)
+            old = self.matrix.shape[0]
+            matrix[:old, :old] = self.matrix
+            self.matrix = matrix
+
+    def add(self, realLabels, predLabels):
+        """ Count the given pairs of real and predicted labels. Unknown
+        labels are added in the order they first occur.
+
+        >>> cm = ConfusionMatrix(['A'])
+        >>> cm.add(['E', 'A', 'D'], ['C', 'B', 'A'])
+        >>> cm.labels
+        ['A', 'E', 'D', 'C', 'B']
+        """
+
+        self.addLabels(itertools.chain(realLabels, predLabels))
+        realIds = numpy.array([self.labelIds[r] for r in realLabels],
+                              dtype=numpy.int64)
+        predIds = numpy.array([self.labelIds[p] for p in predLabels],
+                              dtype=numpy.int64)
+        numpy.add.at(self.matrix, (realIds, predIds), 1)
+
+    def merge(self, other):
+        """ Add the counts of another ConfusionMatrix. """
+
+        self.addLabels(other.labels)
+        ids = numpy.array([self.labelIds[label] for label in other.labels],
+                          dtype=numpy.int64)
+        self.matrix[numpy.ix_(ids, ids)] += other.matrix
 
     def evaluate(self):
-        """ Calculate and output evaluation.
+        """ Return per class precision, recall and F-score (arrays in the
+        order of self.labels) and their macro and micro averages. Undefined
+        values (division by zero) are 0.
+
+        >>> cm = ConfusionMatrix(['A', 'B'])
+        >>> cm.add(['A', 'A', 'A', 'B'], ['A', 'A', 'B', 'B'])
+        >>> ev = cm.evaluate()
+        >>> [float('%.3f' % v) for v in ev['precision']]
+        [1.0, 0.5]
+        >>> [float('%.3f' % v) for v in ev['recall']]
+        [0.667, 1.0]
+        >>> float('%.3f' % ev['macroFscore']), float(ev['microFscore'])
+        (0.733, 0.75)
         """
 
-        for label, cls in self.c.items():
-            print('\nClass {0} (p_c = {1:.3f})'.format(label, cls['pc']))
-            precision = cls['rightPreds'] / cls['predDocs']
-            recall = cls['rightPreds'] / cls['testDocs']
-            fscore = (2 * precision * recall) / (precision + recall)
-            print('  Precision: {0:.2f}%'.format(precision*100))
-            print('  Recall: {0:.2f}%'.format(recall*100))
-            print('  F-Score: {0:.2f}%'.format(fscore*100))
-            bestWords = sorted(cls['pwcs'], key=cls['pwcs'].get, reverse=True)
-            print('  Top 30 words: {0}'.format(', '.join(bestWords[0:30])))
+        def divide(a, b):
+            a = numpy.asarray(a, dtype=numpy.float64)
+            b = numpy.asarray(b, dtype=numpy.float64)
+            return numpy.divide(a, b, out=numpy.zeros_like(a), where=b != 0)
+
+        right = numpy.diag(self.matrix)
+        predDocs = self.matrix.sum(axis=0)
+        testDocs = self.matrix.sum(axis=1)
+        ev = {}
+        ev['precision'] = divide(right, predDocs)
+        ev['recall'] = divide(right, testDocs)
+        ev['fscore'] = divide(2 * ev['precision'] * ev['recall'],
+                              ev['precision'] + ev['recall'])
+        ev['macroPrecision'] = float(ev['precision'].mean())
+        ev['macroRecall'] = float(ev['recall'].mean())
+        ev['macroFscore'] = float(ev['fscore'].mean())
+        ev['microPrecision'] = float(divide(right.sum(), predDocs.sum()))
+        ev['microRecall'] = float(divide(right.sum(), testDocs.sum()))
+        ev['microFscore'] = float(divide(
+            2 * ev['microPrecision'] * ev['microRecall'],
+            ev['microPrecision'] + ev['microRecall']))
+        return ev
+
+
+def byteRanges(filename, numRanges):
+    """ Split the file into numRanges (start, end) byte ranges of similar
+    size. Lines are assigned to the range in which they start.
+
+    >>> byteRanges('example.txt', 2)
+    [(0, 38), (38, 77)]
+    """
+
+    size = os.path.getsize(filename)
+    bounds = [size * i // numRanges for i in range(numRanges + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(numRanges)]
+
+
+def readRange(filename, start, end):
+    """ Yield the lines of the file that start within [start, end),
+    decoded like a file opened in text mode (with the locale encoding).
+
+    >>> [len(list(readRange('example.txt', s, e))) for s, e in
+    ...  byteRanges('example.txt', 4)]
+    [2, 1, 2, 1]
+    """
+
+    encoding = locale.getpreferredencoding(False)
+    with open(filename, 'rb') as f:
+        if start > 0:
+            # skip the line that started before this range
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            pos += len(line)
+            yield line.decode(encoding)
+
+
+def countRange(args):
+    """ Worker of NaiveBayes.fitParallel: count a byte range of a file. """
+
+    filename, start, end, test = args
+    nb = NaiveBayes(test=test)
+    nb.partialFit(readRange(filename, start, end))
+    return (nb.labels, nb.vocab.terms(), scipy.sparse.csr_matrix(nb.counts),
+            nb.docCounts)
+
+
+def predictRange(args):
+    """ Worker of NaiveBayes.predict: predict a byte range of a file with the
+    model inherited from the parent process. """
+
+    filename, start, end = args
+    return _model.predictLines(readRange(filename, start, end))
 
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python3 naive_bayes.py <train-input> <test-input>")
+    memory = '--memory' in sys.argv  # print a memory report
+    if memory:
+        sys.argv.remove('--memory')
+    if len(sys.argv) not in [3, 4]:
+        print("Usage: python3 naive_bayes.py <train-input> <test-input> "
+              "[<workers>] [--memory]")
         exit(1)
 
-    nb = NaiveBayes(sys.argv[1])
-    nb.predict(sys.argv[2])
-    nb.evaluate()
+    workers = int(sys.argv[3]) if len(sys.argv) == 4 else 1
+    nb = NaiveBayes(sys.argv[1], workers=workers)
+    if memory:
+        print(formatMemoryReport(nb.memoryReport()))
+    cm = nb.predict(sys.argv[2], workers=workers)
+    nb.evaluate(cm)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,89 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import argparse
+import sys
+import time
+from metrics import METRICS
+from naive_bayes import NaiveBayes
+from synthetic import addCorpusArguments, addScalingArguments, \
+    corpusParams, finishScaling, generateCorpus, phaseTimes, runScaling
+
+
+def runNaiveBayes(numDocs, args):
+    """ Train Naive Bayes on a labelled synthetic corpus of numDocs
+    documents and predict the labels of the args.test documents that follow
+    them in the corpus. Return a dict with the times, the prediction
+    throughput and batch latency, the test scores and (with --memory) the
+    memory usage.
+
+    >>> args = parseArgs(['--vocab', '500', '--length', '20', '--test', '200',
+    ...                   '--memory'])
+    >>> run = runNaiveBayes(1000, args)
+    >>> sorted(run) # doctest: +NORMALIZE_WHITESPACE
+    ['batchMs', 'bytesPerDoc', 'docsPerSecond', 'microFscore', 'modelMb',
+     'numTerms', 'phases', 'predictSeconds', 'trainSeconds']
+    >>> run['microFscore'] > 0.5
+    True
+    """
+
+    run = {}
+    nb = NaiveBayes(test=True)  # the synthetic terms are no stopwords
+    start = time.perf_counter()
+    nb.partialFit(generateCorpus(numDocs, **corpusParams(args)))
+    nb.computeProbabilities()
+    run['trainSeconds'] = round(time.perf_counter() - start, 3)
+    run['numTerms'] = len(nb.vocab)
+
+    start = time.perf_counter()
+    cm = nb.predictLines(generateCorpus(args.test, **corpusParams(args),
+                                        firstDoc=numDocs))
+    run['predictSeconds'] = round(time.perf_counter() - start, 3)
+    run['docsPerSecond'] = round(args.test / run['predictSeconds'], 1)
+    batches = METRICS.histograms['nb_predict_batch_seconds']
+    run['batchMs'] = round(batches.sum * 1000 / batches.count, 3)
+    run['microFscore'] = round(cm.evaluate()['microFscore'], 4)
+    run['phases'] = phaseTimes()
+
+    if args.memory:
+        report = nb.memoryReport()
+        run['modelMb'] = round(report['total'] / 2 ** 20, 1)
+        run['bytesPerDoc'] = round(report['bytesPerDoc'], 1)
+    return run
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description='Scaling benchmark of Naive Bayes on labelled synthetic '
+                    'Zipfian corpora: training time, peak RSS and prediction '
+                    'throughput per corpus size, written as JSON report.')
+    addCorpusArguments(parser, numClasses=5)
+    addScalingArguments(parser)
+    parser.add_argument('--test', type=int, default=10000,
+                        help='number of test documents')
+    parser.add_argument('--memory', action='store_true',
+                        help='add the memory report of the model')
+    args = parser.parse_args(argv)
+    if args.classes < 1:
+        parser.error('--classes must be at least 1')
+    return args
+
+
+def main(argv):
+    args = parseArgs(argv)
+    params = corpusParams(args)
+    params['test'] = args.test
+    sizes = [int(size) for size in args.sizes.split(',')]
+    report = runScaling('naive_bayes',
+                        lambda numDocs: runNaiveBayes(numDocs, args), sizes,
+                        params, args.timeout)
+    finishScaling(report, args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1 @@
+../shared/tokenizer.py
\ No newline at end of file
@@ -0,0 +1,392 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+
+Named counters, timers and histograms for the build and query paths, and
+memory accounting of loaded models. The environment variables
+
+    IR_METRICS=json|prometheus  write all metrics to stderr (or to the file
+                                IR_METRICS_FILE) when the process exits
+    IR_PROFILE=cprofile,tracemalloc
+                                profile the whole process (CPU and/or
+                                memory), results are written to
+                                IR_PROFILE_DIR (default: .) on exit
+
+are read when the module is imported.
+"""
+
+import atexit
+import bisect
+import contextlib
+import cProfile
+import functools
+import json
+import mmap
+import numpy
+import os
+import re
+import sys
+import time
+import tracemalloc
+import types
+
+# upper bounds of the histogram buckets for durations (s) and sizes
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                5.0, 10.0, 60.0, float('inf'))
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, float('inf'))
+# corpus sizes (number of documents) memory reports are projected to
+PROJECTION_DOCS = (10 ** 5, 10 ** 6, 10 ** 7)
+# Heaps' law exponent: the vocabulary of n documents grows like n^beta
+HEAPS_BETA = 0.5
+# objects deepSizeof does not descend into (shared by everybody)
+_OPAQUE = (type, types.ModuleType, types.FunctionType,
+           types.BuiltinFunctionType, types.MethodType)
+
+
+class Histogram:
+    """ Class for counting observed values in buckets with fixed upper
+    bounds. """
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ Return the upper bound of the bucket the q-quantile falls into
+        (None if there are no values or it is in the open last bucket).
+
+        >>> h = Histogram(SIZE_BUCKETS)
+        >>> for value in [3, 5, 50, 70, 80, 5000]:
+        ...     h.observe(value)
+        >>> h.quantile(0.5), h.quantile(0.9), h.quantile(1.0)
+        (100, 10000, 10000)
+        """
+
+        if self.count == 0:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return None if bound == float('inf') else bound
+
+
+class Metrics:
+    """ Class for a registry of named counters and histograms. """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        """ Add value to the counter with the given name. """
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS):
+        """ Add value to the histogram with the given name (created with the
+        given buckets on first use). """
+
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """ Context manager adding the duration of its block to the
+        histogram name + '_seconds'.
+
+        >>> m = Metrics()
+        >>> for i in range(3):
+        ...     with m.timer('pass1'):
+        ...         pass
+        >>> m.histograms['pass1_seconds'].count
+        3
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name + '_seconds', time.perf_counter() - start)
+
+    def timed(self, name):
+        """ Decorator timing each call of a function (see timer). """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name + '_seconds',
+                                 time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def report(self):
+        """ Return all metrics as a dict (histograms with count, sum, mean
+        and estimated quantiles).
+
+        >>> m = Metrics()
+        >>> m.count('postings', 7)
+        >>> m.observe('candidates', 40, SIZE_BUCKETS)
+        >>> m.report()['counters']
+        {'postings': 7}
+        >>> m.report()['histograms']['candidates']['p50']
+        100
+        """
+
+        histograms = {}
+        for name, h in sorted(self.histograms.items()):
+            histograms[name] = {
+                'count': h.count, 'sum': h.sum,
+                'mean': h.sum / h.count if h.count > 0 else None,
+                'p50': h.quantile(0.5), 'p95': h.quantile(0.95),
+                'p99': h.quantile(0.99)}
+        return {'counters': dict(sorted(self.counters.items())),
+                'histograms': histograms}
+
+    def toJson(self):
+        return json.dumps(self.report(), indent=2)
+
+    def toPrometheus(self, prefix='ir_'):
+        """ Return all metrics in the Prometheus text exposition format.
+
+        >>> m = Metrics()
+        >>> m.count('query.postings', 3)
+        >>> m.observe('size', 5, (10, float('inf')))
+        >>> print(m.toPrometheus())
+        # TYPE ir_query_postings counter
+        ir_query_postings 3
+        # TYPE ir_size histogram
+        ir_size_bucket{le="10"} 1
+        ir_size_bucket{le="+Inf"} 1
+        ir_size_sum 5.0
+        ir_size_count 1
+        """
+
+        def metricName(name):
+            return prefix + re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            name = metricName(name)
+            lines.append('# TYPE {0} counter'.format(name))
+            lines.append('{0} {1}'.format(name, value))
+        for name, h in sorted(self.histograms.items()):
+            name = metricName(name)
+            lines.append('# TYPE {0} histogram'.format(name))
+            seen = 0
+            for bound, count in zip(h.buckets, h.counts):
+                seen += count
+                le = '+Inf' if bound == float('inf') else '{0:g}'.format(
+                    bound)
+                lines.append('{0}_bucket{{le="{1}"}} {2}'.format(name, le,
+                                                                 seen))
+            lines.append('{0}_sum {1}'.format(name, h.sum))
+            lines.append('{0}_count {1}'.format(name, h.count))
+        return '\n'.join(lines)
+
+
+METRICS = Metrics()  # registry used by the build and query paths
+
+
+def deepSizeof(obj, seen=None):
+    """ Return the number of bytes used by obj and all objects reachable
+    from it (through containers and attributes). Objects in seen (a set of
+    ids, updated) are not counted again. Numpy arrays count their data
+    buffer, except for memory mapped files which are not on the heap.
+
+    >>> import sys
+    >>> s = 'x' * 1000
+    >>> deepSizeof([s, s]) == sys.getsizeof([s, s]) + sys.getsizeof(s)
+    True
+    >>> a = numpy.zeros(1000)
+    >>> deepSizeof(a[0:10]) > 8000
+    True
+    """
+
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while len(stack) > 0:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _OPAQUE):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, numpy.ndarray):
+            if obj.base is not None:  # a view, count what it is a view on
+                stack.append(obj.base)
+        elif hasattr(obj, '__dict__'):
+            stack.append(vars(obj))
+    return size
+
+
+def mappedBytes(obj):
+    """ Return the size of the data of a numpy array backed by a memory
+    mapped file (0 for other objects). """
+
+    base = obj
+    while isinstance(base, numpy.ndarray):
+        base = base.base
+    return obj.nbytes if isinstance(base, mmap.mmap) else 0
+
+
+def memoryBreakdown(owner, parts, numDocs, numPostings,
+                    targets=PROJECTION_DOCS):
+    """ Return a dict with the deep size in bytes of each part of owner,
+    given as list of (name, object, scaling), and of the rest of owner
+    ('other'). Objects shared by several parts are counted for the first.
+    Memory mapped arrays are not included, their sizes are listed under
+    'mapped' (their pages are loaded as they are used). All sizes are
+    projected to corpora of targets documents, the scaling of a part is
+    'docs' (linear in the number of documents), 'vocab' (grows like the
+    vocabulary, see HEAPS_BETA) or 'fixed' (as is 'other').
+
+    >>> class Model:
+    ...     pass
+    >>> model = Model()
+    >>> model.postings = numpy.zeros(1000, dtype=numpy.int64)
+    >>> model.table = numpy.zeros(100, dtype=numpy.int64)
+    >>> report = memoryBreakdown(model, [
+    ...     ('postings', model.postings, 'docs'),
+    ...     ('table', model.table, 'vocab')], 10, 1000, [1000])
+    >>> report['bytesPerPosting'] > 8, report['bytesPerDoc'] > 800
+    (True, True)
+    >>> p = report['parts']
+    >>> report['projection'][1000] == int(100 * p['postings'] +
+    ...                                   10 * p['table'] + p['other'])
+    True
+    """
+
+    seen = set()
+    sizes = {}
+    scalings = {}
+    mapped = {}
+    for name, obj, scaling in parts:
+        sizes[name] = deepSizeof(obj, seen)
+        scalings[name] = scaling
+        if mappedBytes(obj) > 0:
+            mapped[name] = mappedBytes(obj)
+    sizes['other'] = deepSizeof(owner, seen)
+    scalings['other'] = 'fixed'
+    total = sum(sizes.values())
+
+    projection = {}
+    for target in targets:
+        factor = target / max(numDocs, 1)
+        exponent = {'docs': 1, 'vocab': HEAPS_BETA, 'fixed': 0}
+        projection[target] = int(sum(
+            (size + mapped.get(name, 0)) * factor ** exponent[scalings[name]]
+            for name, size in sizes.items()))
+    return {'parts': sizes, 'total': total, 'mapped': mapped,
+            'numDocs': numDocs, 'numPostings': numPostings,
+            'bytesPerPosting': total / numPostings if numPostings > 0
+            else None,
+            'bytesPerDoc': total / max(numDocs, 1),
+            'projection': projection}
+
+
+def formatMemoryReport(report):
+    """ Return a memory report of memoryBreakdown as printable table. """
+
+    def mb(size):
+        return '{0:10.1f} MB'.format(size / 2 ** 20)
+
+    total = max(report['total'], 1)
+    lines = []
+    for name, size in sorted(report['parts'].items(), key=lambda x: -x[1]):
+        lines.append('{0:<20}{1} {2:6.1f}%'.format(name, mb(size),
+                                                   100 * size / total))
+    lines.append('{0:<20}{1}'.format('total', mb(report['total'])))
+    for name, size in sorted(report['mapped'].items()):
+        lines.append('{0:<20}{1} (memory mapped)'.format(name, mb(size)))
+    line = '{0} docs: {1:.1f} bytes/doc'.format(
+        report['numDocs'], report['bytesPerDoc'])
+    if report['bytesPerPosting'] is not None:
+        line += ', {0} postings: {1:.1f} bytes/posting'.format(
+            report['numPostings'], report['bytesPerPosting'])
+    lines.append(line)
+    for target, size in sorted(report['projection'].items()):
+        lines.append('projected for {0:>10} docs:{1}'.format(target,
+                                                             mb(size)))
+    return '\n'.join(lines)
+
+
+def writeMetrics(fmt, fileName=None):
+    """ Write METRICS as 'json' or 'prometheus' to the file (default:
+    stderr). """
+
+    text = METRICS.toJson() if fmt == 'json' else METRICS.toPrometheus()
+    if fileName is None:
+        print(text, file=sys.stderr)
+    else:
+        with open(fileName, 'w') as f:
+            f.write(text + '\n')
+
+
+def startProfiling(modes, dirName='.'):
+    """ Start profiling the process with cProfile and/or tracemalloc (modes
+    is a collection of 'cprofile' and 'tracemalloc'). The results are
+    written to dirName when the process exits: CPU profile to
+    profile-<pid>.prof (for pstats), top allocation sites to
+    tracemalloc-<pid>.txt. """
+
+    pid = os.getpid()
+    if 'cprofile' in modes:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dumpProfile():
+            if os.getpid() == pid:  # not in forked children
+                profiler.disable()
+                profiler.dump_stats(os.path.join(
+                    dirName, 'profile-{0}.prof'.format(pid)))
+        atexit.register(dumpProfile)
+    if 'tracemalloc' in modes:
+        tracemalloc.start(10)
+
+        def dumpAllocations():
+            if os.getpid() != pid:
+                return
+            current, peak = tracemalloc.get_traced_memory()
+            stats = tracemalloc.take_snapshot().statistics('lineno')
+            with open(os.path.join(
+                    dirName, 'tracemalloc-{0}.txt'.format(pid)), 'w') as f:
+                f.write('current {0} bytes, peak {1} bytes\n'.format(
+                    current, peak))
+                for stat in stats[0:25]:
+                    f.write('{0}\n'.format(stat))
+        atexit.register(dumpAllocations)
+
+
+if os.environ.get('IR_METRICS') in ['json', 'prometheus']:
+    atexit.register(writeMetrics, os.environ['IR_METRICS'],
+                    os.environ.get('IR_METRICS_FILE'))
+if os.environ.get('IR_PROFILE'):
+    startProfiling(os.environ['IR_PROFILE'].split(','),
+                   os.environ.get('IR_PROFILE_DIR', '.'))
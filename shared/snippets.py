@@ -0,0 +1,176 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import functools
+import re
+import sys
+import time
+
+
+class Highlighter:
+    """ Class for highlighting the keywords of one query in texts. All
+    keywords are matched in a single pass by one compiled (case insensitive)
+    alternation. """
+
+    def __init__(self, keywords, before='\033[32m', after='\033[0m'):
+        r""" Create the highlighter for the given keywords, matches are
+        wrapped in before and after (default: green on a terminal).
+
+        >>> hl = Highlighter(['web', 'a.b', 'web', ''], '[', ']')
+        >>> hl.highlight('The Web is not a.b, aXb or webs')
+        'The [Web] is not [a.b], aXb or webs'
+        """
+
+        keywords = set(k.lower() for k in keywords if len(k) > 0)
+        """ Longest first, so that no keyword hides a longer one. """
+        keywords = sorted(keywords, key=lambda k: (-len(k), k))
+        self.pattern = None
+        if len(keywords) > 0:
+            self.pattern = re.compile(
+                r'\b(?:' + '|'.join(re.escape(k) for k in keywords) + r')\b',
+                re.IGNORECASE)
+        self.before = before
+        self.after = after
+
+    def matches(self, text):
+        """ Return the (start, end) offsets of the keywords in the text. """
+
+        if self.pattern is None:
+            return []
+        return [m.span() for m in self.pattern.finditer(text)]
+
+    def highlight(self, text, spans=None):
+        """ Return the text with the keywords (or the given spans of the
+        text) highlighted. """
+
+        if spans is None:
+            spans = self.matches(text)
+        parts = []
+        pos = 0
+        for start, end in spans:
+            parts.append(text[pos:start])
+            parts.append(self.before + text[start:end] + self.after)
+            pos = end
+        parts.append(text[pos:])
+        return ''.join(parts)
+
+    def window(self, text, width, spans=None):
+        """ Return the (start, end) offsets of the part of the text of at
+        most width characters that contains the most keywords (or of the
+        given spans of the text). The part starts and ends at word
+        boundaries where possible.
+
+        >>> hl = Highlighter(['bond', 'connery'])
+        >>> text = 'bond ' + 'x ' * 20 + 'james bond with sean connery'
+        >>> start, end = hl.window(text, 30)
+        >>> text[start:end]
+        'x james bond with sean connery'
+        """
+
+        if len(text) <= width:
+            return 0, len(text)
+        if spans is None:
+            spans = self.matches(text)
+        start = 0
+        if len(spans) > 0:
+            """ Densest run of matches spans[i:j] that fits the width. """
+            best, bestI, bestJ = 0, 0, 0
+            j = 0
+            for i in range(len(spans)):
+                j = max(j, i)
+                while j < len(spans) and spans[j][1] - spans[i][0] <= width:
+                    j += 1
+                if j - i > best:
+                    best, bestI, bestJ = j - i, i, j
+            if best > 0:
+                """ Center the matches in the window. """
+                first, last = spans[bestI][0], spans[bestJ - 1][1]
+                start = max(0, first - (width - (last - first)) // 2)
+            else:
+                start = spans[0][0]
+        end = min(len(text), start + width)
+        start = max(0, end - width)
+
+        """ Do not cut words. """
+        if start > 0 and not text[start - 1].isspace():
+            space = text.find(' ', start, end)
+            if space >= 0:
+                start = space + 1
+        if end < len(text) and not text[end].isspace():
+            space = text.rfind(' ', start, end)
+            if space > start:
+                end = space
+        return start, end
+
+    def snippet(self, text, width=200, ellipsis='...'):
+        """ Return the part of the text of at most width characters with the
+        most keywords, highlighted.
+
+        >>> hl = Highlighter(['bond', 'connery'], '<', '>')
+        >>> hl.snippet('bond ' + 'x ' * 20 + 'james bond with sean connery',
+        ...            30)
+        '...x james <bond> with sean <connery>'
+        >>> hl.snippet('no keyword here', 8)
+        'no...'
+        """
+
+        spans = self.matches(text)
+        start, end = self.window(text, width, spans)
+        spans = [(s - start, e - start) for s, e in spans
+                 if s >= start and e <= end]
+        result = self.highlight(text[start:end], spans)
+        if start > 0:
+            result = ellipsis + result
+        if end < len(text):
+            result = result + ellipsis
+        return result
+
+
+@functools.lru_cache(maxsize=256)
+def highlighter(query):
+    """ Return the (cached) Highlighter for the keywords of the query.
+
+    >>> highlighter('web surfing') is highlighter('web surfing')
+    True
+    """
+
+    return Highlighter(query.split(' '))
+
+
+if __name__ == '__main__':
+    """ Micro-benchmark: compare highlighting the 3 best lines per query with
+    one regex substitution per keyword to snippets of the cached
+    highlighters, for the lines of a file given as command line parameter.
+    """
+
+    if len(sys.argv) != 2:
+        print('Usage: python3 snippets.py <filename>')
+        sys.exit()
+
+    with open(sys.argv[1]) as f:
+        lines = [line.strip() for line in f]
+    queries = [' '.join(line.split(' ')[0:3]) for line in lines[0:1000]]
+
+    start = time.time()
+    for i, query in enumerate(queries):
+        for line in lines[i:i + 3]:
+            for keyword in query.split(' '):
+                patt = r'\b(' + keyword + r')\b'
+                line = re.sub(patt, '\033[32m\\g<0>\033[0m', line, flags=re.I)
+    end = time.time()
+    print('re.sub per keyword: {0:.3f}ms per query'.format(
+        (end - start) * 1000 / len(queries)))
+
+    start = time.time()
+    for i, query in enumerate(queries):
+        hl = highlighter(query)
+        for line in lines[i:i + 3]:
+            hl.snippet(line)
+    end = time.time()
+    print('Highlighter snippets: {0:.3f}ms per query'.format(
+        (end - start) * 1000 / len(queries)))
@@ -0,0 +1,363 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+
+Deterministic synthetic corpora for scaling benchmarks, and helpers to run
+one benchmark per corpus size in its own process and compare the results.
+The term with Zipf rank r (starting at 0) is 'w<r>'.
+"""
+
+import argparse
+import json
+import numpy
+import os
+import platform
+import signal
+import sys
+import traceback
+from metrics import METRICS
+
+_CHUNK_DOCS = 10000  # documents generated per random stream
+_CLASS_STREAM = 1 << 30  # stream of the class topic permutations
+_QUERY_STREAM = 1 << 31  # stream of the queries
+# corpus sizes (number of documents) scaling benchmarks run with by default
+SCALING_DOCS = (10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+
+
+def zipfCdf(vocabSize, zipf=1.0, skip=0):
+    """ Return the cumulative distribution over the ranks skip ... vocabSize
+    - 1 with probabilities proportional to 1 / (rank + 1)^zipf.
+
+    >>> [float('%.3f' % p) for p in zipfCdf(4)]
+    [0.48, 0.72, 0.88, 1.0]
+    """
+
+    weights = 1.0 / numpy.arange(skip + 1, vocabSize + 1) ** zipf
+    cdf = numpy.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def sampleRanks(rng, cdf, size, skip=0):
+    """ Draw size ranks from the distribution of zipfCdf. """
+
+    ranks = numpy.searchsorted(cdf, rng.random(size), side='right')
+    return numpy.minimum(ranks, len(cdf) - 1) + skip
+
+
+def generateCorpus(numDocs, vocabSize=100000, docLength=100, zipf=1.0,
+                   seed=0, numClasses=0, topicWeight=0.3, firstDoc=0):
+    """ Yield numDocs lines of text (starting with the document number
+    firstDoc of the corpus) with Poisson distributed lengths (mean
+    docLength, at least 1) and terms drawn from a Zipf distribution over
+    vocabSize terms. With numClasses > 0, each line is '<label>\\t<text>'
+    with a uniformly drawn label 'c<i>', and a topicWeight fraction of the
+    terms is drawn from the Zipf distribution over a permutation of the
+    vocabulary specific to the class.
+
+    The corpus only depends on the parameters, and a smaller corpus is a
+    prefix of a larger one with the same parameters.
+
+    >>> list(generateCorpus(3, vocabSize=10, docLength=4, seed=1))
+    ['w2 w1 w0 w4 w2', 'w0 w0 w5', 'w2 w5 w8 w1 w3']
+    >>> list(generateCorpus(2, 10, 4, seed=1, numClasses=2))
+    ['c1\\tw2 w1 w0 w4 w2', 'c1\\tw0 w1 w7']
+    >>> big = list(generateCorpus(25000, 1000, 5))
+    >>> big[0:12000] == list(generateCorpus(12000, 1000, 5))
+    True
+    >>> big[9000:21000] == list(generateCorpus(12000, 1000, 5, firstDoc=9000))
+    True
+    """
+
+    words = ['w{0}'.format(rank) for rank in range(vocabSize)]
+    cdf = zipfCdf(vocabSize, zipf)
+    if numClasses > 0:
+        rng = numpy.random.default_rng([seed, _CLASS_STREAM])
+        topics = [rng.permutation(vocabSize) for c in range(numClasses)]
+        labels = ['c{0}'.format(c) for c in range(numClasses)]
+
+    endDoc = firstDoc + numDocs
+    for chunk in range(firstDoc // _CHUNK_DOCS,
+                       (endDoc + _CHUNK_DOCS - 1) // _CHUNK_DOCS):
+        # one stream per chunk, generated in full so that prefixes match
+        rng = numpy.random.default_rng([seed, chunk])
+        lengths = numpy.maximum(rng.poisson(docLength, _CHUNK_DOCS), 1)
+        ranks = sampleRanks(rng, cdf, lengths.sum())
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        if numClasses > 0:
+            docClasses = rng.integers(numClasses, size=_CHUNK_DOCS)
+            topical = rng.random(len(ranks)) < topicWeight
+            tokenClasses = numpy.repeat(docClasses, lengths)
+            for c in range(numClasses):
+                mask = topical & (tokenClasses == c)
+                ranks[mask] = topics[c][ranks[mask]]
+        ranks = ranks.tolist()
+        chunkStart = chunk * _CHUNK_DOCS
+        for doc in range(max(firstDoc, chunkStart) - chunkStart,
+                         min(endDoc, chunkStart + _CHUNK_DOCS) - chunkStart):
+            text = ' '.join([words[rank] for rank in
+                             ranks[offsets[doc]:offsets[doc + 1]]])
+            if numClasses > 0:
+                yield labels[docClasses[doc]] + '\t' + text
+            else:
+                yield text
+
+
+def generateQueries(numQueries, vocabSize=100000, zipf=1.0, seed=0,
+                    maxWords=3, skip=100):
+    """ Return numQueries queries of 1 to maxWords terms drawn from the
+    Zipf distribution of generateCorpus without its skip most frequent terms
+    (which play the role of stopwords).
+
+    >>> generateQueries(3, 1000, seed=1)
+    ['w317 w366 w395', 'w536', 'w118']
+    """
+
+    skip = min(skip, vocabSize - 1)
+    rng = numpy.random.default_rng([seed, _QUERY_STREAM])
+    cdf = zipfCdf(vocabSize, zipf, skip)
+    lengths = rng.integers(1, maxWords + 1, size=numQueries)
+    ranks = sampleRanks(rng, cdf, lengths.sum(), skip).tolist()
+    queries = []
+    pos = 0
+    for length in lengths:
+        queries.append(' '.join('w{0}'.format(rank)
+                                for rank in ranks[pos:pos + length]))
+        pos += length
+    return queries
+
+
+def phaseTimes():
+    """ Return the total seconds per timed phase recorded in METRICS (see
+    metrics.Metrics.timer). """
+
+    return {name[:-len('_seconds')]: round(h.sum, 3)
+            for name, h in sorted(METRICS.histograms.items())
+            if name.endswith('_seconds')}
+
+
+def runIsolated(function, *args, timeout=None):
+    """ Call function(*args) in a forked process, so that its memory usage
+    is measured alone (and freed afterwards). The function returns a dict
+    (JSON serializable), which is returned with 'status' ('ok', 'timeout',
+    'failed' or 'killed by signal <n>', e.g. when out of memory) and
+    'peakRssMb' added. The function is stopped after timeout seconds.
+
+    >>> def allocate(n):
+    ...     return {'sum': int(numpy.ones(n, dtype=numpy.int8).sum())}
+    >>> result = runIsolated(allocate, 200 * 2 ** 20)
+    >>> result['status'], result['sum'], result['peakRssMb'] > 200
+    ('ok', 209715200, True)
+    >>> import time
+    >>> runIsolated(time.sleep, 5, timeout=1)['status']
+    'timeout'
+    """
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            os.close(read)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if timeout is not None:
+                signal.alarm(int(timeout))
+            result = function(*args)
+            with os.fdopen(write, 'w') as f:
+                json.dump(result, f)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    os.close(write)
+    with os.fdopen(read) as f:
+        output = f.read()
+    pid, status, rusage = os.wait4(pid, 0)
+    result = {}
+    if os.WIFSIGNALED(status):
+        sig = os.WTERMSIG(status)
+        result['status'] = 'timeout' if sig == signal.SIGALRM else \
+            'killed by signal {0}'.format(sig)
+    elif os.WEXITSTATUS(status) != 0:
+        result['status'] = 'failed'
+    else:
+        result = json.loads(output)
+        result['status'] = 'ok'
+    result['peakRssMb'] = round(rusage.ru_maxrss / 1024, 1)  # KB on Linux
+    return result
+
+
+def runScaling(suite, function, sizes, params, timeout=None):
+    """ Run function(numDocs) isolated (see runIsolated) for each size and
+    return the report: the suite name, the parameters, the machine and a
+    run per size. Sizes after the first one that did not finish are
+    skipped, since they would not finish either. """
+
+    report = {'suite': suite, 'params': params,
+              'machine': {'python': platform.python_version(),
+                          'numpy': numpy.__version__,
+                          'platform': platform.platform(),
+                          'cpus': os.cpu_count()},
+              'runs': []}
+    failed = False
+    for numDocs in sizes:
+        if failed:
+            run = {'status': 'skipped'}
+        else:
+            print('{0}: {1} docs ...'.format(suite, numDocs), flush=True)
+            run = runIsolated(function, numDocs, timeout=timeout)
+            failed = run['status'] != 'ok'
+        run['docs'] = numDocs
+        report['runs'].append(run)
+        print(json.dumps(run), flush=True)
+    return report
+
+
+def flatten(values, prefix=''):
+    """ Return a nested dict as flat dict with dotted keys.
+
+    >>> flatten({'a': 1, 'b': {'c': 2, 'd': {'e': 3}}})
+    {'a': 1, 'b.c': 2, 'b.d.e': 3}
+    """
+
+    flat = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compareScaling(baseline, report, tolerance):
+    """ Compare a scaling report with a baseline report of the same suite.
+    Return a list of regressions: runs that no longer finish and times,
+    latencies and memory sizes (keys ending in Seconds, Ms or Mb) that grew
+    by more than the given fraction.
+
+    >>> old = {'params': {}, 'runs': [
+    ...     {'docs': 10, 'status': 'ok', 'buildSeconds': 1.0,
+    ...      'latency': {'p95Ms': 2.0}},
+    ...     {'docs': 100, 'status': 'ok', 'buildSeconds': 10.0}]}
+    >>> new = {'params': {}, 'runs': [
+    ...     {'docs': 10, 'status': 'ok', 'buildSeconds': 1.05,
+    ...      'latency': {'p95Ms': 3.0}},
+    ...     {'docs': 100, 'status': 'timeout'}]}
+    >>> compareScaling(old, new, 0.1)
+    ['10 docs latency.p95Ms: 2.0 -> 3.0', '100 docs: ok -> timeout']
+    """
+
+    regressions = []
+    if baseline['params'] != report['params']:
+        regressions.append('parameters differ: {0} -> {1}'.format(
+            baseline['params'], report['params']))
+    oldRuns = {run['docs']: flatten(run) for run in baseline['runs']}
+    for run in report['runs']:
+        old = oldRuns.get(run['docs'])
+        if old is None:
+            continue
+        if old['status'] == 'ok' and run['status'] != 'ok':
+            regressions.append('{0} docs: ok -> {1}'.format(
+                run['docs'], run['status']))
+            continue
+        for key, new in sorted(flatten(run).items()):
+            if not key.endswith(('Seconds', 'Ms', 'Mb')) or key not in old \
+               or not isinstance(new, (int, float)):
+                continue
+            if new > old[key] * (1 + tolerance):
+                regressions.append('{0} docs {1}: {2} -> {3}'.format(
+                    run['docs'], key, old[key], new))
+    return regressions
+
+
+def addCorpusArguments(parser, numClasses=0):
+    """ Add the arguments of generateCorpus (and of the corpus sizes and
+    result files of a scaling benchmark) to an argparse parser. """
+
+    parser.add_argument('--vocab', type=int, default=100000,
+                        help='number of distinct terms')
+    parser.add_argument('--length', type=int, default=100,
+                        help='mean number of terms per document')
+    parser.add_argument('--zipf', type=float, default=1.0,
+                        help='exponent of the Zipf distribution of terms')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--classes', type=int, default=numClasses,
+                        help='number of classes of a labelled corpus')
+    parser.add_argument('--topic-weight', dest='topicWeight', type=float,
+                        default=0.3, help='fraction of the terms of a '
+                                          'labelled document drawn from its '
+                                          'class')
+
+
+def addScalingArguments(parser):
+    sizes = ','.join(str(size) for size in SCALING_DOCS)
+    parser.add_argument('--sizes', default=sizes,
+                        help='comma separated corpus sizes (number of '
+                             'documents)')
+    parser.add_argument('--timeout', type=float, default=3600,
+                        help='seconds per corpus size')
+    parser.add_argument('--json', help='write the report to this file '
+                                       '(- for stdout)')
+    parser.add_argument('--baseline', help='report to compare with, exit '
+                                           'with status 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+
+
+def corpusParams(args):
+    """ Return the generateCorpus parameters of the parsed arguments. """
+
+    return {'vocabSize': args.vocab, 'docLength': args.length,
+            'zipf': args.zipf, 'seed': args.seed, 'numClasses': args.classes,
+            'topicWeight': args.topicWeight}
+
+
+def finishScaling(report, args):
+    """ Write the report and compare it with the baseline as requested by
+    the parsed arguments (see addScalingArguments). """
+
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compareScaling(baseline, report, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {0}'.format(regression))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic Zipfian corpus, one document per '
+                    'line (<label>\\t<text> with --classes).')
+    parser.add_argument('docs', type=int, help='number of documents')
+    parser.add_argument('--output', '-o', help='file (default: stdout)')
+    parser.add_argument('--queries', type=int, default=0,
+                        help='write this many queries instead')
+    addCorpusArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.queries > 0:
+        lines = generateQueries(args.queries, args.vocab, args.zipf,
+                                args.seed)
+    else:
+        lines = generateCorpus(args.docs, **corpusParams(args))
+    f = sys.stdout if args.output is None else open(args.output, 'w')
+    for line in lines:
+        f.write(line + '\n')
+    if f is not sys.stdout:
+        f.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,210 @@
+"""
+Copyright 2016 Tarek Saier <tarek.saier@uranus.uni-freiburg.de>
+
+This work is free. You can redistribute it and/or modify
+it under the terms of the WTFPL, Version 2, as published
+by Sam Hocevar. See the COPYING file for more details.
+"""
+
+import array
+import numpy
+import re
+import sys
+import time
+
+_SPLIT = re.compile(r'\W+')
+
+
+def loadStopwords(fileName='stopwords_en.txt'):
+    """ Read a file with one stopword per line into a frozenset. """
+
+    with open(fileName) as f:
+        return frozenset(line.strip() for line in f)
+
+
+class Vocabulary:
+    """ Class for mapping terms to dense integer IDs and back. Each term is
+    stored once, as key of the term -> ID dict that the ID -> term list
+    shares. Document frequencies are an array indexed by ID. For saving,
+    the terms are packed into a UTF-8 string table (see packed). """
+
+    def __init__(self, terms=()):
+        """ Create a vocabulary containing the given terms.
+
+        >>> v = Vocabulary(['foo', 'bar'])
+        >>> v.add('baz'), v.add('foo'), len(v), 'bar' in v
+        (2, 0, 3, True)
+        >>> v.term(1), v.terms(), v.terms([2, 0])
+        ('bar', ['foo', 'bar', 'baz'], ['baz', 'foo'])
+        >>> v.dfs[0] += 2
+        >>> v.dfs[2] += 1
+        >>> [float('%.3f' % idf) for idf in v.idfs(4)]
+        [1.0, inf, 2.0]
+        >>> table, offsets = v.packed()
+        >>> table.tobytes(), offsets.tolist()
+        (b'foobarbaz', [0, 3, 6, 9])
+        >>> Vocabulary.fromPacked(table, offsets).ids == v.ids
+        True
+        >>> Vocabulary.fromPacked(*Vocabulary(['ä', '']).packed()).terms()
+        ['ä', '']
+        """
+
+        self.ids = {}                # term -> ID
+        self.termList = []           # ID -> term (the same str objects)
+        self.dfs = array.array('q')  # ID -> document frequency
+        for term in terms:
+            self.add(term)
+
+    def __len__(self):
+        return len(self.dfs)
+
+    def __contains__(self, term):
+        return term in self.ids
+
+    def add(self, term):
+        """ Return the ID of the term, adding it if it is unknown. """
+
+        termId = self.ids.get(term)
+        if termId is None:
+            termId = len(self.dfs)
+            self.ids[term] = termId
+            self.termList.append(term)
+            self.dfs.append(0)
+        return termId
+
+    def get(self, term, default=None):
+        """ Return the ID of the term or default if it is unknown. """
+
+        return self.ids.get(term, default)
+
+    def term(self, termId):
+        """ Return the term with the given ID. """
+
+        return self.termList[termId]
+
+    def terms(self, termIds=None):
+        """ Return a list of the terms with the given IDs (default: all). """
+
+        if termIds is None:
+            return list(self.termList)
+        return [self.termList[termId] for termId in termIds]
+
+    def dfArray(self):
+        """ Return the document frequencies as a NumPy array. """
+
+        return numpy.array(self.dfs, dtype=numpy.int64)
+
+    def idfs(self, numDocs):
+        """ Return log2(numDocs / df) for all IDs as a NumPy array. """
+
+        with numpy.errstate(divide='ignore'):
+            return numpy.log2(numDocs / self.dfArray())
+
+    def packed(self):
+        """ Return the terms as UTF-8 string table and the offsets of the
+        terms in it (term i is table[offsets[i]:offsets[i + 1]]) as NumPy
+        arrays, e.g. for saving them. """
+
+        encoded = [term.encode('utf-8') for term in self.termList]
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(term) for term in encoded], out=offsets[1:])
+        return (numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8),
+                offsets)
+
+    @staticmethod
+    def fromPacked(table, offsets):
+        """ Create a vocabulary from arrays returned by packed(). """
+
+        data = numpy.asarray(table).tobytes()
+        offsets = numpy.asarray(offsets).tolist()
+        return Vocabulary(data[offsets[i]:offsets[i + 1]].decode('utf-8')
+                          for i in range(len(offsets) - 1))
+
+
+class Tokenizer:
+    """ Class for splitting text into lower case words and mapping words to
+    integer term IDs. """
+
+    def __init__(self, stopwords=()):
+        """ Create a tokenizer with the given stopwords.
+
+        >>> t = Tokenizer(['the', 'a'])
+        >>> t.tokenize('The Man, the Myth -- a_legend!')
+        ['the', 'man', 'the', 'myth', 'a_legend']
+        >>> t.tokenize('The Man, the Myth -- a_legend!', removeStopwords=True)
+        ['man', 'myth', 'a_legend']
+        >>> [t.termId(w) for w in t.tokenize('b a b c')]
+        [0, 1, 0, 2]
+        >>> t.vocab.terms()
+        ['b', 'a', 'c']
+        """
+
+        self.stopwords = frozenset(stopwords)
+        self.vocab = Vocabulary()
+
+    def tokenize(self, text, removeStopwords=False):
+        """ Return the lower case words of the given text. """
+
+        words = _SPLIT.split(text.lower())
+        if removeStopwords:
+            stopwords = self.stopwords
+            return [w for w in words if w and w not in stopwords]
+        return [w for w in words if w]
+
+    def tokenizeLines(self, lines, removeStopwords=False):
+        """ Yield the list of words of each of the given lines.
+
+        >>> list(Tokenizer().tokenizeLines(['foo bar', '', 'Baz.']))
+        [['foo', 'bar'], [], ['baz']]
+        """
+
+        for line in lines:
+            yield self.tokenize(line, removeStopwords)
+
+    def termId(self, term):
+        """ Return the ID of the given term in self.vocab. Unknown terms get
+        the next free ID. """
+
+        return self.vocab.add(term)
+
+
+if __name__ == '__main__':
+    """ Micro-benchmark: compare the throughput of inline tokenization with
+    an uncompiled pattern to the Tokenizer for a file given as command line
+    parameter. """
+
+    if len(sys.argv) != 2:
+        print('Usage: python3 tokenizer.py <filename>')
+        sys.exit()
+
+    with open(sys.argv[1]) as f:
+        lines = f.readlines()
+
+    start = time.time()
+    numTokens = 0
+    for line in lines:
+        for word in re.split(r'\W+', line):
+            if len(word) > 0:
+                word = word.lower()
+                numTokens += 1
+    end = time.time()
+    print('inline re.split: {0:.0f} tokens/s'.format(
+        numTokens / (end - start)))
+
+    tokenizer = Tokenizer(loadStopwords())
+    for removeStopwords in [False, True]:
+        start = time.time()
+        numTokens = 0
+        for words in tokenizer.tokenizeLines(lines, removeStopwords):
+            numTokens += len(words)
+        end = time.time()
+        print('Tokenizer (removeStopwords={0}): {1:.0f} tokens/s'.format(
+            removeStopwords, numTokens / (end - start)))
+
+    start = time.time()
+    for words in tokenizer.tokenizeLines(lines):
+        for w in words:
+            tokenizer.termId(w)
+    end = time.time()
+    print('Tokenizer + term IDs: {0:.0f} tokens/s ({1} terms)'.format(
+        numTokens / (end - start), len(tokenizer.vocab)))